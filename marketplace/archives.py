@@ -0,0 +1,178 @@
+# marketplace/archives.py
+"""Look inside uploaded ZIP/APK archives without extracting them.
+
+``inspect_archive`` reads the central directory through a seekable file
+(a GridOut streams just the chunks it touches) and judges the archive by the
+sizes it declares. Only entries whose declared size looks wrong are inflated,
+in small reads, to see how far they really expand. Nothing is written to disk
+and memory stays at one read buffer.
+"""
+import stat
+import struct
+import zipfile
+import zlib
+
+from django.conf import settings
+
+ARCHIVE_MAX_ENTRIES = getattr(settings, "ARCHIVE_MAX_ENTRIES", 20000)
+ARCHIVE_MAX_UNCOMPRESSED = getattr(settings, "ARCHIVE_MAX_UNCOMPRESSED", 4 * 1024 ** 3)
+ARCHIVE_MAX_RATIO = getattr(settings, "ARCHIVE_MAX_RATIO", 100)
+ARCHIVE_MANIFEST_ENTRIES = getattr(settings, "ARCHIVE_MANIFEST_ENTRIES", 200)
+
+READ_SIZE = 256 * 1024
+# Entries smaller than this can't hide a bomb, whatever their ratio
+RATIO_MIN_SIZE = 1024 * 1024
+NESTED_ARCHIVE_EXTENSIONS = (".zip", ".apk", ".jar", ".7z", ".rar", ".gz", ".xz", ".bz2")
+# Local file header: 30 fixed bytes, then the name and extra field
+LOCAL_HEADER_SIZE = 30
+
+
+def _unsafe_path(name: str):
+    path = name.replace("\\", "/")
+    if path.startswith("/") or (len(path) > 1 and path[1] == ":"):
+        return "absolute path"
+    if ".." in path.split("/"):
+        return "path traversal"
+    return None
+
+
+def _ratio(size, compressed):
+    return round(size / compressed, 1) if compressed else (0.0 if not size else float("inf"))
+
+
+def _overlapping(infos):
+    """Entries whose data runs into the next local header (overlapped-file bombs)."""
+    ordered = sorted(infos, key=lambda i: i.header_offset)
+    return [
+        info.filename for info, nxt in zip(ordered, ordered[1:])
+        if info.header_offset + LOCAL_HEADER_SIZE + len(info.orig_filename.encode("utf-8", "replace"))
+        + info.compress_size > nxt.header_offset
+    ]
+
+
+def _deflate_bound(size):
+    # zlib's deflateBound(): the most a deflate stream of ``size`` bytes can take
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13
+
+
+def _suspicious(info, ratio):
+    """Entries whose declared size the data may not honour."""
+    return info.compress_size > _deflate_bound(info.file_size) or (
+        info.file_size >= RATIO_MIN_SIZE and ratio > ARCHIVE_MAX_RATIO
+    )
+
+
+def _inflated_size(fileobj, info, limit):
+    """Inflate ``info``'s raw deflate data in READ_SIZE steps; stop once past ``limit``.
+
+    ``ZipFile.open`` stops at the declared size, so this reads the stream
+    itself to see how far it really expands.
+    """
+    fileobj.seek(info.header_offset)
+    header = fileobj.read(LOCAL_HEADER_SIZE)
+    if len(header) < LOCAL_HEADER_SIZE or header[:4] != b"PK\x03\x04":
+        raise zipfile.BadZipFile("bad local file header")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    fileobj.seek(info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length)
+
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    remaining, total = info.compress_size, 0
+    while remaining and not inflater.eof:
+        block = fileobj.read(min(READ_SIZE, remaining))
+        if not block:
+            break
+        remaining -= len(block)
+        while True:
+            inflated = inflater.decompress(block, READ_SIZE)
+            total += len(inflated)
+            if total > limit:
+                return total
+            block = inflater.unconsumed_tail
+            if not block and len(inflated) < READ_SIZE:
+                break
+    return total
+
+
+def inspect_archive(fileobj):
+    """Return ``(issues, {"archive": manifest})`` for a ZIP-based archive.
+
+    ``fileobj`` must be seekable. Files that aren't ZIPs (e.g. an octet-stream
+    upload that isn't an APK) return no issues and no manifest.
+    """
+    if not zipfile.is_zipfile(fileobj):
+        return [], {}
+    fileobj.seek(0)
+    issues = []
+    try:
+        archive = zipfile.ZipFile(fileobj)
+    except (zipfile.BadZipFile, OSError) as exc:
+        return [f"corrupt archive: {exc}"], {}
+
+    with archive:
+        infos = archive.infolist()
+        if len(infos) > ARCHIVE_MAX_ENTRIES:
+            issues.append(f"{len(infos)} entries (limit {ARCHIVE_MAX_ENTRIES})")
+            infos = infos[:ARCHIVE_MAX_ENTRIES]
+
+        declared_total = sum(i.file_size for i in infos)
+        compressed_total = sum(i.compress_size for i in infos)
+        if declared_total > ARCHIVE_MAX_UNCOMPRESSED:
+            issues.append(f"expands to {declared_total} bytes")
+        overlaps = _overlapping(infos)
+        if overlaps:
+            issues.append(f"overlapping entries: {', '.join(overlaps[:5])}")
+
+        entries, encrypted, nested, symlinks = [], 0, 0, 0
+        budget = ARCHIVE_MAX_UNCOMPRESSED
+        for info in infos:
+            name = info.filename
+            problem = _unsafe_path(name)
+            if problem:
+                issues.append(f"{problem}: {name}")
+            if stat.S_ISLNK(info.external_attr >> 16):
+                symlinks += 1
+                issues.append(f"symlink: {name}")
+            if info.is_dir():
+                continue
+            if name.lower().endswith(NESTED_ARCHIVE_EXTENSIONS):
+                nested += 1
+            ratio = _ratio(info.file_size, info.compress_size)
+            if info.file_size >= RATIO_MIN_SIZE and ratio > ARCHIVE_MAX_RATIO:
+                issues.append(f"compression ratio {ratio}:1: {name}")
+
+            if info.flag_bits & 0x1:
+                encrypted += 1
+            elif (not overlaps and info.compress_type == zipfile.ZIP_DEFLATED
+                    and budget > 0 and _suspicious(info, ratio)):
+                # Extractors that trust the stream rather than the central
+                # directory would write whatever this inflates to.
+                try:
+                    actual = _inflated_size(fileobj, info, min(info.file_size, budget))
+                except (zipfile.BadZipFile, zlib.error, OSError, struct.error) as exc:
+                    issues.append(f"unreadable entry {name}: {exc}")
+                else:
+                    if actual > info.file_size:
+                        issues.append(f"entry inflates past its declared size: {name}")
+                    budget -= actual
+
+            if len(entries) < ARCHIVE_MANIFEST_ENTRIES:
+                entries.append({
+                    "name": name, "size": info.file_size,
+                    "compressed": info.compress_size, "ratio": ratio,
+                })
+
+        if encrypted:
+            issues.append(f"{encrypted} encrypted entries could not be checked")
+
+        manifest = {
+            "entry_count": len(infos),
+            "total_size": declared_total,
+            "compressed_size": compressed_total,
+            "ratio": _ratio(declared_total, compressed_total),
+            "nested_archives": nested,
+            "symlinks": symlinks,
+            "encrypted": encrypted,
+            "entries": entries,
+            "truncated": len(infos) > len(entries),
+        }
+    return issues, {"archive": manifest}
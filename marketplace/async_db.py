@@ -0,0 +1,31 @@
+# marketplace/async_db.py
+import asyncio
+import weakref
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+
+from .db import MONGO_URI, MONGO_DB_NAME, client_options, connections
+from .profiling import command_profiler
+
+# Motor clients are bound to the event loop they first run on. Under uvicorn
+# there is one loop per worker process; keying by loop keeps tests and
+# async_to_sync callers, which spin up their own loops, from sharing a client.
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = AsyncIOMotorClient(MONGO_URI, event_listeners=[connections.pool_stats, command_profiler], **client_options())
+        _clients[loop] = client
+    return client
+
+
+def get_db():
+    """The marketplace database for the running event loop."""
+    return get_client()[MONGO_DB_NAME]
+
+
+def gridfs_bucket(bucket_name: str):
+    return AsyncIOMotorGridFSBucket(get_db(), bucket_name=bucket_name)
@@ -0,0 +1,262 @@
+# marketplace/async_views.py
+"""Async versions of the hot read paths, served when ASYNC_VIEWS is on.
+
+Run under an ASGI server (``gunicorn modmarket.asgi:application -k
+uvicorn.workers.UvicornWorker``): Mongo reads go through Motor and GridFS
+downloads stream from an async iterator, so a slow client holds a coroutine
+instead of a worker. Under WSGI Django would run each of these views in its
+own event loop, which works but gains nothing.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.contrib import messages
+from django.contrib.auth.views import redirect_to_login
+from django.http import Http404
+from django.shortcuts import render, redirect
+
+from .async_db import get_db
+from .cache import doc_cache
+from .counters import download_counter
+from .media import aserve_gridfs, DOWNLOAD_BUCKETS, IMMUTABLE_PUBLIC, IMMUTABLE_PRIVATE, REVALIDATE_PRIVATE
+from .models import (
+    BatchLoader, PRODUCT_CARD_FIELDS, count_cache_get, count_cache_put, page_query, page_result
+)
+from .profiling import query_budget
+from .search import catalog_index
+from .views import (
+    LISTING_PAGE_SIZE, _listing_params, _listing_context, _decorate_product, _detail_context
+)
+
+
+# ------------------------
+# Async data access
+# ------------------------
+class AsyncBatchLoader(BatchLoader):
+    """BatchLoader whose `$in` queries run through Motor."""
+
+    async def _aload(self, cache: dict, collection, field: str, keys):
+        wanted, missing = self._pending(cache, keys)
+        if missing:
+            docs = await collection.find({field: {"$in": missing}}).to_list(None)
+            self._fill(cache, field, docs, missing)
+        return {k: cache[k] for k in wanted}
+
+    async def developers(self, developer_ids):
+        return await self._aload(self._developers, get_db().developers, "_id", developer_ids)
+
+    async def users(self, user_ids):
+        return await self._aload(self._users, get_db().users, "user_id", user_ids)
+
+    async def categories(self, names):
+        return await self._aload(self._categories, get_db().categories, "category", names)
+
+    async def attach_developers(self, products: list):
+        devs = await self.developers(p.get("developer_id") for p in products)
+        users = await self.users(d.get("user_id") for d in devs.values() if d)
+        return self.link_developers(products, devs, users)
+
+    async def attach_categories(self, products: list):
+        cats = await self.categories(self.category_names(products))
+        return self.link_categories(products, cats)
+
+
+async def _value(value):
+    return value
+
+async def product_doc(pk: str):
+    return await doc_cache.aget("product", pk, lambda: get_db().products.find_one({"_id": pk}))
+
+async def developer_get(dev_id: str):
+    return await doc_cache.aget("developer", dev_id, lambda: get_db().developers.find_one({"_id": dev_id}))
+
+async def user_get(user_id: int):
+    return await doc_cache.aget("user", user_id, lambda: get_db().users.find_one({"user_id": user_id}))
+
+async def user_get_by_pk(pk: str):
+    return await doc_cache.aget("user_pk", pk, lambda: get_db().users.find_one({"_id": pk}))
+
+async def products_count_cached(q: dict):
+    key, total = count_cache_get(q)
+    if total is None:
+        products = get_db().products
+        total = await (products.estimated_document_count() if not q else products.count_documents(q))
+        count_cache_put(key, total)
+    return total
+
+async def products_find_page(q, sort_field, sort_dir, limit, skip=0, after=None, before=None):
+    query, sort, skip, backwards = page_query(q, sort_field, sort_dir, skip, after, before)
+    docs = await get_db().products.find(query, PRODUCT_CARD_FIELDS).sort(sort).skip(skip).limit(limit + 1).to_list(None)
+    return page_result(docs, limit, backwards)
+
+async def products_search_page(q: dict, ranked: list, limit: int, skip: int = 0):
+    products = get_db().products
+    ids = [pid for pid, _ in ranked]
+    matching = {d["_id"] for d in await products.find({**q, "_id": {"$in": ids}}, {"_id": 1}).to_list(None)}
+    ordered = [pid for pid in ids if pid in matching]
+    page_ids = ordered[skip:skip + limit]
+    by_id = {d["_id"]: d for d in await products.find({"_id": {"$in": page_ids}}, PRODUCT_CARD_FIELDS).to_list(None)}
+    docs = [by_id[pid] for pid in page_ids if pid in by_id]
+    return docs, len(ordered) > skip + limit, len(ordered)
+
+async def category_facets(limit=None):
+    cur = get_db().category_stats.find({"approved_count": {"$gt": 0}}).sort("_id", 1)
+    if limit:
+        cur = cur.limit(int(limit))
+    return [{"category": c["_id"], "count": c["approved_count"]} async for c in cur]
+
+async def reviews_for_product(pk: str):
+    try:
+        product_id = ObjectId(pk)
+    except InvalidId:
+        return []
+    reviews = await get_db().reviews.find({"product_id": product_id}).sort("created_at", -1).to_list(None)
+    users = await AsyncBatchLoader().users(r["user_id"] for r in reviews)
+    for r in reviews:
+        r["user"] = users.get(r["user_id"])
+    return reviews
+
+async def review_get_by_user(user_id, pk: str):
+    try:
+        product_id = ObjectId(pk)
+    except InvalidId:
+        return None
+    return await get_db().reviews.find_one({"user_id": user_id, "product_id": product_id})
+
+
+# ------------------------
+# Helpers
+# ------------------------
+async def _auth_user(request):
+    """Resolve the lazy ``request.user`` (session + auth DB) off the event loop."""
+    await sync_to_async(lambda: request.user.is_authenticated)()
+    return request.user
+
+async def _developer_for(user):
+    # Unlike developer_get_or_create this never inserts: a user without a
+    # profile can't own a product, which is all these views need to know.
+    if not user.is_authenticated:
+        return None
+    return await get_db().developers.find_one({"user_id": int(user.id)})
+
+async def _error(request, message):
+    await sync_to_async(messages.error)(request, message)
+
+async def _render(request, template, context):
+    return await sync_to_async(render)(request, template, context)
+
+
+# ------------------------
+# File serving
+# ------------------------
+async def serve_file(request, file_id, bucket_name="products", inline=False, cache_control=IMMUTABLE_PRIVATE):
+    return await aserve_gridfs(request, bucket_name, file_id, inline=inline, cache_control=cache_control)
+
+async def serve_thumbnail(request, file_id):
+    return await serve_file(request, file_id, bucket_name="thumbnails", inline=True, cache_control=IMMUTABLE_PUBLIC)
+
+async def serve_avatar(request, file_id):
+    return await serve_file(request, file_id, bucket_name="avatars", inline=True, cache_control=IMMUTABLE_PUBLIC)
+
+async def download_product_file(request, file_id, bucket):
+    if bucket not in DOWNLOAD_BUCKETS:
+        raise Http404("File not found.")
+    return await serve_file(request, file_id, bucket_name=bucket, inline=True)
+
+async def download_product(request, pk):
+    user = await _auth_user(request)
+    if not user.is_authenticated:
+        return redirect_to_login(request.get_full_path())
+
+    profile, product = await asyncio.gather(_developer_for(user), product_doc(pk))
+    if product and product.get("status") != "approved" and (not profile or product.get("developer_id") != profile["_id"]):
+        product = None
+    if not product:
+        await _error(request, "Product not available for download.")
+        return redirect("home")
+    main_file = await get_db().product_files.find_one({"product_id": pk, "file_type": "main"})
+    if not main_file:
+        await _error(request, "Main product file not found.")
+        return redirect("product_detail", pk=pk)
+    download_counter.record(
+        pk, user.id,
+        ip=request.META.get("REMOTE_ADDR", ""),
+        ua=request.META.get("HTTP_USER_AGENT", "")[:256],
+    )
+    # the URL names the product, not the file, so clients revalidate each time
+    return await serve_file(request, file_id=main_file["path"], bucket_name="products", inline=False,
+                            cache_control=REVALIDATE_PRIVATE)
+
+
+# ------------------------
+# Catalog pages
+# ------------------------
+@query_budget(10)
+async def product_list(request):
+    params = _listing_params(request)
+    q, query = params["q"], params["query"]
+    # BM25 scoring is CPU work on an in-process index; keep it off the loop.
+    ranked = await sync_to_async(catalog_index.search, thread_sensitive=False)(query) if query else None
+
+    per_page = LISTING_PAGE_SIZE
+    if ranked is not None and params["sort_by"] == "relevance":
+        items, has_more, total = await products_search_page(q, ranked, per_page, skip=params["skip"])
+        params["after"] = params["before"] = None
+    else:
+        if ranked is not None:
+            q["_id"] = {"$in": [pid for pid, _ in ranked]}
+            total = await get_db().products.count_documents(q)
+        else:
+            total = await products_count_cached(q)
+        items, has_more = await products_find_page(
+            q, params["sort_field"], params["sort_dir"], per_page,
+            skip=params["skip"], after=params["after"], before=params["before"]
+        )
+    for p in items:
+        p["id"] = str(p["_id"])
+    loader = AsyncBatchLoader()
+    categories, *_ = await asyncio.gather(
+        category_facets(), loader.attach_developers(items), loader.attach_categories(items)
+    )
+
+    context = _listing_context(request, params, items, has_more, total, categories)
+    return await _render(request, "marketplace/product_list.html", context)
+
+@query_budget(13)
+async def product_detail(request, pk):
+    user = await _auth_user(request)
+    profile, product = await asyncio.gather(_developer_for(user), product_doc(pk))
+    if product and not user.is_staff and product.get("status") != "approved":
+        if not profile or product.get("developer_id") != profile["_id"]:
+            product = None
+    if not product:
+        await _error(request, "Product not found.")
+        return redirect("home")
+
+    adb = get_db()
+    approved = product.get("status") == "approved"
+    # Everything below depends only on the product, so fetch it concurrently.
+    license, files, listed_files, user_details, dev, reviews, user_review, related, category = await asyncio.gather(
+        adb.licenses.find_one({"product_id": product["_id"]}),
+        adb.product_files.find({"product_id": product["_id"]}).to_list(None),
+        adb.product_files.find({"product_id": pk}).sort("uploaded_at", -1).to_list(None),
+        user_get_by_pk(product["user_id"]),
+        developer_get(product["developer_id"]),
+        reviews_for_product(pk) if approved else _value([]),
+        review_get_by_user(user.id, pk) if approved and user.is_authenticated else _value([]),
+        adb.products.find({
+            "category_id": product.get("category"),
+            "status": "approved",
+            "_id": {"$ne": pk}
+        }, PRODUCT_CARD_FIELDS).limit(4).to_list(None),
+        adb.categories.find_one({"_id": str(product.get("category_id"))}),
+    )
+    if dev:
+        product["developer"] = {**dev, "user": await user_get(dev["user_id"])}
+    _decorate_product(product, license, files, user_details, dev)
+
+    return await _render(request, "marketplace/product_detail.html", _detail_context(
+        request, product, reviews, user_review, related, listed_files, category
+    ))
@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import gridfs
+from bson import ObjectId
+from django.conf import settings
+
+from .db import get_db
+
+logger = logging.getLogger(__name__)
+
+BLOB_CACHE_DIR = getattr(settings, "BLOB_CACHE_DIR", None)
+BLOB_CACHE_MAX_BYTES = getattr(settings, "BLOB_CACHE_MAX_BYTES", 2 * 1024 ** 3)
+BLOB_CACHE_MAX_FILE_BYTES = getattr(settings, "BLOB_CACHE_MAX_FILE_BYTES", 200 * 1024 ** 2)
+# Evict down to this fraction of the budget so fills don't trigger a scan each time.
+EVICT_TO = 0.9
+FILL_WORKERS = 2
+
+_BUCKET_RE = re.compile(r"^[\w.-]+$")
+
+
+class BlobCache:
+    """Optional on-disk LRU copy of GridFS files, keyed by bucket and ObjectId.
+
+    Each entry is a data file plus a ``.json`` sidecar holding the headers we
+    need to serve it; the sidecar is written last, so its presence marks a
+    complete entry. Misses are filled by a small background thread pool
+    (temp file + ``os.replace``), and the least recently served entries (by
+    mtime, bumped on every hit) are evicted once ``max_bytes`` is exceeded.
+    Deleting a GridFS file should ``invalidate`` its entry; that reaches every
+    worker sharing this directory, not other hosts.
+    """
+
+    def __init__(self, root=BLOB_CACHE_DIR, max_bytes=BLOB_CACHE_MAX_BYTES, max_file_bytes=BLOB_CACHE_MAX_FILE_BYTES):
+        self.root = Path(root) if root else None
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self._pid = None
+        self._init_worker()
+
+    def _init_worker(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._inflight = set()
+        self._size = None
+        self._stats = {"hits": 0, "misses": 0, "bytes_saved": 0, "fills": 0, "fill_errors": 0, "evictions": 0}
+
+    @property
+    def enabled(self):
+        return self.root is not None
+
+    def _paths(self, bucket, file_id):
+        if not _BUCKET_RE.match(bucket) or not ObjectId.is_valid(file_id):
+            return None
+        base = self.root / bucket / file_id[:2] / file_id
+        return base, base.with_suffix(".json")
+
+    def lookup(self, bucket, file_id):
+        """Return ``(data_path, meta)`` for a cached file, or ``None``."""
+        if self._pid != os.getpid():
+            self._init_worker()
+        paths = self._paths(bucket, str(file_id))
+        if not paths:
+            return None
+        data_path, meta_path = paths
+        try:
+            meta = json.loads(meta_path.read_text())
+            os.utime(data_path)  # LRU recency
+        except (OSError, ValueError):
+            with self._lock:
+                self._stats["misses"] += 1
+            return None
+        with self._lock:
+            self._stats["hits"] += 1
+        return data_path, meta
+
+    def record_served(self, nbytes):
+        with self._lock:
+            self._stats["bytes_saved"] += nbytes
+
+    def schedule_fill(self, bucket, file_id, length):
+        if not self.enabled or length > self.max_file_bytes or not self._paths(bucket, str(file_id)):
+            return
+        key = (bucket, str(file_id))
+        with self._lock:
+            if key in self._inflight:
+                return
+            self._inflight.add(key)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=FILL_WORKERS, thread_name_prefix="blob-cache")
+        self._executor.submit(self._fill, *key)
+
+    def _fill(self, bucket, file_id):
+        data_path, meta_path = self._paths(bucket, file_id)
+        try:
+            grid_out = gridfs.GridFS(get_db(), collection=bucket).get(ObjectId(file_id))
+            data_path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=data_path.parent, prefix=".fill-")
+            try:
+                with os.fdopen(fd, "wb") as out:
+                    for chunk in grid_out:
+                        out.write(chunk)
+                os.replace(tmp, data_path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            meta = {
+                "file_id": file_id,
+                "bucket": bucket,
+                "length": grid_out.length,
+                "content_type": grid_out.content_type,
+                "filename": grid_out.filename,
+                "upload_date": grid_out.upload_date.isoformat() if grid_out.upload_date else None,
+            }
+            fd, tmp = tempfile.mkstemp(dir=data_path.parent, prefix=".meta-")
+            with os.fdopen(fd, "w") as out:
+                json.dump(meta, out)
+            os.replace(tmp, meta_path)
+            with self._lock:
+                self._stats["fills"] += 1
+                if self._size is not None:
+                    self._size += grid_out.length
+                over = self._size is None or self._size > self.max_bytes
+            if over:
+                self.evict()
+        except Exception:
+            logger.exception("blob cache fill failed for %s/%s", bucket, file_id)
+            with self._lock:
+                self._stats["fill_errors"] += 1
+        finally:
+            with self._lock:
+                self._inflight.discard((bucket, file_id))
+
+    def invalidate(self, bucket, file_id):
+        """Drop the cached copy of a GridFS file that is being deleted."""
+        if not self.enabled:
+            return
+        paths = self._paths(bucket, str(file_id))
+        if not paths:
+            return
+        data_path, meta_path = paths
+        removed = 0
+        for path in (meta_path, data_path):
+            try:
+                size = path.stat().st_size
+                path.unlink()
+            except OSError:
+                continue
+            if path == data_path:
+                removed = size
+        if removed:
+            with self._lock:
+                if self._size is not None:
+                    self._size -= removed
+
+    def _entries(self):
+        for meta_path in self.root.glob("*/*/*.json"):
+            data_path = meta_path.with_suffix("")
+            try:
+                st = data_path.stat()
+            except OSError:
+                continue
+            yield st.st_mtime, st.st_size, data_path, meta_path
+
+    def evict(self):
+        """Delete least recently served entries until under the byte budget."""
+        if not self.enabled:
+            return 0
+        entries = sorted(self._entries())
+        total = sum(e[1] for e in entries)
+        target = self.max_bytes * EVICT_TO if total > self.max_bytes else total
+        evicted = 0
+        for _, size, data_path, meta_path in entries:
+            if total <= target:
+                break
+            for path in (meta_path, data_path):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._size = total
+            self._stats["evictions"] += evicted
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            size = self._size
+        lookups = s["hits"] + s["misses"]
+        return {
+            **s,
+            "enabled": self.enabled,
+            "hit_ratio": round(s["hits"] / lookups, 4) if lookups else 0.0,
+            "bytes_cached": size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+blob_cache = BlobCache()
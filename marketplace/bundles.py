@@ -0,0 +1,152 @@
+# marketplace/bundles.py
+""""Download all files" ZIP bundles, streamed straight from GridFS.
+
+The archive is written through ``zipfile`` into a small in-memory sink that is
+drained after every GridFS chunk, so memory stays at about one chunk whatever
+the product's size and nothing touches local disk. Members that are already
+compressed (archives, images, media) are stored as-is.
+
+Every download rebuilds the archive from the member blobs; only the list of
+members and its signature are cached. Member timestamps come from GridFS, so
+the same members always produce the same bytes and the signature doubles as
+the ETag.
+"""
+import hashlib
+import logging
+import posixpath
+import re
+import zipfile
+from datetime import datetime
+
+import gridfs
+from bson import ObjectId
+from django.utils.http import quote_etag
+
+from .cache import doc_cache
+from .db import db, get_db
+from .media import iter_gridfs
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_NAMESPACE = "bundle"
+
+STORED_CONTENT_TYPES = {
+    "application/zip", "application/java-archive", "application/vnd.android.package-archive",
+    "application/gzip", "application/x-7z-compressed", "application/x-rar-compressed",
+    "image/png", "image/jpeg", "image/gif", "image/webp", "video/mp4", "audio/mpeg", "audio/ogg",
+}
+STORED_EXTENSIONS = {
+    ".zip", ".apk", ".jar", ".7z", ".rar", ".gz", ".tgz", ".xz", ".bz2", ".zst",
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".mp4", ".mp3", ".ogg", ".pak",
+}
+_UNSAFE_NAME_RE = re.compile(r"[^\w. ()-]+")
+
+
+def _compression(filename, content_type):
+    ext = posixpath.splitext((filename or "").lower())[1]
+    if content_type in STORED_CONTENT_TYPES or ext in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def _arcname(folder, filename, taken):
+    name = _UNSAFE_NAME_RE.sub("_", posixpath.basename((filename or "").replace("\\", "/"))).strip(" .") or "file"
+    stem, ext = posixpath.splitext(name)
+    candidate, n = f"{folder}/{name}", 1
+    while candidate in taken:
+        n += 1
+        candidate = f"{folder}/{stem} ({n}){ext}"
+    taken.add(candidate)
+    return candidate
+
+
+def bundle_members(product_id: str):
+    """``(signature, members)`` for a product's files plus its license.
+
+    Each member is ``{"name", "bucket", "file_id", "size", "compression"}``;
+    the signature changes whenever a file is added, removed or replaced.
+    """
+    manifest = doc_cache.get(BUNDLE_NAMESPACE, product_id, lambda: _manifest(product_id))
+    return manifest["signature"], manifest["members"]
+
+
+def _manifest(product_id):
+    fields = {"path": 1, "bucket": 1, "filename": 1, "file_size": 1, "file_type": 1, "content_type": 1}
+    files = list(db.product_files.find({"product_id": product_id}, fields).sort([("file_type", 1), ("_id", 1)]))
+    license = db.licenses.find_one({"product_id": product_id}, fields)
+    taken, members = set(), []
+    for doc, folder in [(f, f.get("file_type") or "files") for f in files] + ([(license, "license")] if license else []):
+        members.append({
+            "name": _arcname(folder, doc.get("filename"), taken),
+            "bucket": doc.get("bucket") or "products",
+            "file_id": str(doc["path"]),
+            "size": int(doc.get("file_size") or 0),
+            "compression": _compression(doc.get("filename"), doc.get("content_type")),
+        })
+    signature = hashlib.sha256(
+        "\n".join(f"{m['name']}\0{m['bucket']}\0{m['file_id']}" for m in members).encode()
+    ).hexdigest()
+    return {"signature": signature, "members": members}
+
+
+def bundle_invalidate(product_id: str):
+    """Drop the cached manifest after the product's files or license change."""
+    doc_cache.invalidate(BUNDLE_NAMESPACE, product_id)
+
+
+def bundle_etag(signature: str):
+    # the archive is rebuilt byte for byte from the same members, so the
+    # signature identifies the response body
+    return quote_etag(f"bundle-{signature}")
+
+
+class _Sink:
+    """Write-only, unseekable file for ZipFile; ``drain()`` hands back what was written."""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def _zip_stream(members):
+    fs_by_bucket = {}
+    sink = _Sink()
+    with zipfile.ZipFile(sink, mode="w") as archive:
+        for member in members:
+            fs = fs_by_bucket.get(member["bucket"])
+            if fs is None:
+                fs = fs_by_bucket[member["bucket"]] = gridfs.GridFS(get_db(), collection=member["bucket"])
+            try:
+                grid_out = fs.get(ObjectId(member["file_id"]))
+            except gridfs.NoFile:
+                logger.warning("bundle member %s/%s is missing", member["bucket"], member["file_id"])
+                continue
+            info = zipfile.ZipInfo(member["name"], date_time=(grid_out.upload_date or datetime.now()).timetuple()[:6])
+            info.compress_type = member["compression"]
+            info.file_size = grid_out.length  # lets zipfile decide on ZIP64 up front
+            with archive.open(info, mode="w") as entry:
+                for chunk in iter_gridfs(grid_out):
+                    entry.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            yield sink.drain()
+    yield sink.drain()
+
+
+def stream_bundle(members):
+    """Yield the ZIP bytes of ``members``."""
+    for data in _zip_stream(members):
+        if data:
+            yield data
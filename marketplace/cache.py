@@ -0,0 +1,166 @@
+import copy
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+
+DOC_CACHE_TTL = getattr(settings, "DOC_CACHE_TTL", 60)
+DOC_CACHE_MAX_ENTRIES = getattr(settings, "DOC_CACHE_MAX_ENTRIES", 2000)
+# Alias from CACHES to share entries across workers; None keeps the cache in-process only.
+DOC_CACHE_BACKEND = getattr(settings, "DOC_CACHE_BACKEND", None)
+
+
+class DocumentCache:
+    """Read-through cache for Mongo documents, grouped by namespace.
+
+    The first tier is an in-process LRU bounded by ``max_entries`` with a
+    per-entry TTL; the optional second tier is a Django cache backend shared by
+    all workers. Callers always get a deep copy, so views can decorate the
+    returned document without touching the cached one. Writers invalidate by
+    namespace and key, or drop a whole namespace with ``clear()``; other
+    workers' local tiers expire within ``ttl``.
+    """
+
+    def __init__(self, ttl=DOC_CACHE_TTL, max_entries=DOC_CACHE_MAX_ENTRIES, backend=DOC_CACHE_BACKEND):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (namespace, key) -> (expires_at, doc)
+        self._stats = defaultdict(lambda: {"hits": 0, "shared_hits": 0, "misses": 0, "invalidations": 0})
+
+    def _shared(self):
+        if not self.backend:
+            return None
+        from django.core.cache import caches
+        return caches[self.backend]
+
+    @staticmethod
+    def _version_keys(namespace):
+        return ["modmarket:doc:version", f"modmarket:doc:{namespace}:version"]
+
+    def _shared_key(self, shared, namespace, key):
+        # Shared entries can't be enumerated, so clear() bumps a version that is
+        # part of every key instead; the old entries are left to expire.
+        versions = shared.get_many(self._version_keys(namespace))
+        return self._versioned_key(versions, namespace, key)
+
+    async def _ashared_key(self, shared, namespace, key):
+        versions = await shared.aget_many(self._version_keys(namespace))
+        return self._versioned_key(versions, namespace, key)
+
+    def _versioned_key(self, versions, namespace, key):
+        version = ".".join(str(versions.get(k, 0)) for k in self._version_keys(namespace))
+        return f"modmarket:doc:{namespace}:{version}:{key}"
+
+    def _store(self, entry_key, doc):
+        with self._lock:
+            self._entries[entry_key] = (time.monotonic() + self.ttl, doc)
+            self._entries.move_to_end(entry_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, namespace, key, loader):
+        """Return the cached document for ``key`` or call ``loader()`` and cache it.
+
+        ``None`` results are not cached, so missing documents are always re-checked.
+        """
+        if key is None:
+            return None
+        entry_key = (namespace, key)
+        stats = self._stats[namespace]
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(entry_key)
+                stats["hits"] += 1
+                return copy.deepcopy(entry[1])
+        shared = self._shared()
+        shared_key = self._shared_key(shared, namespace, key) if shared else None
+        doc = shared.get(shared_key) if shared else None
+        if doc is not None:
+            stats["shared_hits"] += 1
+        else:
+            stats["misses"] += 1
+            doc = loader()
+            if doc is not None and shared:
+                shared.set(shared_key, doc, self.ttl)
+        if doc is not None:
+            self._store(entry_key, doc)
+        return copy.deepcopy(doc)
+
+    async def aget(self, namespace, key, loader):
+        """``get`` for async views: ``loader`` is a coroutine function.
+
+        The local tier is a plain dict lookup and safe to use on the event loop;
+        the shared tier goes through the backend's async API.
+        """
+        if key is None:
+            return None
+        entry_key = (namespace, key)
+        stats = self._stats[namespace]
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(entry_key)
+                stats["hits"] += 1
+                return copy.deepcopy(entry[1])
+        shared = self._shared()
+        shared_key = await self._ashared_key(shared, namespace, key) if shared else None
+        doc = await shared.aget(shared_key) if shared else None
+        if doc is not None:
+            stats["shared_hits"] += 1
+        else:
+            stats["misses"] += 1
+            doc = await loader()
+            if doc is not None and shared:
+                await shared.aset(shared_key, doc, self.ttl)
+        if doc is not None:
+            self._store(entry_key, doc)
+        return copy.deepcopy(doc)
+
+    def invalidate(self, namespace, key):
+        with self._lock:
+            self._entries.pop((namespace, key), None)
+            self._stats[namespace]["invalidations"] += 1
+        shared = self._shared()
+        if shared:
+            shared.delete(self._shared_key(shared, namespace, key))
+
+    def clear(self, namespace=None):
+        """Drop every entry in ``namespace`` (or all of them), in both tiers.
+
+        Other workers' local tiers still expire within ``ttl``.
+        """
+        with self._lock:
+            for entry_key in [k for k in self._entries if namespace is None or k[0] == namespace]:
+                del self._entries[entry_key]
+        shared = self._shared()
+        if shared:
+            version_key = self._version_keys(namespace)[0 if namespace is None else 1]
+            shared.set(version_key, time.time_ns(), None)
+
+    def stats(self):
+        with self._lock:
+            sizes = defaultdict(int)
+            for namespace, _ in self._entries:
+                sizes[namespace] += 1
+            out = {}
+            for namespace, s in self._stats.items():
+                lookups = s["hits"] + s["shared_hits"] + s["misses"]
+                out[namespace] = {
+                    **s,
+                    "entries": sizes.get(namespace, 0),
+                    "hit_ratio": round((s["hits"] + s["shared_hits"]) / lookups, 4) if lookups else 0.0,
+                }
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "backend": self.backend,
+                "namespaces": out,
+            }
+
+
+doc_cache = DocumentCache()
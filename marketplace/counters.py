@@ -0,0 +1,136 @@
+import atexit
+import logging
+import os
+import threading
+from datetime import datetime
+
+from bson import ObjectId
+from django.conf import settings
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from .db import db
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = getattr(settings, "DOWNLOAD_COUNTER_FLUSH_INTERVAL", 5)
+MAX_PENDING = getattr(settings, "DOWNLOAD_COUNTER_MAX_PENDING", 500)
+
+
+class DownloadCounter:
+    """Per-worker write-behind buffer for download events.
+
+    ``record`` only appends to memory. A background thread flushes the buffer
+    every ``FLUSH_INTERVAL`` seconds (or sooner once ``MAX_PENDING`` events are
+    queued) with one ``bulk_write`` of ``downloads`` upserts and one
+    ``bulk_write`` of ``$inc`` updates on ``products``. The unique
+    ``(user_id, product_id)`` index on ``downloads`` still decides which events
+    count, so repeat downloads by the same user don't bump ``download_count``.
+    Events and increments that fail to write go back into the buffer for the
+    next flush.
+    """
+
+    def __init__(self, interval=FLUSH_INTERVAL, max_pending=MAX_PENDING):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pid = None
+        self._init_worker()
+        atexit.register(self.flush)
+
+    def _init_worker(self):
+        # Called again after a fork: locks and threads don't survive it.
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._events = {}
+        self._increments = {}
+        self._wake = threading.Event()
+        self._thread = None
+
+    def _ensure_thread(self):
+        if self._pid != os.getpid():
+            self._init_worker()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="download-counter", daemon=True)
+            self._thread.start()
+
+    def record(self, product_id: str, user_id: int, ip: str = "", ua: str = ""):
+        self._ensure_thread()
+        with self._lock:
+            # keep the first event per (user, product) in this window
+            self._events.setdefault((int(user_id), product_id), {
+                "downloaded_at": datetime.now(),
+                "ip_address": ip,
+                "user_agent": ua,
+            })
+            pending = len(self._events)
+        if pending >= self.max_pending:
+            self._wake.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._events) + len(self._increments)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except PyMongoError:
+                logger.exception("download counter flush failed")
+
+    def _restore(self, events=None, increments=None):
+        with self._lock:
+            # events already buffered are newer; the earlier ones win as in record()
+            self._events = {**self._events, **(events or {})}
+            for product_id, n in (increments or {}).items():
+                self._increments[product_id] = self._increments.get(product_id, 0) + n
+
+    def flush(self):
+        with self._lock:
+            events, self._events = self._events, {}
+            increments, self._increments = self._increments, {}
+        if not events and not increments:
+            return 0
+        keys = list(events)
+        ops = [
+            UpdateOne(
+                {"user_id": user_id, "product_id": product_id},
+                {"$setOnInsert": {"_id": str(ObjectId()), **events[(user_id, product_id)]}},
+                upsert=True,
+            )
+            for user_id, product_id in keys
+        ]
+        upserted = {}
+        if ops:
+            try:
+                upserted = db.downloads.bulk_write(ops, ordered=False).upserted_ids
+            except BulkWriteError as exc:
+                # duplicate-key races with another worker: those events already counted
+                upserted = {u["index"]: u["_id"] for u in exc.details.get("upserted", [])}
+                failed = {keys[e["index"]] for e in exc.details.get("writeErrors", []) if e.get("code") != 11000}
+                self._restore(events={k: events[k] for k in failed})
+            except PyMongoError:
+                self._restore(events, increments)
+                raise
+        for index in upserted:
+            product_id = keys[index][1]
+            increments[product_id] = increments.get(product_id, 0) + 1
+        if increments:
+            pids = list(increments)
+            try:
+                db.products.bulk_write([
+                    UpdateOne({"_id": pid}, {"$inc": {"download_count": increments[pid]}})
+                    for pid in pids
+                ], ordered=False)
+            except BulkWriteError as exc:
+                failed = [pids[e["index"]] for e in exc.details.get("writeErrors", [])]
+                self._restore(increments={pid: increments[pid] for pid in failed})
+                raise
+            except PyMongoError:
+                self._restore(increments=increments)
+                raise
+        return sum(increments.values())
+
+
+download_counter = DownloadCounter()
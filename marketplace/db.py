@@ -1,44 +1,340 @@
 # marketplace/db.py
+import logging
 import os
-from pymongo import MongoClient, ASCENDING, DESCENDING
-from pymongo.errors import ServerSelectionTimeoutError
+import threading
+import time
+from collections import deque
+from datetime import datetime
 
-MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017")
-MONGO_DB_NAME = os.environ.get("MONGO_DB_NAME", "modmarket")
+from django.conf import settings
+from pymongo import MongoClient, ASCENDING, DESCENDING, monitoring
+from pymongo.errors import PyMongoError
 
-_client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=8000)
-db = _client[MONGO_DB_NAME]
+from .profiling import command_profiler
 
-def ensure_indexes():
+logger = logging.getLogger(__name__)
+
+MONGO_URI = getattr(settings, "MONGO_URI", os.environ.get("MONGO_URI", "mongodb://localhost:27017"))
+MONGO_DB_NAME = getattr(settings, "MONGO_DB_NAME", os.environ.get("MONGO_DB_NAME", "modmarket"))
+
+# MongoClient keyword -> setting name. Unset (None) settings keep the driver default.
+POOL_SETTINGS = {
+    "maxPoolSize": "MONGO_MAX_POOL_SIZE",
+    "minPoolSize": "MONGO_MIN_POOL_SIZE",
+    "maxIdleTimeMS": "MONGO_MAX_IDLE_TIME_MS",
+    "maxConnecting": "MONGO_MAX_CONNECTING",
+    "waitQueueTimeoutMS": "MONGO_WAIT_QUEUE_TIMEOUT_MS",
+    "connectTimeoutMS": "MONGO_CONNECT_TIMEOUT_MS",
+    "socketTimeoutMS": "MONGO_SOCKET_TIMEOUT_MS",
+    "serverSelectionTimeoutMS": "MONGO_SERVER_SELECTION_TIMEOUT_MS",
+}
+# Checkout latencies kept for the percentiles in PoolStats.stats()
+CHECKOUT_SAMPLES = 2048
+
+
+def client_options():
+    options = {}
+    for option, name in POOL_SETTINGS.items():
+        value = getattr(settings, name, None)
+        if value is not None:
+            options[option] = value
+    return options
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Connection pool listener tracking checkout latency and wait-queue depth.
+
+    A checkout "waits" from ConnectionCheckOutStarted until the connection is
+    handed over (or the checkout fails); both events fire on the requesting
+    thread, so the start time is kept in a thread-local.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._samples = deque(maxlen=CHECKOUT_SAMPLES)
+            self._counts = {
+                "checkouts": 0, "checkout_failures": 0, "connections_created": 0,
+                "connections_closed": 0, "pools_cleared": 0,
+            }
+            self._waiting = 0
+            self._max_waiting = 0
+            self._checked_out = 0
+            self._open = 0
+            self._total_wait = 0.0
+
+    def _end_wait(self, failed=False):
+        started = getattr(self._local, "started", None)
+        self._local.started = None
+        elapsed = time.perf_counter() - started if started is not None else 0.0
+        with self._lock:
+            self._waiting = max(self._waiting - 1, 0)
+            if failed:
+                self._counts["checkout_failures"] += 1
+            else:
+                self._counts["checkouts"] += 1
+                self._checked_out += 1
+                self._total_wait += elapsed
+                self._samples.append(elapsed)
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+        with self._lock:
+            self._waiting += 1
+            self._max_waiting = max(self._max_waiting, self._waiting)
+
+    def connection_checked_out(self, event):
+        self._end_wait()
+
+    def connection_check_out_failed(self, event):
+        self._end_wait(failed=True)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._checked_out = max(self._checked_out - 1, 0)
+
+    def connection_created(self, event):
+        with self._lock:
+            self._counts["connections_created"] += 1
+            self._open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self._counts["connections_closed"] += 1
+            self._open = max(self._open - 1, 0)
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._counts["pools_cleared"] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def stats(self):
+        with self._lock:
+            samples = sorted(self._samples)
+            out = {
+                **self._counts,
+                "waiting": self._waiting,
+                "max_waiting": self._max_waiting,
+                "checked_out": self._checked_out,
+                "open_connections": self._open,
+                "avg_checkout_ms": round(1000 * self._total_wait / self._counts["checkouts"], 3)
+                if self._counts["checkouts"] else 0.0,
+            }
+        for pct in (50, 95, 99):
+            out[f"p{pct}_checkout_ms"] = (
+                round(1000 * samples[min(int(pct / 100 * len(samples)), len(samples) - 1)], 3) if samples else 0.0
+            )
+        out["max_checkout_ms"] = round(1000 * samples[-1], 3) if samples else 0.0
+        return out
+
+
+class MongoConnections:
+    """Owns this process's MongoClient.
+
+    The client is created on first use, and again in a forked child (a client
+    created before gunicorn forks shares sockets and monitor threads with the
+    master and must not be used there). Pool options come from settings, see
+    ``POOL_SETTINGS``; each worker opens up to ``maxPoolSize`` connections per
+    server, so size workers x maxPoolSize against the server's connection limit.
+    """
+
+    def __init__(self, uri=MONGO_URI, db_name=MONGO_DB_NAME):
+        self.uri = uri
+        self.db_name = db_name
+        self.pool_stats = PoolStats()
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Drop (don't close) an inherited client: closing it in the child
+        # would act on sockets the parent still owns.
+        self._lock = threading.Lock()
+        self._client = None
+        self._db = None
+        self._pid = os.getpid()
+        self.pool_stats.reset()
+
+    @property
+    def client(self):
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+                if self._client is None:
+                    client = MongoClient(self.uri, event_listeners=[self.pool_stats, command_profiler], **client_options())
+                    self._db = client[self.db_name]
+                    self._client = client
+        return self._client
+
+    @property
+    def database(self):
+        self.client  # connects (or reconnects after a fork) if needed
+        return self._db
+
+    def stats(self):
+        return {
+            "pid": self._pid,
+            "connected": self._client is not None,
+            "options": client_options(),
+            "pool": self.pool_stats.stats(),
+        }
+
+    def close(self):
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self._db = None
+
+
+connections = MongoConnections()
+
+
+def get_db():
+    """The marketplace Database for this process (GridFS needs the real object)."""
+    return connections.database
+
+
+class LazyDatabase:
+    """Stand-in for the module-level ``db`` that resolves ``get_db()`` on each
+    use, so importing this module never opens a connection."""
+
+    def __getattr__(self, name):
+        return getattr(get_db(), name)
+
+    def __getitem__(self, name):
+        return get_db()[name]
+
+
+db = LazyDatabase()
+
+# --------- Indexes ----------
+# Bump INDEX_VERSION whenever INDEXES changes; `manage.py ensure_indexes`
+# applies the spec and records the version in schema_versions.
+INDEX_VERSION = 3
+
+# (collection, keys, options)
+INDEXES = [
     # Products
-    db.products.create_index([("status", ASCENDING)])
-    db.products.create_index([("created_at", DESCENDING)])
-    db.products.create_index([("download_count", DESCENDING)])
-    db.products.create_index([("rating", DESCENDING)])
-    db.products.create_index([("title", ASCENDING)])
-    db.products.create_index([("tags", ASCENDING)])
+    ("products", [("status", ASCENDING)], {}),
+    ("products", [("created_at", DESCENDING)], {}),
+    ("products", [("download_count", DESCENDING)], {}),
+    ("products", [("rating", DESCENDING)], {}),
+    ("products", [("title", ASCENDING)], {}),
+    ("products", [("tags", ASCENDING)], {}),
+    # Developer profile: one developer's products per status, newest first
+    ("products", [("developer_id", ASCENDING), ("status", ASCENDING), ("created_at", DESCENDING)], {}),
+    # Search index workers pull changed products by updated_at
+    ("products", [("updated_at", ASCENDING)], {}),
+    # Keyset pagination: (status, sort key, _id) for every product_list sort
+    *[
+        ("products", [("status", ASCENDING), (field, DESCENDING), ("_id", DESCENDING)], {})
+        for field in ("created_at", "download_count", "rating", "price")
+    ],
 
     # Categories
-    db.categories.create_index([("category", ASCENDING)], unique=True)
-    
+    ("categories", [("category", ASCENDING)], {"unique": True}),
+    ("category_stats", [("approved_count", DESCENDING)], {}),
 
     # Developers
-    db.developers.create_index([("user_id", ASCENDING)], unique=True)
+    ("developers", [("user_id", ASCENDING)], {"unique": True}),
 
     # Reviews
-    db.reviews.create_index([("product_id", ASCENDING), ("created_at", DESCENDING)])
-    db.reviews.create_index([("user_id", ASCENDING), ("product_id", ASCENDING)], unique=True)
+    ("reviews", [("product_id", ASCENDING), ("created_at", DESCENDING)], {}),
+    ("reviews", [("user_id", ASCENDING), ("product_id", ASCENDING)], {"unique": True}),
 
     # Downloads (prevent multiple download-count bumps)
-    db.downloads.create_index([("user_id", ASCENDING), ("product_id", ASCENDING)], unique=True)
+    ("downloads", [("user_id", ASCENDING), ("product_id", ASCENDING)], {"unique": True}),
 
     # Product files
-    db.product_files.create_index([("product_id", ASCENDING)])
-    db.product_files.create_index([("file_type", ASCENDING)])
-
-try:
-    _client.admin.command("ping")
-    ensure_indexes()
-except ServerSelectionTimeoutError:
-    # If DB is unreachable at import-time, app can still boot; indexes will be created on first successful connection.
-    pass
+    ("product_files", [("product_id", ASCENDING)], {}),
+    ("product_files", [("file_type", ASCENDING)], {}),
+
+    # Content-addressed blobs (_id is "<bucket>:<sha256>")
+    ("blob_index", [("bucket", ASCENDING), ("file_id", ASCENDING)], {}),
+
+    # Resized image renditions, looked up by source file, size and format
+    ("renditions.files", [
+        ("metadata.source_bucket", ASCENDING), ("metadata.source_id", ASCENDING),
+        ("metadata.size", ASCENDING), ("metadata.format", ASCENDING),
+    ], {}),
+
+    # Background jobs: claim() looks for due queued jobs and expired locks;
+    # finished jobs are kept a week for inspection
+    ("jobs", [("status", ASCENDING), ("run_at", ASCENDING)], {}),
+    ("jobs", [("status", ASCENDING), ("locked_until", ASCENDING)], {}),
+    ("jobs", [("finished_at", ASCENDING)], {
+        "expireAfterSeconds": 7 * 24 * 3600, "partialFilterExpression": {"status": "done"},
+    }),
+]
+
+
+def applied_index_version():
+    doc = db.schema_versions.find_one({"_id": "indexes"})
+    return doc["version"] if doc else 0
+
+
+def ensure_indexes():
+    """Create every index in INDEXES (a no-op for existing ones) and record INDEX_VERSION."""
+    for collection, keys, options in INDEXES:
+        db[collection].create_index(keys, **options)
+    db.schema_versions.update_one(
+        {"_id": "indexes"},
+        {"$set": {"version": INDEX_VERSION, "applied_at": datetime.now()}},
+        upsert=True,
+    )
+    return len(INDEXES)
+
+
+def missing_indexes():
+    """``[(collection, keys), ...]`` from INDEXES that the server doesn't have."""
+    existing = {}
+    missing = []
+    for collection, keys, _ in INDEXES:
+        if collection not in existing:
+            existing[collection] = {
+                tuple((k, int(d)) for k, d in info["key"])
+                for info in db[collection].index_information().values()
+            }
+        if tuple(keys) not in existing[collection]:
+            missing.append((collection, keys))
+    return missing
+
+
+def _verify_indexes():
+    try:
+        version = applied_index_version()
+        missing = missing_indexes()
+    except PyMongoError as exc:
+        logger.warning("startup index check skipped: %s", exc)
+        return
+    if version < INDEX_VERSION or missing:
+        logger.warning(
+            "Mongo indexes are out of date (applied version %s, expected %s, %d missing); "
+            "run `python manage.py ensure_indexes`.", version, INDEX_VERSION, len(missing),
+        )
+
+
+def verify_indexes_in_background():
+    """Check (never build) indexes on a daemon thread so the server boots immediately."""
+    if not getattr(settings, "MONGO_VERIFY_INDEXES", True):
+        return None
+    thread = threading.Thread(target=_verify_indexes, name="verify-indexes", daemon=True)
+    thread.start()
+    return thread
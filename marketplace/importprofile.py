@@ -0,0 +1,52 @@
+import os
+import re
+import subprocess
+import sys
+
+from django.conf import settings
+
+IMPORT_TIME_BUDGET_MS = getattr(settings, "IMPORT_TIME_BUDGET_MS", 1500)
+
+# What a worker imports before it can serve: settings, every app, the URLconf
+# (and with it all views, models and their dependencies).
+_PROBE = """
+import os, time
+start = time.perf_counter()
+import django
+django.setup()
+from django.conf import settings
+__import__(settings.ROOT_URLCONF)
+print("WALL_MS", (time.perf_counter() - start) * 1000)
+"""
+_LINE_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+
+def profile_imports(settings_module=None):
+    """Import the project in a fresh interpreter under ``-X importtime``.
+
+    Returns ``{"wall_ms", "modules": [(name, self_ms, cumulative_ms, depth), ...]}``.
+    The startup index check is disabled so the numbers cover imports only.
+    """
+    env = {
+        **os.environ,
+        "DJANGO_SETTINGS_MODULE": settings_module or os.environ.get("DJANGO_SETTINGS_MODULE", "modmarket.settings"),
+        "MONGO_VERIFY_INDEXES": "false",
+        "PYTHONDONTWRITEBYTECODE": "1",
+    }
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _PROBE],
+        cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=False,
+    )
+    wall = None
+    for line in proc.stdout.splitlines():
+        if line.startswith("WALL_MS "):
+            wall = float(line.split()[1])
+    if proc.returncode or wall is None:
+        raise RuntimeError(f"import probe failed:\n{proc.stderr[-2000:]}")
+    modules = []
+    for line in proc.stderr.splitlines():
+        match = _LINE_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append((name, int(self_us) / 1000, int(cumulative_us) / 1000, len(indent) // 2))
+    return {"wall_ms": wall, "modules": modules}
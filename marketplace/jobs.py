@@ -0,0 +1,162 @@
+import logging
+import random
+import traceback
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from django.conf import settings
+from pymongo import ReturnDocument
+
+from .db import db
+
+logger = logging.getLogger(__name__)
+
+JOB_VISIBILITY_TIMEOUT = getattr(settings, "JOB_VISIBILITY_TIMEOUT", 300)
+JOB_MAX_ATTEMPTS = getattr(settings, "JOB_MAX_ATTEMPTS", 5)
+JOB_BACKOFF_BASE = getattr(settings, "JOB_BACKOFF_BASE", 10)
+JOB_BACKOFF_MAX = getattr(settings, "JOB_BACKOFF_MAX", 3600)
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+# kind -> callable(**args); filled by @job_handler in marketplace/tasks.py
+HANDLERS = {}
+
+
+class JobError(Exception):
+    """Raised by a handler for a failure that retrying won't fix."""
+
+
+def job_handler(kind):
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def _job_doc(kind, args, run_at=None, max_attempts=None, now=None):
+    now = now or datetime.now()
+    return {
+        "_id": str(ObjectId()),
+        "kind": kind,
+        "args": args or {},
+        "status": QUEUED,
+        "attempts": 0,
+        "max_attempts": max_attempts or JOB_MAX_ATTEMPTS,
+        "run_at": run_at or now,
+        "locked_until": None,
+        "locked_by": None,
+        "last_error": None,
+        "result": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def enqueue(kind, args=None, run_at=None, max_attempts=None):
+    doc = _job_doc(kind, args, run_at, max_attempts)
+    db.jobs.insert_one(doc)
+    return doc["_id"]
+
+
+def enqueue_many(jobs):
+    """Queue ``[(kind, args), ...]`` with one insert_many."""
+    now = datetime.now()
+    docs = [_job_doc(kind, args, now=now) for kind, args in jobs]
+    if docs:
+        db.jobs.insert_many(docs)
+    return [d["_id"] for d in docs]
+
+
+def claim(worker_id, kinds=None, visibility=JOB_VISIBILITY_TIMEOUT):
+    """Atomically take the next due job, or one whose lock has expired.
+
+    The claimed job stays invisible to other workers for ``visibility``
+    seconds; a worker that dies mid-job simply lets the lock lapse.
+    """
+    now = datetime.now()
+    q = {
+        "$or": [
+            {"status": QUEUED, "run_at": {"$lte": now}},
+            {"status": RUNNING, "locked_until": {"$lt": now}},
+        ],
+        "$expr": {"$lt": ["$attempts", "$max_attempts"]},
+    }
+    if kinds:
+        q["kind"] = {"$in": list(kinds)}
+    return db.jobs.find_one_and_update(
+        q,
+        {
+            "$set": {"status": RUNNING, "locked_by": worker_id,
+                     "locked_until": now + timedelta(seconds=visibility), "updated_at": now},
+            "$inc": {"attempts": 1},
+        },
+        sort=[("run_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def extend(job_ids, worker_id, visibility=JOB_VISIBILITY_TIMEOUT):
+    """Push back the lock on jobs this worker is still running."""
+    if not job_ids:
+        return
+    now = datetime.now()
+    db.jobs.update_many(
+        {"_id": {"$in": list(job_ids)}, "status": RUNNING, "locked_by": worker_id},
+        {"$set": {"locked_until": now + timedelta(seconds=visibility), "updated_at": now}},
+    )
+
+
+def complete(job, worker_id, result=None):
+    now = datetime.now()
+    db.jobs.update_one(
+        {"_id": job["_id"], "locked_by": worker_id},
+        {"$set": {"status": DONE, "result": result, "locked_until": None,
+                  "finished_at": now, "updated_at": now}},
+    )
+
+
+def backoff_delay(attempts):
+    """Exponential backoff with full jitter, capped at JOB_BACKOFF_MAX seconds."""
+    return random.uniform(0, min(JOB_BACKOFF_MAX, JOB_BACKOFF_BASE * 2 ** max(attempts - 1, 0)))
+
+
+def fail(job, worker_id, error, retry=True):
+    """Record a failed attempt: requeue with backoff, or give up after max_attempts."""
+    now = datetime.now()
+    message = error if isinstance(error, str) else "".join(traceback.format_exception_only(type(error), error)).strip()
+    final = not retry or job["attempts"] >= job.get("max_attempts", JOB_MAX_ATTEMPTS)
+    update = {"last_error": message[:2000], "locked_until": None, "updated_at": now}
+    if final:
+        update.update(status=FAILED, finished_at=now)
+    else:
+        update.update(status=QUEUED, run_at=now + timedelta(seconds=backoff_delay(job["attempts"])))
+    db.jobs.update_one({"_id": job["_id"], "locked_by": worker_id}, {"$set": update})
+    return not final
+
+
+def reap():
+    """Fail running jobs whose lock expired on their last allowed attempt."""
+    now = datetime.now()
+    return db.jobs.update_many(
+        {"status": RUNNING, "locked_until": {"$lt": now}, "$expr": {"$gte": ["$attempts", "$max_attempts"]}},
+        {"$set": {"status": FAILED, "last_error": "visibility timeout expired", "finished_at": now, "updated_at": now}},
+    ).modified_count
+
+
+def run(kind, args):
+    """Execute one job in the current process (the worker pool's entry point)."""
+    from . import tasks  # noqa: F401  registers the handlers
+
+    handler = HANDLERS.get(kind)
+    if handler is None:
+        raise JobError(f"no handler for job kind {kind!r}")
+    return handler(**args)
+
+
+def stats():
+    counts = {s: 0 for s in (QUEUED, RUNNING, DONE, FAILED)}
+    for row in db.jobs.aggregate([{"$group": {"_id": "$status", "n": {"$sum": 1}}}]):
+        counts[row["_id"]] = row["n"]
+    oldest = db.jobs.find_one({"status": QUEUED}, {"run_at": 1}, sort=[("run_at", 1)])
+    counts["oldest_queued_at"] = oldest["run_at"].isoformat() if oldest else None
+    return counts
@@ -0,0 +1,305 @@
+import json
+import platform
+import random
+import re
+import statistics
+import subprocess
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from collections import Counter
+from datetime import datetime
+from urllib.parse import urlencode
+
+import django
+import pymongo
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from marketplace import profiling
+from marketplace.db import db
+from marketplace.management.commands.loadtest import percentile
+from marketplace.management.commands.seed_dataset import USERNAME_PREFIX, WORDS
+from marketplace.models import product_delete
+
+SCENARIOS = (
+    "home", "product_list", "product_list_search", "product_list_filter", "product_list_deep",
+    "product_detail", "download_product", "serve_file", "upload",
+)
+_SERVER_TIMING_RE = re.compile(r'mongo;dur=([\d.]+);desc="(\d+) commands"')
+BENCH_TITLE = "[bench] upload"
+
+
+def _rss_mb(pid="self"):
+    try:
+        with open(f"/proc/{pid}/status") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5, cwd=settings.BASE_DIR,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the hot pages (home, product_list with search/filters/deep pages, "
+        "product_detail, downloads, uploads) against the current database, in-process "
+        "through the Django test client or against a running server with --base-url. "
+        "Reports p50/p95/p99 latency, Mongo commands per request and memory as JSON; "
+        "--compare reports the change from an earlier run. Seed data first with "
+        "`manage.py seed_dataset`."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                            help="Run only this scenario (repeatable; default: all).")
+        parser.add_argument("--requests", type=int, default=100, help="Measured requests per scenario.")
+        parser.add_argument("--warmup", type=int, default=5, help="Unmeasured requests per scenario first.")
+        parser.add_argument("--deep-page", type=int, default=50, help="Page number for product_list_deep.")
+        parser.add_argument("--seed", type=int, default=1, help="Seed for picking products and queries.")
+        parser.add_argument("--base-url", help="Benchmark a running server (start it with "
+                                               "MONGO_PROFILE_SERVER_TIMING=true to count commands).")
+        parser.add_argument("--server-pid", type=int, help="With --base-url, sample this process's RSS.")
+        parser.add_argument("--tracemalloc", action="store_true",
+                            help="In-process: record peak Python allocations per scenario (slower).")
+        parser.add_argument("--label", default="", help="Name for this run in the report.")
+        parser.add_argument("--output", help="Write the JSON report to this file.")
+        parser.add_argument("--compare", help="Earlier report to compare against.")
+        parser.add_argument("--max-regression", type=float,
+                            help="With --compare, fail if any p95 grows by more than this percent "
+                                 "or any scenario issues more Mongo commands per request.")
+
+    # ---- fixtures ----
+    def _fixtures(self, seed):
+        rng = random.Random(seed)
+        products = [p["_id"] for p in db.products.find({"status": "approved"}, {"_id": 1}).sort("_id", 1).limit(5000)]
+        if not products:
+            raise CommandError("No approved products; run `manage.py seed_dataset` first.")
+        main_files = {f["product_id"]: f["path"] for f in db.product_files.find(
+            {"product_id": {"$in": products}, "file_type": "main"}, {"product_id": 1, "path": 1})}
+        categories = [c["_id"] for c in db.category_stats.find({"approved_count": {"$gt": 0}}, {"_id": 1})]
+        user = (User.objects.filter(username__startswith=f"{USERNAME_PREFIX}dev-").order_by("username").first()
+                or User.objects.filter(is_superuser=False).order_by("id").first())
+        if user is None:
+            raise CommandError("No user to log in as; run `manage.py seed_dataset` first.")
+        return rng, products, main_files, categories, user
+
+    def _paths(self, scenario, rng, products, main_files, categories):
+        """An endless supply of (method, path, data) for ``scenario``."""
+        list_url = reverse("product_list")
+        while True:
+            pk = rng.choice(products)
+            if scenario == "home":
+                yield "GET", reverse("home"), None
+            elif scenario == "product_list":
+                yield "GET", list_url, None
+            elif scenario == "product_list_search":
+                yield "GET", f"{list_url}?{urlencode({'q': ' '.join(rng.sample(WORDS, rng.randint(1, 2)))})}", None
+            elif scenario == "product_list_filter":
+                params = {"sort": rng.choice(["-download_count", "-rating", "price", "-created_at"]),
+                          "price": rng.choice(["", "free", "paid"])}
+                if categories:
+                    params["category"] = rng.choice(categories)
+                yield "GET", f"{list_url}?{urlencode({k: v for k, v in params.items() if v})}", None
+            elif scenario == "product_list_deep":
+                yield "GET", f"{list_url}?page={self.deep_page}", None
+            elif scenario == "product_detail":
+                yield "GET", reverse("product_detail", args=[pk]), None
+            elif scenario == "download_product":
+                yield "GET", reverse("download_product", args=[pk]), None
+            elif scenario == "serve_file":
+                file_id = main_files.get(pk) or next(iter(main_files.values()), None)
+                if file_id is None:
+                    return
+                yield "GET", reverse("serve_file", args=[file_id]), None
+            elif scenario == "upload":
+                yield "POST", reverse("upload_product"), self._upload_form(rng)
+
+    def _upload_form(self, rng):
+        payload = rng.randbytes(64 * 1024)
+        return {
+            "title": BENCH_TITLE, "description": " ".join(rng.choices(WORDS, k=60)),
+            "category": rng.choice(WORDS), "license": "MIT", "product_type": "project",
+            "version": "1.0.0", "price": "0", "is_free": "on", "tags": "bench",
+            "license_file": SimpleUploadedFile("LICENSE.txt", b"MIT License\n" * 50, content_type="text/plain"),
+            "files-TOTAL_FORMS": "1", "files-INITIAL_FORMS": "0",
+            "files-MIN_NUM_FORMS": "0", "files-MAX_NUM_FORMS": "1000",
+            "files-0-file_type": "main",
+            "files-0-file": SimpleUploadedFile("bench.zip", b"PK\x03\x04" + payload, content_type="application/zip"),
+        }
+
+    # ---- transports ----
+    def _client_request(self, method, path, data):
+        response = self.client.post(path, data) if method == "POST" else self.client.get(path)
+        size = sum(len(c) for c in response.streaming_content) if response.streaming else len(response.content)
+        return response.status_code, size, response.headers.get("Server-Timing", "")
+
+    def _http_request(self, method, path, data):
+        if method != "GET":
+            raise CommandError("Only GET scenarios can run against --base-url.")
+        request = urllib.request.Request(self.base_url + path, headers={"Cookie": self.cookie})
+        try:
+            with urllib.request.urlopen(request, timeout=120) as response:
+                size = 0
+                while chunk := response.read(256 * 1024):
+                    size += len(chunk)
+                return response.status, size, response.headers.get("Server-Timing", "")
+        except urllib.error.HTTPError as exc:
+            return exc.code, 0, exc.headers.get("Server-Timing", "")
+
+    # ---- running ----
+    def _run(self, scenario, paths, requests, warmup, use_tracemalloc):
+        send = self._http_request if self.base_url else self._client_request
+        latencies, commands, mongo_ms, statuses, transferred = [], [], [], Counter(), 0
+        rss_pid = self.server_pid if self.base_url else "self"
+        for _ in range(warmup):
+            item = next(paths, None)
+            if item is None:
+                break
+            send(*item)
+        rss_before = _rss_mb(rss_pid)
+        if use_tracemalloc:
+            tracemalloc.start()
+        for _ in range(requests):
+            item = next(paths, None)
+            if item is None:
+                break
+            started = time.perf_counter()
+            status, size, timing = send(*item)
+            latencies.append((time.perf_counter() - started) * 1000)
+            statuses[status] += 1
+            transferred += size
+            match = _SERVER_TIMING_RE.search(timing or "")
+            if match:
+                mongo_ms.append(float(match.group(1)))
+                commands.append(int(match.group(2)))
+        peak_alloc = None
+        if use_tracemalloc:
+            peak_alloc = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+            tracemalloc.stop()
+        rss_after = _rss_mb(rss_pid)
+
+        def ms(value):
+            return round(value, 2) if value is not None else None
+
+        return {
+            "requests": len(latencies),
+            "status": {str(k): v for k, v in sorted(statuses.items())},
+            "p50_ms": ms(percentile(latencies, 50)),
+            "p95_ms": ms(percentile(latencies, 95)),
+            "p99_ms": ms(percentile(latencies, 99)),
+            "mean_ms": ms(statistics.fmean(latencies)) if latencies else None,
+            "max_ms": ms(max(latencies)) if latencies else None,
+            "mongo_commands_per_request": round(statistics.fmean(commands), 2) if commands else None,
+            "mongo_commands_max": max(commands) if commands else None,
+            "mongo_ms_per_request": ms(statistics.fmean(mongo_ms)) if mongo_ms else None,
+            "bytes_per_request": round(transferred / len(latencies)) if latencies else 0,
+            "rss_before_mb": rss_before,
+            "rss_after_mb": rss_after,
+            "peak_alloc_mb": peak_alloc,
+        }
+
+    def _cleanup_uploads(self, developer_user_id):
+        dev = db.developers.find_one({"user_id": developer_user_id}, {"_id": 1})
+        if not dev:
+            return 0
+        ids = [p["_id"] for p in db.products.find({"developer_id": dev["_id"], "title": BENCH_TITLE}, {"_id": 1})]
+        file_ids = [f["_id"] for coll in (db.product_files, db.licenses)
+                    for f in coll.find({"product_id": {"$in": ids}}, {"_id": 1})]
+        db.jobs.delete_many({"args.id": {"$in": file_ids}})
+        for pk in ids:
+            product_delete(pk)
+        return len(ids)
+
+    def _dataset(self):
+        return {name: db[name].estimated_document_count()
+                for name in ("products", "product_files", "reviews", "downloads", "developers", "users")}
+
+    def handle(self, *args, **options):
+        self.base_url = (options["base_url"] or "").rstrip("/")
+        self.server_pid = options["server_pid"]
+        self.deep_page = max(options["deep_page"], 1)
+        scenarios = options["scenario"] or [s for s in SCENARIOS if not (self.base_url and s == "upload")]
+        rng, products, main_files, categories, user = self._fixtures(options["seed"])
+
+        self.client = Client()
+        self.client.force_login(user)
+        self.cookie = f"{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}"
+        # In-process, every response carries the command count in Server-Timing.
+        profiling.MONGO_PROFILE_SERVER_TIMING = True
+
+        report = {
+            "label": options["label"],
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "git_revision": _git_revision(),
+            "mode": "http" if self.base_url else "test_client",
+            "base_url": self.base_url or None,
+            "async_views": getattr(settings, "ASYNC_VIEWS", False),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "pymongo": pymongo.version,
+            "dataset": self._dataset(),
+            "options": {k: options[k] for k in ("requests", "warmup", "deep_page", "seed")},
+            "scenarios": {},
+        }
+        allowed_hosts = [*settings.ALLOWED_HOSTS, "testserver"]
+        try:
+            with override_settings(ALLOWED_HOSTS=allowed_hosts, SECURE_SSL_REDIRECT=False):
+                for scenario in scenarios:
+                    self.stderr.write(f"{scenario}...")
+                    paths = self._paths(scenario, rng, products, main_files, categories)
+                    report["scenarios"][scenario] = self._run(
+                        scenario, paths, options["requests"], options["warmup"], options["tracemalloc"]
+                    )
+        finally:
+            if "upload" in scenarios and not self.base_url:
+                report["uploads_removed"] = self._cleanup_uploads(user.id)
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as fh:
+                fh.write(output + "\n")
+        self.stdout.write(output)
+
+        if options["compare"]:
+            self._compare(options["compare"], report, options["max_regression"])
+
+    def _compare(self, path, report, max_regression):
+        with open(path) as fh:
+            baseline = json.load(fh)
+        failures = []
+        self.stdout.write(f"\nvs {baseline.get('label') or path} ({baseline.get('git_revision')}):")
+        self.stdout.write(f"  {'scenario':<22}{'p50 ms':>16}{'p95 ms':>16}{'p99 ms':>16}{'cmds/req':>14}")
+        for name, now in report["scenarios"].items():
+            before = baseline.get("scenarios", {}).get(name)
+            if not before:
+                continue
+            cells = []
+            for key in ("p50_ms", "p95_ms", "p99_ms"):
+                old, new = before.get(key), now.get(key)
+                pct = (new - old) / old * 100 if old and new is not None else None
+                cells.append(f"{new}" + (f" ({pct:+.0f}%)" if pct is not None else ""))
+                if key == "p95_ms" and max_regression is not None and pct is not None and pct > max_regression:
+                    failures.append(f"{name} p95 {old} -> {new} ms ({pct:+.0f}%)")
+            old_cmds, new_cmds = before.get("mongo_commands_per_request"), now.get("mongo_commands_per_request")
+            cells.append(f"{old_cmds} -> {new_cmds}")
+            if max_regression is not None and old_cmds is not None and new_cmds is not None and new_cmds > old_cmds:
+                failures.append(f"{name} Mongo commands per request {old_cmds} -> {new_cmds}")
+            self.stdout.write(f"  {name:<22}{cells[0]:>16}{cells[1]:>16}{cells[2]:>16}{cells[3]:>14}")
+        if failures:
+            raise CommandError("Regressions:\n  " + "\n  ".join(failures))
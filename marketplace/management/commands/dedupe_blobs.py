@@ -0,0 +1,88 @@
+import hashlib
+from collections import defaultdict
+from datetime import datetime
+
+import gridfs
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+
+from marketplace.bundles import BUNDLE_NAMESPACE
+from marketplace.cache import doc_cache
+from marketplace.db import db, get_db
+from marketplace.models import BLOB_REFERENCES, blob_reclaim
+
+
+class Command(BaseCommand):
+    help = (
+        "Deduplicate existing GridFS buckets by SHA-256: repoint references to one "
+        "canonical file per content hash, delete the copies and files nothing references, "
+        "and rebuild blob_index."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bucket", action="append", choices=sorted(BLOB_REFERENCES),
+                            help="Bucket to process (repeatable). Defaults to all.")
+        parser.add_argument("--dry-run", action="store_true", help="Report what would be reclaimed without changing anything.")
+
+    def _sha256(self, fs, file_doc):
+        if file_doc.get("sha256"):
+            return file_doc["sha256"]
+        digest = hashlib.sha256()
+        grid_out = fs.get(file_doc["_id"])
+        for chunk in grid_out:
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def handle(self, *args, **options):
+        dry_run = options["dry_run"]
+        total_reclaimed = 0
+        for bucket in options["bucket"] or sorted(BLOB_REFERENCES):
+            fs = gridfs.GridFS(get_db(), collection=bucket)
+            files = db[f"{bucket}.files"]
+            groups = defaultdict(list)
+            for file_doc in files.find({}, {"length": 1, "sha256": 1, "uploadDate": 1}).sort("uploadDate", 1):
+                sha = self._sha256(fs, file_doc)
+                if not dry_run and not file_doc.get("sha256"):
+                    files.update_one({"_id": file_doc["_id"]}, {"$set": {"sha256": sha}})
+                groups[sha].append(file_doc)
+
+            reclaimed = copies = unreferenced = 0
+            for sha, docs in groups.items():
+                canonical, duplicates = docs[0], docs[1:]
+                canonical_id = str(canonical["_id"])
+                refcount = 0
+                for collection, field, extra in BLOB_REFERENCES[bucket]:
+                    for dup in duplicates:
+                        if not dry_run:
+                            db[collection].update_many({**extra, field: str(dup["_id"])}, {"$set": {field: canonical_id}})
+                    refcount += db[collection].count_documents({**extra, field: {"$in": [str(d["_id"]) for d in docs]}})
+                for dup in duplicates:
+                    reclaimed += dup.get("length", 0)
+                    copies += 1
+                    if not dry_run:
+                        fs.delete(dup["_id"])
+                if refcount == 0:
+                    reclaimed += canonical.get("length", 0)
+                    unreferenced += 1
+                if not dry_run:
+                    key = f"{bucket}:{sha}"
+                    db.blob_index.update_one(
+                        {"_id": key},
+                        {"$set": {"bucket": bucket, "sha256": sha, "file_id": canonical_id,
+                                  "size": canonical.get("length", 0), "refcount": refcount},
+                         "$setOnInsert": {"created_at": datetime.now()}},
+                        upsert=True,
+                    )
+                    if refcount == 0:
+                        blob_reclaim(key, bucket, canonical_id)
+            total_reclaimed += reclaimed
+            self.stdout.write(
+                f"{bucket}: {len(groups)} unique files, {copies} duplicates, {unreferenced} unreferenced, "
+                f"{filesizeformat(reclaimed)} {'reclaimable' if dry_run else 'reclaimed'}"
+            )
+        if not dry_run:
+            # cached products and bundle manifests may still name the deleted duplicates
+            doc_cache.clear("product")
+            doc_cache.clear(BUNDLE_NAMESPACE)
+        verb = "Would reclaim" if dry_run else "Reclaimed"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {filesizeformat(total_reclaimed)} ({total_reclaimed} bytes) in total."))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.db import db
+from marketplace.jobs import enqueue_many
+from marketplace.tasks import SCAN_COLLECTIONS
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = (
+        "Queue scan_file jobs (checksum, archive manifest, renditions) for stored "
+        "uploads; `manage.py run_jobs` then works through them in parallel."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true",
+                            help="Rescan every file, not just those still pending.")
+
+    def handle(self, *args, **options):
+        q = {} if options["all"] else {"scan_status": {"$in": ["pending", None]}}
+        queued = 0
+        for collection in sorted(SCAN_COLLECTIONS):
+            batch = []
+            for doc in db[collection].find(q, {"_id": 1}):
+                batch.append(("scan_file", {"collection": collection, "id": doc["_id"]}))
+                if len(batch) >= BATCH_SIZE:
+                    queued += len(enqueue_many(batch))
+                    batch = []
+            queued += len(enqueue_many(batch))
+        self.stdout.write(self.style.SUCCESS(f"Queued {queued} scans."))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import PyMongoError
+
+from marketplace.db import INDEX_VERSION, INDEXES, applied_index_version, ensure_indexes, missing_indexes
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the MongoDB indexes the app relies on and record the index version. "
+        "Run on deploy (and after pulling a change that bumps INDEX_VERSION)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true",
+                            help="Only report missing indexes; exit non-zero if any are missing or the version is behind.")
+        parser.add_argument("--force", action="store_true",
+                            help="Apply the index spec even if the recorded version is current.")
+
+    def handle(self, *args, **options):
+        try:
+            version = applied_index_version()
+            missing = missing_indexes()
+        except PyMongoError as exc:
+            raise CommandError(f"MongoDB unavailable: {exc}")
+
+        for collection, keys in missing:
+            self.stdout.write(f"missing: {collection} {keys}")
+        current = version >= INDEX_VERSION and not missing
+        if options["check"]:
+            if not current:
+                raise CommandError(f"Indexes out of date: version {version}/{INDEX_VERSION}, {len(missing)} missing.")
+            self.stdout.write(self.style.SUCCESS(f"Indexes up to date (version {version})."))
+            return
+        if current and not options["force"]:
+            self.stdout.write(self.style.SUCCESS(f"Indexes up to date (version {version}), nothing to do."))
+            return
+        try:
+            ensure_indexes()
+        except PyMongoError as exc:
+            raise CommandError(f"Index build failed: {exc}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Applied {len(INDEXES)} index definitions; version {version} -> {INDEX_VERSION}."
+        ))
@@ -0,0 +1,70 @@
+import json
+import time
+
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from django.core.management.base import BaseCommand
+
+from marketplace.db import db
+from marketplace.models import PRODUCT_CARD_FIELDS
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the BSON bytes each product listing query transfers with full documents "
+        "versus the card projection (PRODUCT_CARD_FIELDS), and the time to fetch and decode them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=5, help="Runs per query; the fastest is reported.")
+        parser.add_argument("--output", help="Also write the JSON report to this file.")
+
+    def _listings(self):
+        approved = {"status": "approved"}
+        sample = db.products.find_one(approved, {"category_id": 1, "developer_id": 1}) or {}
+        busiest = next(db.products.aggregate([
+            {"$group": {"_id": "$developer_id", "n": {"$sum": 1}}}, {"$sort": {"n": -1}}, {"$limit": 1},
+        ]), {})
+        return {
+            "home_featured": (approved, [("download_count", -1)], 8),
+            "home_recent": (approved, [("created_at", -1)], 6),
+            "product_list": (approved, [("created_at", -1), ("_id", -1)], 13),
+            "products_related": ({**approved, "category_id": sample.get("category_id"), "_id": {"$ne": sample.get("_id")}}, [], 4),
+            "developer_dashboard": ({"developer_id": busiest.get("_id")}, [("created_at", -1)], 0),
+            "admin_product_list": ({}, [("created_at", -1)], 0),
+        }
+
+    @staticmethod
+    def _find(collection, q, sort, limit, projection):
+        cur = collection.find(q, projection)
+        if sort:
+            cur = cur.sort(sort)
+        return list(cur.limit(limit))
+
+    def _measure(self, q, sort, limit, projection, repeat):
+        # Byte counts come from undecoded documents; timings include decoding.
+        raw = db.products.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+        size = sum(len(d.raw) for d in self._find(raw, q, sort, limit, projection))
+        best_ms, count = None, 0
+        for _ in range(max(repeat, 1)):
+            started = time.perf_counter()
+            count = len(self._find(db.products, q, sort, limit, projection))
+            elapsed = (time.perf_counter() - started) * 1000
+            best_ms = elapsed if best_ms is None else min(best_ms, elapsed)
+        return {"docs": count, "bytes": size, "ms": round(best_ms, 3)}
+
+    def handle(self, *args, **options):
+        report = {}
+        for name, (q, sort, limit) in self._listings().items():
+            full = self._measure(q, sort, limit, None, options["repeat"])
+            card = self._measure(q, sort, limit, PRODUCT_CARD_FIELDS, options["repeat"])
+            report[name] = {
+                "full": full,
+                "card": card,
+                "bytes_saved_pct": round(100 * (1 - card["bytes"] / full["bytes"]), 1) if full["bytes"] else 0.0,
+            }
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as fh:
+                fh.write(output + "\n")
+        self.stdout.write(output)
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import math
+import platform
+import time
+from collections import Counter
+from datetime import datetime
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive a running deployment with concurrent HTTP requests and report throughput "
+        "and latency percentiles as JSON. Run it once against the sync (WSGI) and once "
+        "against the async (ASGI, ASYNC_VIEWS=true) deployment to compare them; "
+        "--slow-clients keeps that many throttled downloads open for the whole run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", action="append", required=True,
+                            help="URL to request (repeatable; requests round-robin over them).")
+        parser.add_argument("--requests", type=int, default=500, help="Measured requests in total.")
+        parser.add_argument("--concurrency", type=int, default=50, help="Measured requests in flight at once.")
+        parser.add_argument("--slow-clients", type=int, default=0,
+                            help="Extra connections that repeatedly download --slow-url at --slow-rate.")
+        parser.add_argument("--slow-url", help="URL for the slow clients (defaults to the first --url).")
+        parser.add_argument("--slow-rate", type=int, default=64, help="Slow client read rate in KiB/s.")
+        parser.add_argument("--cookie", default="", help="Cookie header to send, e.g. 'sessionid=...'.")
+        parser.add_argument("--timeout", type=float, default=60.0, help="Per-read timeout in seconds.")
+        parser.add_argument("--label", default="", help="Name for this run in the report, e.g. 'sync' or 'async'.")
+        parser.add_argument("--output", help="Also write the JSON report to this file.")
+
+    async def _fetch(self, url, rate=None):
+        parts = urlsplit(url)
+        use_ssl = parts.scheme == "https"
+        port = parts.port or (443 if use_ssl else 80)
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        head = [f"GET {target} HTTP/1.1", f"Host: {parts.netloc}", "Connection: close",
+                "User-Agent: modmarket-loadtest"]
+        if self.cookie:
+            head.append(f"Cookie: {self.cookie}")
+
+        start = time.perf_counter()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(parts.hostname, port, ssl=use_ssl or None), self.timeout
+        )
+        try:
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode())
+            await writer.drain()
+            status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+            ttfb = time.perf_counter() - start
+            status = int(status_line.split()[1])
+            received = len(status_line)
+            # a slow client reads a tenth of a second's worth at a time
+            chunk = max(rate // 10, 1024) if rate else 256 * 1024
+            while True:
+                data = await asyncio.wait_for(reader.read(chunk), self.timeout)
+                if not data:
+                    break
+                received += len(data)
+                if rate:
+                    await asyncio.sleep(len(data) / rate)
+            return status, ttfb, time.perf_counter() - start, received
+        finally:
+            writer.close()
+
+    async def _measured(self, urls, total, concurrency):
+        results, errors = [], Counter()
+        next_index = iter(range(total))
+
+        async def worker():
+            for i in next_index:
+                try:
+                    results.append(await self._fetch(urls[i % len(urls)]))
+                except (OSError, asyncio.TimeoutError, ValueError, IndexError) as exc:
+                    errors[type(exc).__name__] += 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return results, errors
+
+    async def _slow(self, url, rate, stop, done):
+        while not stop.is_set():
+            try:
+                await self._fetch(url, rate=rate)
+                done["completed"] += 1
+            except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+                done["errors"] += 1
+                await asyncio.sleep(0.5)
+
+    async def _run(self, options):
+        urls = options["url"]
+        stop = asyncio.Event()
+        slow_done = Counter()
+        slow_tasks = [
+            asyncio.create_task(self._slow(options["slow_url"] or urls[0], options["slow_rate"] * 1024, stop, slow_done))
+            for _ in range(options["slow_clients"])
+        ]
+        if slow_tasks:
+            await asyncio.sleep(1)  # let the slow downloads occupy the server first
+        started = time.perf_counter()
+        results, errors = await self._measured(urls, options["requests"], options["concurrency"])
+        elapsed = time.perf_counter() - started
+        stop.set()
+        for task in slow_tasks:
+            task.cancel()
+        await asyncio.gather(*slow_tasks, return_exceptions=True)
+        return results, errors, elapsed, slow_done
+
+    def handle(self, *args, **options):
+        if options["requests"] < 1 or options["concurrency"] < 1:
+            raise CommandError("--requests and --concurrency must be positive.")
+        self.cookie = options["cookie"]
+        self.timeout = options["timeout"]
+        results, errors, elapsed, slow_done = asyncio.run(self._run(options))
+
+        latencies = [r[2] * 1000 for r in results]
+        ttfbs = [r[1] * 1000 for r in results]
+        statuses = Counter(str(r[0]) for r in results)
+        report = {
+            "label": options["label"],
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "urls": options["url"],
+            "requests": options["requests"],
+            "concurrency": options["concurrency"],
+            "slow_clients": options["slow_clients"],
+            "slow_rate_kib": options["slow_rate"],
+            "completed": len(results),
+            "errors": dict(errors),
+            "status_codes": dict(statuses),
+            "elapsed_s": round(elapsed, 3),
+            "requests_per_s": round(len(results) / elapsed, 2) if elapsed else None,
+            "bytes_received": sum(r[3] for r in results),
+            "latency_ms": {
+                f"p{p}": round(percentile(latencies, p), 2) if latencies else None for p in (50, 95, 99)
+            },
+            "latency_max_ms": round(max(latencies), 2) if latencies else None,
+            "ttfb_ms": {
+                f"p{p}": round(percentile(ttfbs, p), 2) if ttfbs else None for p in (50, 95, 99)
+            },
+            "slow_downloads": dict(slow_done),
+        }
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as fh:
+                fh.write(output + "\n")
+        self.stdout.write(output)
@@ -0,0 +1,45 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from marketplace.importprofile import IMPORT_TIME_BUDGET_MS, profile_imports
+
+PROJECT_PACKAGES = ("marketplace", "modmarket")
+
+
+class Command(BaseCommand):
+    help = (
+        "Profile what a worker imports at boot (python -X importtime) and list the slowest "
+        "modules. With --budget-ms, fail when the total exceeds the budget."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--top", type=int, default=20, help="How many modules to list.")
+        parser.add_argument("--budget-ms", type=float, nargs="?", const=IMPORT_TIME_BUDGET_MS,
+                            help=f"Fail if the import wall time exceeds this (default {IMPORT_TIME_BUDGET_MS} ms).")
+        parser.add_argument("--json", action="store_true", help="Print the full profile as JSON.")
+
+    def handle(self, *args, **options):
+        try:
+            profile = profile_imports()
+        except RuntimeError as exc:
+            raise CommandError(str(exc))
+        modules = profile["modules"]
+        if options["json"]:
+            self.stdout.write(json.dumps(profile, indent=2))
+        else:
+            self.stdout.write(f"Import wall time: {profile['wall_ms']:.1f} ms ({len(modules)} modules)\n")
+            self.stdout.write("Slowest top-level imports (cumulative ms):")
+            for name, _, cumulative, _ in sorted((m for m in modules if m[3] == 0), key=lambda m: -m[2])[:options["top"]]:
+                self.stdout.write(f"  {cumulative:9.1f}  {name}")
+            self.stdout.write("Project modules (self ms / cumulative ms):")
+            for name, own, cumulative, _ in sorted(
+                (m for m in modules if m[0].split(".")[0] in PROJECT_PACKAGES), key=lambda m: -m[2]
+            )[:options["top"]]:
+                self.stdout.write(f"  {own:9.1f} / {cumulative:9.1f}  {name}")
+
+        budget = options["budget_ms"]
+        if budget is not None:
+            if profile["wall_ms"] > budget:
+                raise CommandError(f"Import time {profile['wall_ms']:.1f} ms exceeds the {budget:.0f} ms budget.")
+            self.stdout.write(self.style.SUCCESS(f"Within the {budget:.0f} ms import budget."))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.models import category_stats_rebuild, ratings_rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuild denormalized aggregates (category facet counts, product ratings) from source collections."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--categories", action="store_true", help="Only rebuild category_stats.")
+        parser.add_argument("--ratings", action="store_true", help="Only rebuild product rating aggregates.")
+        parser.add_argument("--missing", action="store_true",
+                            help="Only rebuild ratings, and only for products that have no rating aggregates yet "
+                                 "(cheap enough for every deploy).")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Products per bulk_write when rebuilding ratings.")
+
+    def handle(self, *args, **options):
+        options["ratings"] = options["ratings"] or options["missing"]
+        everything = not (options["categories"] or options["ratings"])
+        if everything or options["categories"]:
+            count = category_stats_rebuild()
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt category_stats: {count} categories."))
+        if everything or options["ratings"]:
+            written = ratings_rebuild(batch_size=options["batch_size"], missing_only=options["missing"])
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt rating aggregates: {written} products updated."))
@@ -0,0 +1,126 @@
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from marketplace import jobs
+
+
+def _init_worker():
+    # Ctrl-C goes to the whole process group; let the parent decide when to stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import django
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = (
+        "Run queued background jobs (upload scans, renditions) in a pool of worker "
+        "processes. Jobs are claimed atomically, so any number of these commands can "
+        "share one queue; a job whose worker dies is retried once its lock expires."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int,
+                            default=getattr(settings, "JOB_WORKER_PROCESSES", 0) or os.cpu_count() or 1,
+                            help="Worker processes (default: JOB_WORKER_PROCESSES or the CPU count).")
+        parser.add_argument("--kind", action="append", dest="kinds",
+                            help="Only run jobs of this kind (repeatable).")
+        parser.add_argument("--visibility-timeout", type=int, default=jobs.JOB_VISIBILITY_TIMEOUT,
+                            help="Seconds a claimed job stays locked without a heartbeat.")
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="Seconds to sleep when the queue is empty.")
+        parser.add_argument("--once", action="store_true", help="Exit when the queue is drained.")
+        parser.add_argument("--max-jobs", type=int, default=0, help="Exit after this many jobs (0: no limit).")
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+
+    def _stop(self, signum, frame):
+        self.stdout.write("Stopping after the jobs in flight finish...")
+        self.stopping = True
+
+    def _finish(self, future, job):
+        try:
+            result = future.result()
+        except BrokenProcessPool as exc:
+            jobs.fail(job, self.worker_id, f"worker process died: {exc}")
+            raise
+        except jobs.JobError as exc:
+            jobs.fail(job, self.worker_id, exc, retry=False)
+            self.stderr.write(f"{job['kind']} {job['_id']} failed: {exc}")
+        except Exception as exc:
+            retrying = jobs.fail(job, self.worker_id, exc)
+            self.stderr.write(f"{job['kind']} {job['_id']} attempt {job['attempts']} failed: {exc!r}"
+                              + (" (will retry)" if retrying else ""))
+        else:
+            jobs.complete(job, self.worker_id, result)
+        self.processed += 1
+
+    def handle(self, *args, **options):
+        self.processes = max(options["processes"], 1)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.stopping = False
+        self.processed = 0
+        visibility = options["visibility_timeout"]
+        heartbeat = max(visibility / 3, 1)
+        max_jobs = options["max_jobs"]
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        self.stdout.write(f"Worker {self.worker_id}: {self.processes} processes")
+        pool = self._new_pool()
+        in_flight = {}
+        last_beat = time.monotonic()
+        try:
+            while in_flight or not self.stopping:
+                # Top up free slots; stop claiming once asked to stop or at --max-jobs.
+                idle = False
+                while not self.stopping and len(in_flight) < self.processes:
+                    if max_jobs and self.processed + len(in_flight) >= max_jobs:
+                        break
+                    job = jobs.claim(self.worker_id, options["kinds"], visibility)
+                    if job is None:
+                        idle = True
+                        break
+                    in_flight[pool.submit(jobs.run, job["kind"], job["args"])] = job
+
+                if not in_flight:
+                    if (options["once"] and idle) or (max_jobs and self.processed >= max_jobs):
+                        break
+                    jobs.reap()
+                    time.sleep(options["poll_interval"])
+                    continue
+
+                # With free slots, come back soon to look for new work.
+                timeout = heartbeat if len(in_flight) >= self.processes else min(heartbeat, options["poll_interval"])
+                done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+                try:
+                    for future in done:
+                        self._finish(future, in_flight.pop(future))
+                except BrokenProcessPool as exc:
+                    # A worker died (OOM, segfault in an image codec...): every job
+                    # in the pool is lost with it, so record them and start over.
+                    for job in in_flight.values():
+                        jobs.fail(job, self.worker_id, f"worker process died: {exc}")
+                    in_flight.clear()
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = self._new_pool()
+
+                if time.monotonic() - last_beat >= heartbeat:
+                    jobs.extend([j["_id"] for j in in_flight.values()], self.worker_id, visibility)
+                    last_beat = time.monotonic()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+        self.stdout.write(self.style.SUCCESS(f"Processed {self.processed} jobs."))
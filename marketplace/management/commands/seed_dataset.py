@@ -0,0 +1,266 @@
+import hashlib
+import io
+import math
+import random
+from collections import Counter
+import zipfile
+from datetime import datetime, timedelta
+
+import gridfs
+from bson import ObjectId
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from pymongo import UpdateOne
+
+from marketplace.db import db, ensure_indexes, get_db
+from marketplace.models import RATING_STARS, blob_register, category_stats_rebuild
+
+# Everything this command writes carries this marker (and Django users this
+# username prefix), so --flush removes exactly the synthetic data.
+SEED_FIELD = "seeded"
+USERNAME_PREFIX = "seed-"
+SEED_COLLECTIONS = ("products", "product_files", "licenses", "reviews", "downloads", "developers", "users", "categories")
+SEED_BUCKETS = ("products", "license", "thumbnails")
+
+WORDS = (
+    "pixel dungeon rogue craft sky shader texture pack mod menu launcher voxel racing city builder tower "
+    "defense farm story quest zombie survival physics ragdoll chat bot inventory map editor speedrun timer "
+    "overlay retro neon forest ocean space station galaxy mech arena puzzle rhythm card deck horror"
+).split()
+CATEGORIES = (
+    "Games", "Tools", "Themes", "Shaders", "Texture Packs", "Launchers", "Utilities", "Maps",
+    "Multiplayer", "Audio", "UI", "Templates",
+)
+PRODUCT_TYPES = ("project", "apk", "template", "plugin")
+LICENSES = ("MIT", "GPL-3.0", "Apache-2.0", "Proprietary", "CC-BY-4.0")
+INSERT_BATCH = 1000
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed MongoDB (and Django auth users) with a reproducible synthetic marketplace "
+        "for benchmarks: developers, products with GridFS files, reviews and downloads. "
+        "The same --seed always produces the same data (ids aside)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--developers", type=int, default=50)
+        parser.add_argument("--buyers", type=int, default=500, help="Users who review and download.")
+        parser.add_argument("--products", type=int, default=1000)
+        parser.add_argument("--reviews", type=int, default=8, help="Mean reviews per approved product.")
+        parser.add_argument("--downloads", type=int, default=40, help="Mean downloads per approved product.")
+        parser.add_argument("--files", type=int, default=3, help="Mean files per product (main file always).")
+        parser.add_argument("--blob-kb", type=int, default=512,
+                            help="Median main-file size in KiB; sizes are log-normal around it.")
+        parser.add_argument("--max-blob-mb", type=int, default=64, help="Largest generated file.")
+        parser.add_argument("--distinct-blobs", type=int, default=200,
+                            help="Distinct GridFS files to generate; products share them like real re-uploads.")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--flush", action="store_true", help="Remove previously seeded data first.")
+        parser.add_argument("--flush-only", action="store_true", help="Remove seeded data and exit.")
+
+    # ---- flushing ----
+    def flush(self):
+        for bucket in SEED_BUCKETS:
+            fs = gridfs.GridFS(get_db(), collection=bucket)
+            for f in db[f"{bucket}.files"].find({f"metadata.{SEED_FIELD}": True}, {"_id": 1}):
+                fs.delete(f["_id"])
+            db.blob_index.delete_many({"bucket": bucket, SEED_FIELD: True})
+        removed = {c: db[c].delete_many({SEED_FIELD: True}).deleted_count for c in SEED_COLLECTIONS}
+        removed["auth_users"], _ = User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+        category_stats_rebuild()
+        self.stdout.write(f"Flushed seeded data: {removed}")
+
+    # ---- generators ----
+    def _lognormal_size(self, median):
+        size = int(self.rng.lognormvariate(math.log(median), 1.0))
+        return max(1024, min(size, self.max_blob))
+
+    def _zip_bytes(self, size):
+        """A real ZIP of about ``size`` bytes: a README plus incompressible assets."""
+        out = io.BytesIO()
+        with zipfile.ZipFile(out, "w") as archive:
+            archive.writestr("README.txt", self._text(400), compress_type=zipfile.ZIP_DEFLATED)
+            remaining, n = size, 0
+            while remaining > 0:
+                part = min(remaining, max(size // 8, 64 * 1024))
+                archive.writestr(f"assets/asset-{n}.bin", self.rng.randbytes(part))
+                remaining -= part
+                n += 1
+        return out.getvalue()
+
+    def _png_bytes(self, width, height):
+        """Noise PNG (a real image, so renditions can be built); random bytes without Pillow."""
+        try:
+            from PIL import Image
+        except ImportError:
+            return self.rng.randbytes(width * height)
+        img = Image.frombytes("L", (width, height), self.rng.randbytes(width * height)).convert("RGB")
+        out = io.BytesIO()
+        img.save(out, "PNG")
+        return out.getvalue()
+
+    def _blob(self, bucket, filename, content_type, data):
+        size = len(data)
+        fs = gridfs.GridFS(get_db(), collection=bucket)
+        sha256 = hashlib.sha256(data).hexdigest()
+        file_id = str(fs.put(data, filename=filename, content_type=content_type, metadata={SEED_FIELD: True}))
+        blob_register(bucket, sha256, file_id, size)
+        db.blob_index.update_one({"_id": f"{bucket}:{sha256}"}, {"$set": {SEED_FIELD: True}})
+        return {"file_id": file_id, "size": size, "checksum": sha256, "content_type": content_type,
+                "filename": filename, "bucket": bucket}
+
+    def _text(self, words):
+        return " ".join(self.rng.choice(WORDS) for _ in range(words))
+
+    def _insert(self, collection, docs):
+        for i in range(0, len(docs), INSERT_BATCH):
+            db[collection].insert_many(docs[i:i + INSERT_BATCH], ordered=False)
+
+    def _users(self, kind, count):
+        names = [f"{USERNAME_PREFIX}{kind}-{i:05d}" for i in range(count)]
+        existing = set(User.objects.filter(username__in=names).values_list("username", flat=True))
+        User.objects.bulk_create([
+            User(username=n, email=f"{n}@example.test", password="!") for n in names if n not in existing
+        ])
+        users = list(User.objects.filter(username__in=names).order_by("username").values_list("id", "username"))
+        have = set(db.users.distinct("user_id", {"user_id": {"$in": [u for u, _ in users]}}))
+        self._insert("users", [{
+            "_id": str(ObjectId()), "user_id": uid, "username": name, "email": f"{name}@example.test",
+            "created_at": self.now - timedelta(days=self.rng.randint(30, 900)), SEED_FIELD: True,
+        } for uid, name in users if uid not in have])
+        return users
+
+    def handle(self, *args, **options):
+        if options["flush"] or options["flush_only"]:
+            self.flush()
+            if options["flush_only"]:
+                return
+        elif db.products.count_documents({SEED_FIELD: True}, limit=1):
+            raise CommandError("Seeded data already exists; pass --flush to replace it.")
+
+        self.rng = random.Random(options["seed"])
+        self.now = datetime(2024, 6, 1)  # fixed, so runs with the same seed match
+        self.max_blob = options["max_blob_mb"] * 1024 * 1024
+        ensure_indexes()
+
+        dev_users = self._users("dev", options["developers"])
+        buyers = self._users("buyer", options["buyers"])
+        mongo_users = {d["user_id"]: d["_id"] for d in db.users.find(
+            {"user_id": {"$in": [u for u, _ in dev_users]}}, {"user_id": 1})}
+        developers = []
+        for uid, name in dev_users:
+            developers.append({
+                "_id": str(ObjectId()), "user_id": uid, "company_name": f"{name.title()} Studio",
+                "bio": self._text(20), "website": "", "avatar_path": None, "is_verified": self.rng.random() < 0.2,
+                "rating": 0.0, "total_sales": 0, "created_at": self.now - timedelta(days=self.rng.randint(30, 900)),
+                SEED_FIELD: True,
+            })
+        db.developers.delete_many({"user_id": {"$in": [d["user_id"] for d in developers]}})
+        self._insert("developers", developers)
+        db.categories.bulk_write([
+            UpdateOne({"category": c}, {"$setOnInsert": {"_id": str(ObjectId()), SEED_FIELD: True}}, upsert=True)
+            for c in CATEGORIES
+        ], ordered=False)
+
+        self.stdout.write("Writing GridFS blobs...")
+        main_blobs = [
+            self._blob("products", f"build-{i}.zip", "application/zip",
+                       self._zip_bytes(self._lognormal_size(options["blob_kb"] * 1024)))
+            for i in range(max(options["distinct_blobs"], 1))
+        ]
+        extra_blobs = [
+            self._blob("products", f"screen-{i}.png", "image/png", self._png_bytes(1280, 720))
+            for i in range(max(options["distinct_blobs"] // 4, 1))
+        ]
+        license_blob = self._blob("license", "LICENSE.txt", "text/plain", self._text(700).encode())
+        thumbnails = [
+            self._blob("thumbnails", f"thumb-{i}.png", "image/png", self._png_bytes(480, 320))
+            for i in range(max(options["distinct_blobs"] // 4, 1))
+        ]
+
+        products, files, licenses, reviews, downloads = [], [], [], [], []
+        for i in range(options["products"]):
+            dev = self.rng.choice(developers)
+            status = self.rng.choices(("approved", "pending", "rejected"), weights=(85, 10, 5))[0]
+            is_free = self.rng.random() < 0.6
+            created = self.now - timedelta(minutes=self.rng.randint(0, 365 * 24 * 60))
+            thumb = self.rng.choice(thumbnails)
+            product = {
+                "_id": str(ObjectId()), "title": self._text(self.rng.randint(2, 5)).title(),
+                "description": self._text(self.rng.randint(30, 300)), "developer_id": dev["_id"],
+                "category": self.rng.sample(CATEGORIES, self.rng.randint(1, 3)),
+                "license": self.rng.choice(LICENSES), "product_type": self.rng.choice(PRODUCT_TYPES),
+                "version": f"{self.rng.randint(0, 4)}.{self.rng.randint(0, 20)}.{self.rng.randint(0, 9)}",
+                "price": 0.0 if is_free else round(self.rng.uniform(0.99, 49.99), 2), "is_free": is_free,
+                "status": status, "user_id": mongo_users[dev["user_id"]],
+                "tags": self.rng.sample(WORDS, self.rng.randint(1, 6)),
+                "thumbnail_path": thumb["file_id"], "thumbnail_bucket": "thumbnails",
+                "download_count": 0, "rating": 0.0, "review_count": 0, "rating_sum": 0, "rating_count": 0,
+                "rating_histogram": {str(s): 0 for s in RATING_STARS},
+                "created_at": created, "updated_at": created, SEED_FIELD: True,
+            }
+            products.append(product)
+
+            attachments = [("main", self.rng.choice(main_blobs))]
+            for _ in range(max(int(self.rng.expovariate(1 / max(options["files"] - 1, 1))), 0)):
+                attachments.append(self.rng.choice([("demo", self.rng.choice(main_blobs)),
+                                                    ("screenshot", self.rng.choice(extra_blobs))]))
+            for file_type, blob in attachments:
+                files.append({
+                    "_id": str(ObjectId()), "product_id": product["_id"], "file_type": file_type,
+                    "path": blob["file_id"], "filename": blob["filename"], "file_size": blob["size"],
+                    "checksum": blob["checksum"], "scan_status": "clean", "scan_results": {},
+                    "uploaded_at": created, "bucket": blob["bucket"], "content_type": blob["content_type"],
+                    SEED_FIELD: True,
+                })
+            licenses.append({
+                "_id": str(ObjectId()), "product_id": product["_id"], "path": license_blob["file_id"],
+                "filename": license_blob["filename"], "file_size": license_blob["size"],
+                "checksum": license_blob["checksum"], "scan_status": "clean", "scan_results": {},
+                "uploaded_at": created, "bucket": "license", SEED_FIELD: True,
+            })
+            if status != "approved":
+                continue
+
+            # Popularity is heavy-tailed: a few products get most of the traffic.
+            weight = self.rng.paretovariate(1.5)
+            for uid, _ in self.rng.sample(buyers, min(len(buyers), int(options["reviews"] * weight / 3))):
+                rating = self.rng.choices(RATING_STARS, weights=(5, 5, 15, 35, 40))[0]
+                reviews.append({
+                    "user_id": uid, "product_id": ObjectId(product["_id"]), "rating": rating,
+                    "comment": self._text(self.rng.randint(0, 40)), "created_at": created + timedelta(days=1),
+                    SEED_FIELD: True,
+                })
+                product["rating_sum"] += rating
+                product["rating_count"] += 1
+                product["review_count"] += 1
+                product["rating_histogram"][str(rating)] += 1
+            if product["rating_count"]:
+                product["rating"] = round(product["rating_sum"] / product["rating_count"], 2)
+            for uid, _ in self.rng.sample(buyers, min(len(buyers), int(options["downloads"] * weight / 3))):
+                downloads.append({
+                    "_id": str(ObjectId()), "user_id": uid, "product_id": product["_id"],
+                    "downloaded_at": created + timedelta(hours=self.rng.randint(1, 2000)),
+                    "ip_address": "127.0.0.1", "user_agent": "seed", SEED_FIELD: True,
+                })
+                product["download_count"] += 1
+
+        self.stdout.write("Writing documents...")
+        for collection, docs in (("products", products), ("product_files", files), ("licenses", licenses),
+                                 ("reviews", reviews), ("downloads", downloads)):
+            self._insert(collection, docs)
+        # Products share blobs, so set each blob's refcount to its number of references.
+        refs = Counter((d["bucket"], d["path"]) for d in files + licenses)
+        refs.update(("thumbnails", p["thumbnail_path"]) for p in products)
+        db.blob_index.bulk_write([
+            UpdateOne({"bucket": bucket, "file_id": file_id}, {"$set": {"refcount": refs[(bucket, file_id)]}})
+            for bucket, file_id in {(b["bucket"], b["file_id"]) for b in main_blobs + extra_blobs + thumbnails + [license_blob]}
+        ], ordered=False)
+        category_stats_rebuild()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {len(developers)} developers, {len(buyers)} buyers, {len(products)} products, "
+            f"{len(files)} files, {len(reviews)} reviews, {len(downloads)} downloads "
+            f"({len(main_blobs) + len(extra_blobs) + len(thumbnails) + 1} GridFS blobs)."
+        ))
@@ -0,0 +1,342 @@
+import asyncio
+import calendar
+import re
+from datetime import datetime
+from urllib.parse import quote
+
+import gridfs
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+from .blobcache import blob_cache
+from .db import get_db
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# GridFS files never change once written, so a URL that names one by
+# ObjectId can be cached for a year and revalidated without reading it.
+IMMUTABLE_PUBLIC = "public, max-age=31536000, immutable"
+IMMUTABLE_PRIVATE = "private, max-age=31536000, immutable"
+# For URLs named by something else (a product) whose file can change.
+REVALIDATE_PRIVATE = "private, no-cache"
+# Buckets /file/<id>/<bucket>/download/ may serve; avatars and thumbnails have their own URLs.
+DOWNLOAD_BUCKETS = frozenset({"products", "license"})
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def gridfs_etag(grid_out):
+    # GridFS files are immutable, so md5 (when the driver stored one) or the
+    # file id plus length identifies the content.
+    tag = getattr(grid_out, "md5", None) or f"{grid_out._id}-{grid_out.length}"
+    return quote_etag(str(tag))
+
+
+def immutable_etag(*parts):
+    """ETag for content addressed by ids alone (bucket, file id, variant...)."""
+    return quote_etag("-".join(str(p) for p in parts))
+
+
+def immutable_not_modified(request, etag, last_modified=None):
+    """True when the client already holds this immutable representation.
+
+    The caller must first check that the file still exists: a deleted file's
+    validators would otherwise keep matching.
+    """
+    if request.method not in ("GET", "HEAD"):
+        return False
+    return not_modified(request, etag, last_modified)
+
+
+def is_conditional(request):
+    return bool(request.META.get("HTTP_IF_NONE_MATCH") or request.META.get("HTTP_IF_MODIFIED_SINCE"))
+
+
+def stored_last_modified(bucket, file_id):
+    """``(exists, last_modified)`` for a GridFS file, from its files document only."""
+    try:
+        doc = get_db()[f"{bucket}.files"].find_one({"_id": ObjectId(file_id)}, {"uploadDate": 1})
+    except (InvalidId, TypeError):
+        return False, None
+    return doc is not None, _timestamp(doc.get("uploadDate") if doc else None)
+
+
+async def astored_last_modified(bucket, file_id):
+    from .async_db import get_db as get_async_db
+
+    try:
+        doc = await get_async_db()[f"{bucket}.files"].find_one({"_id": ObjectId(file_id)}, {"uploadDate": 1})
+    except (InvalidId, TypeError):
+        return False, None
+    return doc is not None, _timestamp(doc.get("uploadDate") if doc else None)
+
+
+def _cached_last_modified(meta):
+    return _timestamp(datetime.fromisoformat(meta["upload_date"]) if meta.get("upload_date") else None)
+
+
+def not_modified_response(etag, cache_control):
+    response = HttpResponseNotModified()
+    response["ETag"] = etag
+    response["Cache-Control"] = cache_control
+    return response
+
+
+def _timestamp(uploaded):
+    return calendar.timegm(uploaded.utctimetuple()) if uploaded else None
+
+
+def gridfs_last_modified(grid_out):
+    return _timestamp(grid_out.upload_date)
+
+
+def parse_range(header, length):
+    """Return ``(start, end)`` (inclusive) for a single ``bytes=`` range.
+
+    Returns ``None`` when the header should be ignored (absent, malformed or a
+    multi-range request) and raises ``RangeNotSatisfiable`` when it can't be met.
+    """
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # suffix range: the last N bytes
+        suffix = int(last)
+        if suffix == 0:
+            raise RangeNotSatisfiable
+        return max(length - suffix, 0), length - 1
+    start = int(first)
+    end = int(last) if last else length - 1
+    if start >= length or end < start:
+        raise RangeNotSatisfiable
+    return start, min(end, length - 1)
+
+
+def _etag_matches(header, etag):
+    if header.strip() == "*":
+        return True
+    strong = etag.removeprefix("W/")
+    return any(t.strip().removeprefix("W/") == strong for t in header.split(","))
+
+
+def not_modified(request, etag, last_modified):
+    inm = request.META.get("HTTP_IF_NONE_MATCH")
+    if inm:
+        return _etag_matches(inm, etag)
+    ims = parse_http_date_safe(request.META.get("HTTP_IF_MODIFIED_SINCE", ""))
+    return bool(ims and last_modified and last_modified <= ims)
+
+
+def iter_gridfs(grid_out, start=0, end=None):
+    """Yield the bytes ``start..end`` (inclusive) of a GridFS file one chunk at a time."""
+    end = grid_out.length - 1 if end is None else end
+    chunk = grid_out.chunk_size or 255 * 1024
+    try:
+        if start:
+            grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = grid_out.read(min(chunk, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        grid_out.close()
+
+
+async def aiter_gridfs(grid_out, start=0, end=None):
+    """Async ``iter_gridfs`` for Motor's GridOut, whose read/close are coroutines.
+
+    Also accepts a DiskFile, whose blocking reads are moved off the event loop.
+    """
+    end = grid_out.length - 1 if end is None else end
+    chunk = grid_out.chunk_size or 255 * 1024
+    blocking = isinstance(grid_out, DiskFile)
+    try:
+        if start:
+            grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            size = min(chunk, remaining)
+            data = await (asyncio.to_thread(grid_out.read, size) if blocking else grid_out.read(size))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        if blocking:
+            grid_out.close()
+        else:
+            await grid_out.close()
+
+
+def gridfs_response(request, grid_out, inline=False, etag=None, cache_control=None, stream=iter_gridfs):
+    """Stream ``grid_out`` with Range, ETag and Last-Modified support.
+
+    ``stream`` builds the body iterator; async views pass ``aiter_gridfs`` so
+    the ASGI handler streams chunks without tying up a thread.
+    """
+    length = grid_out.length
+    etag = etag or gridfs_etag(grid_out)
+    last_modified = gridfs_last_modified(grid_out)
+    validators = {"ETag": etag}
+    if last_modified:
+        validators["Last-Modified"] = http_date(last_modified)
+    if cache_control:
+        validators["Cache-Control"] = cache_control
+
+    if request.method in ("GET", "HEAD") and not_modified(request, etag, last_modified):
+        response = HttpResponseNotModified()
+        for name, value in validators.items():
+            response[name] = value
+        return response
+
+    byte_range = None
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if not if_range or _etag_matches(if_range, etag) or if_range == validators.get("Last-Modified"):
+        try:
+            byte_range = parse_range(request.META.get("HTTP_RANGE"), length)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{length}"
+            return response
+
+    start, end = byte_range or (0, length - 1)
+    content_type = grid_out.content_type or "application/octet-stream"
+    if request.method == "HEAD":
+        response = HttpResponse(content_type=content_type)
+    else:
+        response = StreamingHttpResponse(stream(grid_out, start, end), content_type=content_type)
+    if byte_range:
+        response.status_code = 206
+        response["Content-Range"] = f"bytes {start}-{end}/{length}"
+    response["Content-Length"] = str(max(end - start + 1, 0))
+    response["Accept-Ranges"] = "bytes"
+    for name, value in validators.items():
+        response[name] = value
+    dispo_type = "inline" if inline else "attachment"
+    response["Content-Disposition"] = f'{dispo_type}; filename="{quote(grid_out.filename or str(grid_out._id))}"'
+    return response
+
+
+class DiskFile:
+    """A blob-cache entry exposing the GridOut attributes gridfs_response uses."""
+
+    chunk_size = 256 * 1024
+    md5 = None
+
+    def __init__(self, path, meta):
+        self._f = open(path, "rb")
+        self._id = meta["file_id"]
+        self.length = meta["length"]
+        self.content_type = meta.get("content_type")
+        self.filename = meta.get("filename")
+        self.upload_date = datetime.fromisoformat(meta["upload_date"]) if meta.get("upload_date") else None
+
+    def seek(self, pos):
+        self._f.seek(pos)
+
+    def read(self, size=-1):
+        return self._f.read(size)
+
+    def close(self):
+        self._f.close()
+
+
+def _disk_response(request, path, meta, inline, etag, cache_control, stream=None):
+    if stream or request.META.get("HTTP_RANGE") or request.method == "HEAD":
+        disk_file = DiskFile(path, meta)
+        response = gridfs_response(
+            request, disk_file, inline=inline, etag=etag, cache_control=cache_control,
+            stream=stream or iter_gridfs,
+        )
+        if not response.streaming:
+            disk_file.close()  # HEAD, 304 and 416 never read the body
+        served = int(response.get("Content-Length") or 0) if request.method != "HEAD" else 0
+    else:
+        # FileResponse hands the open file to the server's wsgi.file_wrapper,
+        # so gunicorn can sendfile() it without copying through Python.
+        response = FileResponse(
+            open(path, "rb"),
+            content_type=meta.get("content_type") or "application/octet-stream",
+            as_attachment=not inline,
+            filename=meta.get("filename") or meta["file_id"],
+        )
+        response["ETag"] = etag
+        response["Accept-Ranges"] = "bytes"
+        response["Cache-Control"] = cache_control
+        if meta.get("upload_date"):
+            response["Last-Modified"] = http_date(_cached_last_modified(meta))
+        served = meta["length"]
+    blob_cache.record_served(served)
+    return response
+
+
+def serve_gridfs(request, bucket, file_id, inline=False, cache_control=IMMUTABLE_PUBLIC):
+    """Serve a GridFS file by id, answering revalidations without reading chunks.
+
+    With the blob cache enabled, files already on local disk are served from
+    there and misses are copied to disk in the background for next time.
+    """
+    etag = immutable_etag(bucket, file_id)
+    cached = blob_cache.lookup(bucket, file_id) if blob_cache.enabled else None
+    if is_conditional(request):
+        exists, last_modified = (True, _cached_last_modified(cached[1])) if cached else stored_last_modified(bucket, file_id)
+        if exists and immutable_not_modified(request, etag, last_modified):
+            return not_modified_response(etag, cache_control)
+    if cached:
+        try:
+            return _disk_response(request, *cached, inline=inline, etag=etag, cache_control=cache_control)
+        except FileNotFoundError:
+            pass  # evicted or invalidated since the lookup; read from GridFS
+    try:
+        grid_out = gridfs.GridFS(get_db(), collection=bucket).get(ObjectId(file_id))
+    except (gridfs.NoFile, InvalidId):
+        raise Http404("File not found.")
+    if blob_cache.enabled:
+        blob_cache.schedule_fill(bucket, file_id, grid_out.length)
+    return gridfs_response(request, grid_out, inline=inline, etag=etag, cache_control=cache_control)
+
+
+async def aserve_gridfs(request, bucket, file_id, inline=False, cache_control=IMMUTABLE_PUBLIC):
+    """``serve_gridfs`` for async views, reading through Motor's GridFS bucket.
+
+    The body is an async iterator, so a slow client holds a coroutine rather
+    than a worker thread for the length of the download.
+    """
+    from .async_db import gridfs_bucket
+
+    etag = immutable_etag(bucket, file_id)
+    cached = blob_cache.lookup(bucket, file_id) if blob_cache.enabled else None
+    if is_conditional(request):
+        exists, last_modified = (
+            (True, _cached_last_modified(cached[1])) if cached else await astored_last_modified(bucket, file_id)
+        )
+        if exists and immutable_not_modified(request, etag, last_modified):
+            return not_modified_response(etag, cache_control)
+    if cached:
+        try:
+            return _disk_response(
+                request, *cached, inline=inline, etag=etag, cache_control=cache_control, stream=aiter_gridfs
+            )
+        except FileNotFoundError:
+            pass  # evicted or invalidated since the lookup; read from GridFS
+    try:
+        grid_out = await gridfs_bucket(bucket).open_download_stream(ObjectId(file_id))
+    except (gridfs.NoFile, InvalidId):
+        raise Http404("File not found.")
+    if blob_cache.enabled:
+        blob_cache.schedule_fill(bucket, file_id, grid_out.length)
+    return gridfs_response(
+        request, grid_out, inline=inline, etag=etag, cache_control=cache_control, stream=aiter_gridfs
+    )
@@ -1,10 +1,25 @@
+import base64
+import time
+from collections import defaultdict
 from datetime import datetime
-from bson import ObjectId
-from .db import db
+import gridfs
+from bson import ObjectId, json_util
+from pymongo import UpdateOne, DESCENDING, ReturnDocument
+from bson.errors import BSONError, InvalidId
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from .db import db, get_db
+from .search import catalog_index, INDEXED_FIELDS
+from .cache import doc_cache
+from .blobcache import blob_cache
+from . import renditions
+from .bundles import bundle_invalidate
 
 # --------- Users ----------
 def user_get(user_id: int):
-    return db.users.find_one({"user_id": user_id})
+    return doc_cache.get("user", user_id, lambda: db.users.find_one({"user_id": user_id}))
+
+def user_get_by_pk(pk: str):
+    return doc_cache.get("user_pk", pk, lambda: db.users.find_one({"_id": pk}))
 
 def user_create(django_id: int, username: str, email: str):
     if not db.users.find_one({"user_id": django_id}):
@@ -17,7 +32,11 @@ def user_create(django_id: int, username: str, email: str):
         }
         db.users.insert_one(payload)
 def user_update(user_id: int, updates: dict):
-    return db.users.update_one({"_id": int(user_id)}, {"$set": updates})
+    result = db.users.update_one({"_id": int(user_id)}, {"$set": updates})
+    # user docs are cached under two keys; profile edits are rare, so drop both
+    doc_cache.clear("user")
+    doc_cache.clear("user_pk")
+    return result
 
 
 # --------- Categories ----------
@@ -31,19 +50,81 @@ def category_get(cat_id: str):
     return db.categories.find_one({"_id": str(cat_id)})
 
 def category_create(product_id: str, data: list):
-    for c in data:
-        # skip empty or None categories
-        if not c or not str(c).strip():
-            continue
-
-        c = str(c).strip()  # ensure string
-        existing = db.categories.find_one({'category': c})
-        if not existing:
-            db.categories.insert_one({
-                '_id': str(ObjectId()),
-                'product_id': product_id,
-                'category': c,
-            })
+    """Make sure every category name exists, in one unordered bulk upsert.
+
+    Upserts match on the unique ``category`` index, so existing categories are
+    left alone and concurrent uploads can't create duplicates.
+    """
+    # skip empty or None categories
+    names = {str(c).strip() for c in data if c and str(c).strip()}
+    if not names:
+        return
+    ops = [
+        UpdateOne({'category': c}, {'$setOnInsert': {'_id': str(ObjectId()), 'product_id': product_id}}, upsert=True)
+        for c in sorted(names)
+    ]
+    try:
+        db.categories.bulk_write(ops, ordered=False)
+    except BulkWriteError as exc:
+        # a concurrent upload inserted the same category first
+        if any(e.get("code") != 11000 for e in exc.details.get("writeErrors", [])):
+            raise
+
+# --------- Category stats ----------
+# category_stats holds one document per category name with the number of
+# approved products tagged with it, kept current on every status change.
+def _category_names(categories):
+    if isinstance(categories, str):
+        categories = [categories]
+    return {str(c) for c in (categories or []) if c}
+
+def category_stats_inc(categories, delta: int):
+    names = _category_names(categories)
+    if not names or not delta:
+        return
+    db.category_stats.bulk_write([
+        UpdateOne({"_id": c}, {"$inc": {"approved_count": delta}}, upsert=True)
+        for c in names
+    ], ordered=False)
+
+def category_stats_status_change(categories, old_status, new_status):
+    category_stats_change(categories, old_status, categories, new_status)
+
+def category_stats_change(old_categories, old_status, new_categories, new_status):
+    """Adjust the counts for a product whose categories and/or status changed."""
+    old = _category_names(old_categories) if old_status == "approved" else set()
+    new = _category_names(new_categories) if new_status == "approved" else set()
+    ops = [UpdateOne({"_id": c}, {"$inc": {"approved_count": 1}}, upsert=True) for c in sorted(new - old)]
+    ops += [UpdateOne({"_id": c}, {"$inc": {"approved_count": -1}}, upsert=True) for c in sorted(old - new)]
+    if ops:
+        db.category_stats.bulk_write(ops, ordered=False)
+
+def category_stats_rename(old_name: str, new_name: str):
+    doc = db.category_stats.find_one_and_delete({"_id": old_name})
+    if doc and doc.get("approved_count"):
+        db.category_stats.update_one(
+            {"_id": new_name},
+            {"$inc": {"approved_count": doc["approved_count"]}},
+            upsert=True,
+        )
+
+def category_stats_rebuild():
+    """Recompute category_stats from the products collection in one pass."""
+    db.products.aggregate([
+        {"$match": {"status": "approved"}},
+        {"$unwind": "$category"},
+        {"$group": {"_id": "$category", "approved_count": {"$sum": 1}}},
+        {"$out": "category_stats"},
+    ])
+    return db.category_stats.count_documents({})
+
+def category_facets(limit=None, by_count=False):
+    """Categories with at least one approved product, as ``{"category", "count"}`` dicts."""
+    cur = db.category_stats.find({"approved_count": {"$gt": 0}})
+    cur = cur.sort([("approved_count", DESCENDING), ("_id", 1)] if by_count else [("_id", 1)])
+    if limit:
+        cur = cur.limit(int(limit))
+    return [{"category": c["_id"], "count": c["approved_count"]} for c in cur]
 
 # --------- Developers ----------
 def developer_get_or_create(user_id: int):
@@ -65,8 +146,22 @@ def developer_get_or_create(user_id: int):
     db.developers.insert_one(payload)
     return payload, True
 
+def developer_get(dev_id: str):
+    return doc_cache.get("developer", dev_id, lambda: db.developers.find_one({"_id": dev_id}))
+
 def developer_update(user_id: int, updates: dict):
-    return db.developers.update_one({"user_id": int(user_id)}, {"$set": updates})
+    dev = db.developers.find_one_and_update(
+        {"user_id": int(user_id)}, {"$set": updates}, projection={"_id": 1}
+    )
+    if dev:
+        doc_cache.invalidate("developer", dev["_id"])
+    return dev
+
+def developer_delete(dev_id: str):
+    dev = db.developers.find_one_and_delete({"_id": dev_id}, projection={"avatar_path": 1, "avatar_bucket": 1})
+    if dev and dev.get("avatar_path"):
+        blob_release(dev.get("avatar_bucket") or "avatars", dev["avatar_path"])
+    doc_cache.invalidate("developer", dev_id)
 
 
 # --------- Licenses ----------
@@ -78,12 +173,14 @@ def license_create(product_id: str, path: str, filename: str, size: int, checksu
         "path": path,
         "filename": filename,
         "file_size": int(size),
+        "checksum": checksum or "",
         "scan_status": "pending",
         "scan_results": {},
         "uploaded_at": datetime.now(),
         "bucket": bucket or "license",
     }
     db.licenses.insert_one(payload)
+    bundle_invalidate(product_id)
     return payload["_id"]
 
 def license_get(license_id: str):
@@ -101,31 +198,158 @@ def product_create(data: dict):
     data.setdefault("download_count", 0)
     data.setdefault("rating", 0.0)
     data.setdefault("review_count", 0)
+    data.setdefault("rating_sum", 0)
+    data.setdefault("rating_count", 0)
+    data.setdefault("rating_histogram", {str(s): 0 for s in RATING_STARS})
     data["created_at"] = datetime.now()
     data["updated_at"] = datetime.now()
     db.products.insert_one(data)
+    category_stats_status_change(data.get("category"), None, data["status"])
+    catalog_index.update(data)
     return _id
 
+def product_doc(pk: str):
+    """The bare product document, served from the document cache."""
+    return doc_cache.get("product", pk, lambda: db.products.find_one({"_id": pk}))
+
 def product_get(pk: str, status=None):
-    q = {"_id": pk}
-    if status:
-        q["status"] = status
-    product = db.products.find_one(q)
+    product = product_doc(pk)
+    if product and status and product.get("status") != status:
+        return None
     if product:
         # attach developer + user info
-        dev = db.developers.find_one({"_id": product.get("developer_id")})
+        dev = developer_get(product.get("developer_id"))
         if dev:
             user = user_get(dev["user_id"])
             product["developer"] = {**dev, "user": user}
     return product
 
+# --------- Product cards ----------
+# Listings only render cards, so they fetch this projection rather than
+# whole documents. The description is cut server-side to what the cards
+# show (truncatechars:100 at most); the sort keys stay for keyset cursors.
+CARD_DESCRIPTION_CHARS = 101
+PRODUCT_CARD_FIELDS = {
+    "title": 1,
+    "description": {"$substrCP": [{"$ifNull": ["$description", ""]}, 0, CARD_DESCRIPTION_CHARS]},
+    "thumbnail_path": 1,
+    "developer_id": 1,
+    "product_type": 1,
+    "category": 1,
+    "status": 1,
+    "is_free": 1,
+    "price": 1,
+    "download_count": 1,
+    "rating": 1,
+    "created_at": 1,
+}
+
+def product_cards(q: dict, sort: list, limit: int = 0, skip: int = 0):
+    """Card-projected products matching ``q``; ``limit=0`` means no limit."""
+    return list(db.products.find(q, PRODUCT_CARD_FIELDS).sort(sort).skip(skip).limit(limit))
+
 def products_find(q: dict, sort: list, skip: int, limit: int):
-    cur = db.products.find(q).sort(sort).skip(skip).limit(limit)
-    return list(cur)
+    return product_cards(q, sort, limit=limit, skip=skip)
 
 def products_count(q: dict):
     return db.products.count_documents(q)
 
+# Listing totals only drive the "N found" label and page links, so a slightly
+# stale number is fine and saves a full count on every request.
+COUNT_CACHE_TTL = 60
+COUNT_CACHE_MAX = 1024
+_count_cache = {}
+
+def count_cache_get(q: dict, ttl: int = COUNT_CACHE_TTL):
+    """Return ``(key, total)``; ``total`` is None when missing or expired."""
+    key = json_util.dumps(q, sort_keys=True)
+    hit = _count_cache.get(key)
+    if hit and time.monotonic() - hit[1] < ttl:
+        return key, hit[0]
+    return key, None
+
+def count_cache_put(key: str, total: int):
+    if len(_count_cache) >= COUNT_CACHE_MAX:
+        _count_cache.clear()
+    _count_cache[key] = (total, time.monotonic())
+
+def products_count_cached(q: dict, ttl: int = COUNT_CACHE_TTL):
+    key, total = count_cache_get(q, ttl)
+    if total is None:
+        total = db.products.estimated_document_count() if not q else db.products.count_documents(q)
+        count_cache_put(key, total)
+    return total
+
+
+def products_search_page(q: dict, ranked: list, limit: int, skip: int = 0):
+    """Page through search hits in relevance order.
+
+    ``ranked`` is the ``[(product_id, score), ...]`` list from the search index;
+    ``q`` applies the remaining listing filters. Returns ``(docs, has_more, total)``.
+    """
+    ids = [pid for pid, _ in ranked]
+    matching = {d["_id"] for d in db.products.find({**q, "_id": {"$in": ids}}, {"_id": 1})}
+    ordered = [pid for pid in ids if pid in matching]
+    page_ids = ordered[skip:skip + limit]
+    by_id = {d["_id"]: d for d in db.products.find({"_id": {"$in": page_ids}}, PRODUCT_CARD_FIELDS)}
+    docs = [by_id[pid] for pid in page_ids if pid in by_id]
+    return docs, len(ordered) > skip + limit, len(ordered)
+
+
+# --------- Keyset pagination ----------
+def cursor_encode(doc: dict, sort_field: str):
+    """Opaque token for the position of ``doc`` in a listing sorted by ``sort_field``."""
+    raw = json_util.dumps([doc.get(sort_field), doc["_id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def cursor_decode(token: str):
+    try:
+        raw = base64.urlsafe_b64decode((token + "=" * (-len(token) % 4)).encode())
+        value, last_id = json_util.loads(raw.decode())
+    except (ValueError, TypeError, BSONError):
+        return None
+    return value, last_id
+
+def products_find_page(q: dict, sort_field: str, sort_dir: int, limit: int,
+                       skip: int = 0, after: str | None = None, before: str | None = None):
+    """Fetch one listing page ordered by ``(sort_field, _id)``.
+
+    With ``after``/``before`` cursors the page is located with a range query on
+    the sort key instead of ``skip``, so deep pages cost the same as the first.
+    Returns ``(docs, has_more)`` where ``has_more`` refers to the walk direction.
+    """
+    query, sort, skip, backwards = page_query(q, sort_field, sort_dir, skip, after, before)
+    docs = product_cards(query, sort, limit=limit + 1, skip=skip)
+    return page_result(docs, limit, backwards)
+
+def page_query(q: dict, sort_field: str, sort_dir: int, skip: int = 0,
+               after: str | None = None, before: str | None = None):
+    """Build ``(query, sort, skip, backwards)`` for products_find_page."""
+    backwards = bool(before) and not after
+    direction = -sort_dir if backwards else sort_dir
+    position = cursor_decode(after or before) if (after or before) else None
+    query = q
+    if position:
+        value, last_id = position
+        op = "$gt" if direction == 1 else "$lt"
+        # null/missing sort values order before every other value
+        after_ties = {sort_field: value, "_id": {op: last_id}}
+        if value is None:
+            branches = [after_ties] + ([{sort_field: {"$ne": None}}] if direction == 1 else [])
+        else:
+            branches = [{sort_field: {op: value}}, after_ties] + ([{sort_field: None}] if direction == -1 else [])
+        query = {"$and": [q, {"$or": branches}]}
+        skip = 0
+    return query, [(sort_field, direction), ("_id", direction)], skip, backwards
+
+def page_result(docs: list, limit: int, backwards: bool):
+    """Trim the ``limit + 1`` probe row and restore display order."""
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    if backwards:
+        docs.reverse()
+    return docs, has_more
+
 def product_inc_download(pk: str):
     db.products.update_one({"_id": pk}, {"$inc": {"download_count": 1}})
 def product_inc_review(pk: str):
@@ -133,20 +357,166 @@ def product_inc_review(pk: str):
 
 def product_update(pk: str, updates: dict):
     updates["updated_at"] = datetime.now()
-    db.products.update_one({"_id": pk}, {"$set": updates})
+    if "status" in updates or "category" in updates:
+        # read the pre-update status and categories in the same round trip to adjust facet counts
+        before = db.products.find_one_and_update(
+            {"_id": pk}, {"$set": updates}, projection={"status": 1, "category": 1}
+        )
+        if before:
+            category_stats_change(
+                before.get("category"), before.get("status"),
+                updates.get("category", before.get("category")), updates.get("status", before.get("status")),
+            )
+    else:
+        db.products.update_one({"_id": pk}, {"$set": updates})
+    doc_cache.invalidate("product", pk)
+    if INDEXED_FIELDS & set(updates):
+        catalog_index.refresh(pk)
+
+def product_delete(pk: str):
+    product = db.products.find_one_and_delete(
+        {"_id": pk}, projection={"status": 1, "category": 1, "thumbnail_path": 1, "thumbnail_bucket": 1}
+    )
+    if product:
+        category_stats_status_change(product.get("category"), product.get("status"), None)
+        # release the product's blobs; shared (deduplicated) ones stay until unreferenced
+        if product.get("thumbnail_path"):
+            blob_release(product.get("thumbnail_bucket") or "thumbnails", product["thumbnail_path"])
+        for coll in (db.product_files, db.licenses):
+            for f in coll.find({"product_id": pk}, {"path": 1, "bucket": 1}):
+                blob_release(f.get("bucket"), f["path"])
+            coll.delete_many({"product_id": pk})
+        bundle_invalidate(pk)
+    doc_cache.invalidate("product", pk)
+    catalog_index.remove(pk)
+    return product
+
+PRODUCT_STATUSES = ("approved", "pending", "rejected")
+# Fields developer_profile.html shows for each product
+DEVELOPER_PRODUCT_FIELDS = {
+    "title": 1, "category": 1, "description": 1, "is_free": 1, "price": 1, "status": 1, "created_at": 1,
+}
+
+def developer_products_by_status(developer_id: str, per_page: int = 20, pages: dict | None = None):
+    """Counts and one page of products per status for a developer, in a single
+    `$facet` aggregation over the (developer_id, status, created_at) index.
+
+    ``pages`` maps status -> 1-based page number. Returns
+    ``{status: {"items", "count", "page", "has_next", "has_previous"}}``.
+    """
+    pages = {s: max(int((pages or {}).get(s) or 1), 1) for s in PRODUCT_STATUSES}
+    facets = {"counts": [{"$group": {"_id": "$status", "count": {"$sum": 1}}}]}
+    for status in PRODUCT_STATUSES:
+        facets[status] = [
+            {"$match": {"status": status}},
+            {"$skip": (pages[status] - 1) * per_page},
+            {"$limit": per_page},
+        ]
+    result = next(db.products.aggregate([
+        {"$match": {"developer_id": developer_id, "status": {"$in": list(PRODUCT_STATUSES)}}},
+        {"$sort": {"status": 1, "created_at": -1}},
+        {"$project": DEVELOPER_PRODUCT_FIELDS},
+        {"$facet": facets},
+    ]), {})
+    counts = {c["_id"]: c["count"] for c in result.get("counts", [])}
+    out = {}
+    for status in PRODUCT_STATUSES:
+        count, page = counts.get(status, 0), pages[status]
+        out[status] = {
+            "items": result.get(status, []),
+            "count": count,
+            "page": page,
+            "has_next": page * per_page < count,
+            "has_previous": page > 1,
+        }
+    return out
 
 def products_related(category_id: str, exclude_id: str, limit: int = 4):
     cur = db.products.find({
         "category_id": category_id,
         "status": "approved",
         "_id": {"$ne": exclude_id}
-    }).limit(limit)
+    }, PRODUCT_CARD_FIELDS).limit(limit)
     return list(cur)
 
 
+# --------- Blobs ----------
+# blob_index maps (bucket, sha256) to the single GridFS file holding that
+# content, with a count of the documents referencing it.
+def _blob_key(bucket: str, sha256: str):
+    return f"{bucket}:{sha256}"
+
+def blob_register(bucket: str, sha256: str, file_id: str, size: int):
+    """Record a freshly written GridFS file and return the canonical file id.
+
+    If the same content is already stored in ``bucket`` the existing file id is
+    returned (and its reference count bumped); the caller should then drop the
+    copy it just wrote.
+    """
+    for _ in range(2):
+        try:
+            doc = db.blob_index.find_one_and_update(
+                {"_id": _blob_key(bucket, sha256)},
+                {
+                    "$setOnInsert": {
+                        "bucket": bucket, "sha256": sha256, "file_id": str(file_id),
+                        "size": int(size), "created_at": datetime.now(),
+                    },
+                    "$inc": {"refcount": 1},
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            return doc["file_id"]
+        except DuplicateKeyError:
+            # concurrent upsert of the same key; the retry takes the update path
+            continue
+    raise DuplicateKeyError(f"could not register blob {bucket}:{sha256}")
+
+def blob_release(bucket: str, file_id: str):
+    """Drop one reference to a GridFS file, deleting it when none remain."""
+    if not bucket or not file_id:
+        return
+    doc = db.blob_index.find_one_and_update(
+        {"bucket": bucket, "file_id": str(file_id)},
+        {"$inc": {"refcount": -1}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if doc is None:
+        # stored before blob_index existed, so never shared
+        _blob_delete(bucket, file_id)
+    elif doc.get("refcount", 0) <= 0:
+        blob_reclaim(doc["_id"], bucket, file_id)
+
+def blob_reclaim(key: str, bucket: str, file_id: str):
+    """Delete an unreferenced blob_index entry and its file.
+
+    A concurrent ``blob_register`` may have taken a new reference since the
+    count reached 0; the conditional delete then misses and the file stays.
+    """
+    if db.blob_index.delete_one({"_id": key, "refcount": {"$lte": 0}}).deleted_count == 1:
+        _blob_delete(bucket, file_id)
+
+def _blob_delete(bucket: str, file_id: str):
+    try:
+        gridfs.GridFS(get_db(), collection=bucket).delete(ObjectId(file_id))
+    except InvalidId:
+        return
+    blob_cache.invalidate(bucket, file_id)
+    renditions.delete_for(bucket, file_id)
+
+# Documents that point at GridFS files, per bucket: (collection, path field, bucket filter)
+BLOB_REFERENCES = {
+    "products": [("product_files", "path", {"bucket": {"$in": ["products", None]}})],
+    "license": [("licenses", "path", {"bucket": {"$in": ["license", None]}})],
+    "thumbnails": [("products", "thumbnail_path", {})],
+    "avatars": [("developers", "avatar_path", {})],
+}
+
+
 # --------- Product Files ----------
-def product_file_add(product_id: str, file_type: str, path: str, filename: str, size: int, checksum: str | None = None,bucket: str | None = None,content_type=None):
-    payload = {
+def product_file_payload(product_id: str, file_type: str, path: str, filename: str, size: int, checksum: str | None = None,bucket: str | None = None,content_type=None):
+    return {
         "_id": str(ObjectId()),
         "product_id": product_id,
         "file_type": file_type,
@@ -160,9 +530,22 @@ def product_file_add(product_id: str, file_type: str, path: str, filename: str,
         "bucket": bucket or "products",
         "content_type": content_type,
     }
+
+def product_file_add(product_id: str, file_type: str, path: str, filename: str, size: int, checksum: str | None = None,bucket: str | None = None,content_type=None):
+    payload = product_file_payload(product_id, file_type, path, filename, size, checksum, bucket, content_type)
     db.product_files.insert_one(payload)
+    bundle_invalidate(product_id)
     return payload["_id"]
 
+def product_files_add_many(payloads: list):
+    """Insert several product_file_payload() documents with one insert_many."""
+    if not payloads:
+        return []
+    db.product_files.insert_many(payloads)
+    for product_id in {p["product_id"] for p in payloads}:
+        bundle_invalidate(product_id)
+    return [p["_id"] for p in payloads]
+
 def product_file_first(product_id: str, file_type: str):
     return db.product_files.find_one({"product_id": product_id, "file_type": file_type})
 
@@ -174,16 +557,37 @@ def product_files_for(product_id: str):
 from bson import ObjectId
 from datetime import datetime
 
+RATING_STARS = (1, 2, 3, 4, 5)
+
 def review_add(user_id, product_id, rating, comment=""):
+    product_pk = str(product_id)
     if isinstance(product_id, str):
         product_id = ObjectId(product_id)
+    rating = int(rating)
+    now = datetime.now()
     db.reviews.insert_one({
         "user_id": user_id,
         "product_id": product_id,
         "rating": rating,
         "comment": comment,
-        "created_at": datetime.now()
+        "created_at": now
     })
+    # Fold the new review into the running aggregates with one atomic
+    # pipeline update; the average is derived from the updated sum/count.
+    result = db.products.update_one({"_id": product_pk, "rating_count": {"$exists": True}}, [
+        {"$set": {
+            "rating_sum": {"$add": [{"$ifNull": ["$rating_sum", 0]}, rating]},
+            "rating_count": {"$add": [{"$ifNull": ["$rating_count", 0]}, 1]},
+            "review_count": {"$add": [{"$ifNull": ["$review_count", 0]}, 1]},
+            f"rating_histogram.{rating}": {"$add": [{"$ifNull": [f"$rating_histogram.{rating}", 0]}, 1]},
+            "updated_at": now,
+        }},
+        {"$set": {"rating": {"$round": [{"$divide": ["$rating_sum", "$rating_count"]}, 2]}}},
+    ])
+    if not result.matched_count:
+        # no aggregates yet (reviewed before they existed): count every review
+        ratings_rebuild(product_ids=[product_pk])
+    doc_cache.invalidate("product", product_pk)
 
 
 def review_get_by_user(user_id, product_id):
@@ -201,26 +605,79 @@ def reviews_for_product(product_id: str):
     return reviews
 
 
-def refresh_product_rating(product_id: str):
-    pipeline = [
-        {"$match": {"product_id": product_id}},  # product_id is a string
+def rating_breakdown(product: dict):
+    """``[{"stars", "count", "percent"}, ...]`` from 5 down to 1 for the histogram bars."""
+    hist = product.get("rating_histogram") or {}
+    total = sum(int(hist.get(str(s), 0)) for s in RATING_STARS)
+    rows = []
+    for stars in reversed(RATING_STARS):
+        count = int(hist.get(str(stars), 0))
+        rows.append({"stars": stars, "count": count, "percent": round(100 * count / total) if total else 0})
+    return rows
+
+
+def ratings_rebuild(batch_size: int = 1000, product_ids=None, missing_only=False):
+    """Recompute rating aggregates from the reviews collection.
+
+    Covers every product, the ``product_ids`` given, or with ``missing_only``
+    the products that have no aggregates yet. Returns the number of products written.
+    """
+    products_q = {}
+    if product_ids is not None:
+        products_q["_id"] = {"$in": list(product_ids)}
+    if missing_only:
+        products_q["rating_count"] = {"$exists": False}
+    if products_q:
+        product_ids = [p["_id"] for p in db.products.find(products_q, {"_id": 1})]
+        if not product_ids:
+            return 0
+        # reviews store the product id as an ObjectId, older ones as a string
+        object_ids = [ObjectId(pid) for pid in product_ids if ObjectId.is_valid(pid)]
+        pipeline = [{"$match": {"product_id": {"$in": product_ids + object_ids}}}]
+    else:
+        pipeline = []
+    stats = {}
+    for row in db.reviews.aggregate(pipeline + [
         {"$group": {
-            "_id": "$product_id",
-            "avg": {"$avg": "$rating"},
-            "count": {"$sum": 1}
+            "_id": {"product_id": {"$toString": "$product_id"}, "rating": "$rating"},
+            "count": {"$sum": 1},
         }},
-    ]
-    agg = list(db.reviews.aggregate(pipeline))
-    if agg:
-        avg = round(float(agg[0]["avg"]), 2)
-        count = int(agg[0]["count"])
+    ]):
+        pid = row["_id"]["product_id"]
+        entry = stats.setdefault(pid, {"sum": 0, "count": 0, "reviews": 0, "hist": {str(s): 0 for s in RATING_STARS}})
+        entry["reviews"] += row["count"]
+        try:
+            stars = int(row["_id"]["rating"])
+        except (TypeError, ValueError):
+            continue  # reviews without a usable rating count as reviews only
+        if stars not in RATING_STARS:
+            continue
+        entry["sum"] += stars * row["count"]
+        entry["count"] += row["count"]
+        entry["hist"][str(stars)] += row["count"]
+
+    empty = {"sum": 0, "count": 0, "reviews": 0, "hist": {str(s): 0 for s in RATING_STARS}}
+    ops, written = [], 0
+    for product in db.products.find(products_q, {"_id": 1}):
+        entry = stats.get(product["_id"], empty)
+        ops.append(UpdateOne({"_id": product["_id"]}, {"$set": {
+            "rating_sum": entry["sum"],
+            "rating_count": entry["count"],
+            "review_count": entry["reviews"],
+            "rating_histogram": entry["hist"],
+            "rating": round(entry["sum"] / entry["count"], 2) if entry["count"] else 0.0,
+        }}))
+        if len(ops) >= batch_size:
+            written += db.products.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        written += db.products.bulk_write(ops, ordered=False).modified_count
+    if products_q:
+        for pid in product_ids:
+            doc_cache.invalidate("product", pid)
     else:
-        avg, count = 0.0, 0
-
-    db.products.update_one(
-        {"_id": product_id},  # also a string
-        {"$set": {"rating": avg, "review_count": count}}
-    )
+        doc_cache.clear("product")
+    return written
 
 
 
@@ -252,3 +709,130 @@ def moderation_log_add(product_id: str, moderator_id: int, action: str, reason:
         "created_at": datetime.now(),
     }
     db.moderation_logs.insert_one(payload)
+
+# Only what moderation_queue.html shows; descriptions are cut server-side
+# since the card truncates them to 100 characters anyway.
+MODERATION_PRODUCT_FIELDS = {
+    "title": 1, "description": {"$substrCP": [{"$ifNull": ["$description", ""]}, 0, 101]},
+    "thumbnail_path": 1, "developer_id": 1, "product_type": 1, "category": 1, "license": 1,
+    "is_free": 1, "price": 1, "created_at": 1, "tags": 1,
+}
+MODERATION_FILE_FIELDS = {"product_id": 1, "file_type": 1, "filename": 1, "file_size": 1}
+
+def moderation_queue_page(limit: int, after: str | None = None, before: str | None = None):
+    """A keyset page of pending products, newest first, with ``files`` and
+    ``developer`` attached using one `$in` query each. Returns ``(products, has_more)``."""
+    query, sort, _, backwards = page_query({"status": "pending"}, "created_at", -1, 0, after, before)
+    products = list(db.products.find(query, MODERATION_PRODUCT_FIELDS).sort(sort).limit(limit + 1))
+    products, has_more = page_result(products, limit, backwards)
+
+    files_by_product = defaultdict(list)
+    for f in db.product_files.find({"product_id": {"$in": [p["_id"] for p in products]}}, MODERATION_FILE_FIELDS):
+        files_by_product[f["product_id"]].append(f)
+    dev_ids = list({p["developer_id"] for p in products if p.get("developer_id")})
+    devs = {d["_id"]: d for d in db.developers.find({"_id": {"$in": dev_ids}}, {"company_name": 1})}
+    for p in products:
+        p["files"] = files_by_product.get(p["_id"], [])
+        p["developer"] = devs.get(p.get("developer_id"))
+    return products, has_more
+
+
+# --------- Batch loading ----------
+class BatchLoader:
+    """Request-scoped loader that resolves developers/users/categories with one
+    `$in` query per collection instead of one `find_one` per listed product."""
+
+    def __init__(self):
+        self._developers = {}
+        self._users = {}
+        self._categories = {}
+
+    @staticmethod
+    def _pending(cache: dict, keys):
+        wanted = {k for k in keys if k is not None and k != ""}
+        return wanted, [k for k in wanted if k not in cache]
+
+    @staticmethod
+    def _fill(cache: dict, field: str, docs, missing):
+        for doc in docs:
+            cache.setdefault(doc[field], doc)
+        for k in missing:
+            cache.setdefault(k, None)
+
+    def _load(self, cache: dict, collection, field: str, keys):
+        wanted, missing = self._pending(cache, keys)
+        if missing:
+            self._fill(cache, field, collection.find({field: {"$in": missing}}), missing)
+        return {k: cache[k] for k in wanted}
+
+    def developers(self, developer_ids):
+        return self._load(self._developers, db.developers, "_id", developer_ids)
+
+    def users(self, user_ids):
+        return self._load(self._users, db.users, "user_id", user_ids)
+
+    def categories(self, names):
+        return self._load(self._categories, db.categories, "category", names)
+
+    def attach_developers(self, products: list):
+        """Set ``p["developer"]`` (with ``developer["user"]``) and ``p["user"]``
+        on every product."""
+        devs = self.developers(p.get("developer_id") for p in products)
+        users = self.users(d.get("user_id") for d in devs.values() if d)
+        return self.link_developers(products, devs, users)
+
+    @staticmethod
+    def link_developers(products: list, devs: dict, users: dict):
+        for p in products:
+            dev = devs.get(p.get("developer_id"))
+            if not dev:
+                continue
+            dev["id"] = str(dev["_id"])
+            usr = users.get(dev.get("user_id"))
+            if usr:
+                usr["id"] = str(usr["_id"])
+                dev["user"] = usr
+                p["user"] = usr
+            p["developer"] = dev
+        return products
+
+    def attach_users(self, developers: list):
+        users = self.users(d.get("user_id") for d in developers)
+        return self.link_users(developers, users)
+
+    @staticmethod
+    def link_users(developers: list, users: dict):
+        for d in developers:
+            d["user"] = users.get(d.get("user_id"))
+        return developers
+
+    def attach_categories(self, products: list):
+        cats = self.categories(self.category_names(products))
+        return self.link_categories(products, cats)
+
+    @staticmethod
+    def category_names(products: list):
+        return {c for p in products for c in (p.get("category") or [])}
+
+    @staticmethod
+    def link_categories(products: list, cats: dict):
+        for p in products:
+            categories_list = []
+            for name in p.get("category") or []:
+                c = cats.get(name)
+                if c:
+                    c["id"] = str(c["_id"])
+                    categories_list.append(c)
+            p["categories"] = categories_list
+        return products
+
+
+def batch_loader(request=None):
+    """Return the loader bound to ``request`` (one per request), or a fresh one."""
+    if request is None:
+        return BatchLoader()
+    loader = getattr(request, "_batch_loader", None)
+    if loader is None:
+        loader = BatchLoader()
+        request._batch_loader = loader
+    return loader
@@ -0,0 +1,257 @@
+# marketplace/profiling.py
+"""Per-request MongoDB command profiling.
+
+``command_profiler`` is registered on every MongoClient (sync and Motor) and
+records each command into the QueryProfile of the request that issued it,
+found through a context variable, so it costs one lookup when no profile is
+active. QueryProfilerMiddleware opens a profile per request and then:
+
+- adds a ``Server-Timing`` header (on pages that loaded a staff user, or
+  everywhere with MONGO_PROFILE_SERVER_TIMING) that browser dev tools show;
+- warns when one query shape runs MONGO_PROFILE_REPEAT_WARN times or more,
+  the usual sign of an N+1 loop;
+- warns when a view decorated with ``@query_budget(n)`` issues more than n
+  commands (and raises under MONGO_QUERY_BUDGET_STRICT, for tests);
+- logs a sampled JSON summary of slow requests to ``marketplace.slow_requests``.
+
+Commands issued while a streaming response is being sent, or from threads
+started without copying the context, are not counted.
+"""
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger("marketplace.slow_requests")
+
+MONGO_PROFILE_REPEAT_WARN = getattr(settings, "MONGO_PROFILE_REPEAT_WARN", 5)
+MONGO_PROFILE_SLOW_MS = getattr(settings, "MONGO_PROFILE_SLOW_MS", 500)
+MONGO_PROFILE_SAMPLE_RATE = getattr(settings, "MONGO_PROFILE_SAMPLE_RATE", 0.0)
+MONGO_PROFILE_SERVER_TIMING = getattr(settings, "MONGO_PROFILE_SERVER_TIMING", False)
+MONGO_QUERY_BUDGET_STRICT = getattr(settings, "MONGO_QUERY_BUDGET_STRICT", False)
+
+# Commands that touch a collection; handshakes, pings and auth are ignored.
+DATA_COMMANDS = {
+    "find", "getMore", "aggregate", "count", "distinct", "insert", "update", "delete",
+    "findAndModify", "createIndexes", "listIndexes",
+}
+# Repeats of these are expected (cursor batches), not N+1 queries.
+NOT_REPEATS = {"getMore"}
+# Where each command keeps the filter that defines its shape
+FILTER_FIELDS = {
+    "find": "filter", "count": "query", "distinct": "query", "findAndModify": "query",
+}
+
+_current = contextvars.ContextVar("mongo_query_profile", default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def _shape(value):
+    """The structure of a filter with every literal replaced by '?'."""
+    if isinstance(value, dict):
+        return {k: _shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        shaped = [_shape(v) for v in value]
+        # $in/$nin lists of literals all look the same whatever their length
+        return ["?"] if all(s == "?" for s in shaped) else shaped
+    return "?"
+
+
+def command_shape(name, command):
+    if name == "aggregate":
+        # $match stages by structure, every other stage by name
+        shape = [{stage: _shape(spec) if stage == "$match" else "?" for stage, spec in step.items()}
+                 for step in command.get("pipeline", [])]
+    else:
+        if name in ("update", "delete"):
+            ops = command.get(f"{name}s") or []
+            filt = ops[0].get("q") if ops else None
+        else:
+            filt = command.get(FILTER_FIELDS.get(name, ""))
+        shape = _shape(filt) if filt is not None else None
+    return json.dumps(shape, sort_keys=True, default=str)
+
+
+class QueryProfile:
+    """Mongo commands issued while handling one request."""
+
+    def __init__(self, label=""):
+        self.label = label
+        self.budget = None
+        self.commands = []  # (collection, command name, shape, ms, ok)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def started(self, key, collection, name, shape):
+        with self._lock:
+            self._pending[key] = (collection, name, shape)
+
+    def finished(self, key, duration_micros, ok=True):
+        with self._lock:
+            pending = self._pending.pop(key, None)
+            if pending:
+                self.commands.append((*pending, duration_micros / 1000, ok))
+
+    @property
+    def count(self):
+        return len(self.commands)
+
+    @property
+    def total_ms(self):
+        return sum(c[3] for c in self.commands)
+
+    def by_operation(self):
+        """``{"collection.command": {"count", "ms"}}``, busiest first."""
+        grouped = defaultdict(lambda: {"count": 0, "ms": 0.0})
+        for collection, name, _, ms, _ in self.commands:
+            entry = grouped[f"{collection}.{name}"]
+            entry["count"] += 1
+            entry["ms"] += ms
+        return {k: {"count": v["count"], "ms": round(v["ms"], 2)}
+                for k, v in sorted(grouped.items(), key=lambda kv: -kv[1]["ms"])}
+
+    def repeated(self, threshold=MONGO_PROFILE_REPEAT_WARN):
+        """``[(collection, command, shape, times)]`` for shapes run ``threshold``+ times."""
+        counts = Counter((c, n, s) for c, n, s, _, _ in self.commands if n not in NOT_REPEATS)
+        return [(*k, times) for k, times in counts.most_common() if times >= threshold]
+
+    def slowest(self, n=5):
+        return [
+            {"op": f"{c}.{name}", "shape": shape, "ms": round(ms, 2)}
+            for c, name, shape, ms, _ in sorted(self.commands, key=lambda c: -c[3])[:n]
+        ]
+
+    def summary(self):
+        return {
+            "commands": self.count,
+            "mongo_ms": round(self.total_ms, 2),
+            "by_operation": self.by_operation(),
+            "slowest": self.slowest(),
+            "repeated": [{"op": f"{c}.{n}", "shape": s, "times": t} for c, n, s, t in self.repeated()],
+        }
+
+
+class CommandProfiler(monitoring.CommandListener):
+    """Feeds commands to the active QueryProfile, if any."""
+
+    def started(self, event):
+        profile = _current.get()
+        if profile is None or event.command_name not in DATA_COMMANDS:
+            return
+        command = event.command
+        collection = command.get("collection") if event.command_name == "getMore" else command.get(event.command_name)
+        profile.started(
+            (event.connection_id, event.request_id),
+            str(collection), event.command_name, command_shape(event.command_name, command),
+        )
+
+    def succeeded(self, event):
+        profile = _current.get()
+        if profile is not None:
+            profile.finished((event.connection_id, event.request_id), event.duration_micros)
+
+    def failed(self, event):
+        profile = _current.get()
+        if profile is not None:
+            profile.finished((event.connection_id, event.request_id), event.duration_micros, ok=False)
+
+
+command_profiler = CommandProfiler()
+
+
+@contextmanager
+def profile_queries(label=""):
+    """Record the Mongo commands issued inside the block (tests, benchmarks)."""
+    profile = QueryProfile(label)
+    token = _current.set(profile)
+    try:
+        yield profile
+    finally:
+        _current.reset(token)
+
+
+def current_profile():
+    return _current.get()
+
+
+def query_budget(max_commands):
+    """Declare how many Mongo commands a view may issue per request."""
+    def decorate(view):
+        view.mongo_query_budget = max_commands
+        return view
+    return decorate
+
+
+def _is_staff(request):
+    # Only look at a user the view already loaded: resolving request.user here
+    # would read the session and add "Vary: Cookie" to cacheable media responses.
+    user = getattr(request, "_cached_user", None)
+    return bool(getattr(user, "is_staff", False))
+
+
+class QueryProfilerMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        with profile_queries(request.path) as profile:
+            response = self.get_response(request)
+        return self._finish(request, response, profile, started)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        with profile_queries(request.path) as profile:
+            response = await self.get_response(request)
+        return self._finish(request, response, profile, started)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        profile = _current.get()
+        budget = getattr(view_func, "mongo_query_budget", None)
+        if profile is not None and budget is not None:
+            profile.budget = budget
+        return None
+
+    def _finish(self, request, response, profile, started):
+        total_ms = (time.perf_counter() - started) * 1000
+        where = f"{request.method} {request.path}"
+        for collection, name, shape, times in profile.repeated():
+            logger.warning("%s ran %s.%s %d times with shape %s (N+1?)", where, collection, name, times, shape)
+
+        if MONGO_PROFILE_SERVER_TIMING or _is_staff(request):
+            response["Server-Timing"] = (
+                f'mongo;dur={profile.total_ms:.1f};desc="{profile.count} commands", app;dur={total_ms:.1f}'
+            )
+
+        if total_ms >= MONGO_PROFILE_SLOW_MS and MONGO_PROFILE_SAMPLE_RATE and random.random() < MONGO_PROFILE_SAMPLE_RATE:
+            slow_logger.info(json.dumps({
+                "method": request.method, "path": request.path, "status": response.status_code,
+                "total_ms": round(total_ms, 2), **profile.summary(),
+            }, default=str))
+
+        if profile.budget is not None and profile.count > profile.budget:
+            message = f"{where} issued {profile.count} Mongo commands (budget {profile.budget})"
+            if MONGO_QUERY_BUDGET_STRICT:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
@@ -0,0 +1,116 @@
+import io
+
+import gridfs
+from bson import ObjectId
+
+from .db import db, get_db
+
+RENDITION_BUCKET = "renditions"
+
+# name -> bounding box; images are scaled down to fit, never up
+RENDITION_SIZES = {
+    "placeholder": (24, 24),
+    "avatar": (128, 128),
+    "card": (480, 320),
+    "gallery": (960, 640),
+    "full": (1920, 1280),
+}
+RENDITION_FORMATS = {
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", {"quality": 82, "optimize": True, "progressive": True}),
+}
+PLACEHOLDER_QUALITY = 40
+
+# Buckets whose files may be rendered; "products" holds screenshots next to archives.
+IMAGE_BUCKETS = {"thumbnails", "avatars", "products"}
+
+
+class RenditionError(Exception):
+    pass
+
+
+def preferred_format(accept_header: str):
+    return "webp" if "image/webp" in (accept_header or "") else "jpeg"
+
+
+def _find(source_bucket, source_id, size, fmt):
+    return db[f"{RENDITION_BUCKET}.files"].find_one({
+        "metadata.source_bucket": source_bucket,
+        "metadata.source_id": str(source_id),
+        "metadata.size": size,
+        "metadata.format": fmt,
+    }, sort=[("uploadDate", 1), ("_id", 1)])
+
+
+def render(source, size: str, fmt: str):
+    """Resize the image in file-like ``source`` and return the encoded bytes."""
+    # Pillow is imported on first use; most workers never build a rendition.
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    box = RENDITION_SIZES[size]
+    pil_format, _, options = RENDITION_FORMATS[fmt]
+    try:
+        with Image.open(source) as img:
+            img.draft("RGB", box)  # lets JPEG decode at a reduced scale
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail(box, Image.LANCZOS)
+            if fmt == "jpeg" and img.mode in ("RGBA", "LA", "P"):
+                # JPEG has no alpha: flatten onto white
+                img = img.convert("RGBA")
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel("A"))
+                img = background
+            elif img.mode not in ("RGB", "RGBA") or (fmt == "jpeg" and img.mode != "RGB"):
+                img = img.convert("RGBA" if img.mode in ("LA", "P") else "RGB")
+            out = io.BytesIO()
+            if size == "placeholder":
+                options = {**options, "quality": PLACEHOLDER_QUALITY}
+            img.save(out, pil_format, **options)
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as exc:
+        raise RenditionError(str(exc)) from exc
+    return out.getvalue()
+
+
+def get_or_build(source_bucket: str, source_id: str, size: str, fmt: str):
+    """Return the GridOut of a stored rendition, building it on first request."""
+    if source_bucket not in IMAGE_BUCKETS or size not in RENDITION_SIZES or fmt not in RENDITION_FORMATS:
+        raise RenditionError("unsupported rendition")
+    fs = gridfs.GridFS(get_db(), collection=RENDITION_BUCKET)
+    existing = _find(source_bucket, source_id, size, fmt)
+    if existing:
+        return fs.get(existing["_id"])
+    source = gridfs.GridFS(get_db(), collection=source_bucket).get(ObjectId(source_id))
+    if not (source.content_type or "").startswith("image/"):
+        raise RenditionError("source is not an image")
+    data = render(source, size, fmt)
+    _, content_type, _ = RENDITION_FORMATS[fmt]
+    file_id = fs.put(
+        data,
+        filename=f"{source_id}-{size}.{fmt}",
+        content_type=content_type,
+        metadata={"source_bucket": source_bucket, "source_id": str(source_id), "size": size, "format": fmt},
+    )
+    # Concurrent first requests may each have built one; every builder but the
+    # one whose copy _find picks deletes its own, so a single copy remains.
+    winner = _find(source_bucket, source_id, size, fmt)
+    if winner and winner["_id"] != file_id:
+        fs.delete(file_id)
+        file_id = winner["_id"]
+    return fs.get(file_id)
+
+
+def build_all(source_bucket: str, source_id: str, sizes=None):
+    """Eagerly build every (or the given) size in both formats, e.g. after an upload."""
+    built = []
+    for size in sizes or RENDITION_SIZES:
+        for fmt in RENDITION_FORMATS:
+            built.append(get_or_build(source_bucket, source_id, size, fmt)._id)
+    return built
+
+
+def delete_for(source_bucket: str, source_id: str):
+    fs = gridfs.GridFS(get_db(), collection=RENDITION_BUCKET)
+    for doc in db[f"{RENDITION_BUCKET}.files"].find(
+        {"metadata.source_bucket": source_bucket, "metadata.source_id": str(source_id)}, {"_id": 1}
+    ):
+        fs.delete(doc["_id"])
@@ -0,0 +1,299 @@
+import logging
+import math
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from pymongo.errors import PyMongoError
+
+from .db import db
+
+logger = logging.getLogger(__name__)
+
+# Field weights used when building each document's term frequencies (BM25F-style).
+FIELD_WEIGHTS = {"title": 3.0, "tags": 2.0, "description": 1.0}
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Score multipliers for terms that only matched by prefix or with one typo.
+PREFIX_BOOST = 0.7
+TYPO_BOOST = 0.5
+MAX_PREFIX_EXPANSIONS = 20
+MIN_TYPO_LENGTH = 4
+
+MAX_RESULTS = 1000
+# How often each worker pulls products changed by other workers.
+SYNC_INTERVAL = 30
+# Build the index when a server process starts rather than on the first search
+SEARCH_WARM_ON_START = getattr(settings, "SEARCH_WARM_ON_START", True)
+
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is",
+    "it", "of", "on", "or", "the", "this", "to", "with",
+}
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    if not text:
+        return []
+    if isinstance(text, (list, tuple)):
+        text = " ".join(str(t) for t in text)
+    return [t for t in _TOKEN_RE.findall(str(text).lower()) if t not in STOP_WORDS]
+
+
+def _deletes(term):
+    return {term[:i] + term[i + 1:] for i in range(len(term))}
+
+
+def _within_one_edit(a, b):
+    if a == b:
+        return True
+    la, lb = len(a), len(b)
+    if abs(la - lb) > 1:
+        return False
+    if la == lb:
+        diff = [i for i in range(la) if a[i] != b[i]]
+        if len(diff) == 1:
+            return True
+        # adjacent transposition
+        return len(diff) == 2 and diff[1] == diff[0] + 1 and a[diff[0]] == b[diff[1]] and a[diff[1]] == b[diff[0]]
+    if la > lb:
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    return a[i:] == b[i + 1:]
+
+
+# Product fields whose change requires re-indexing.
+INDEXED_FIELDS = set(FIELD_WEIGHTS) | {"status"}
+_INDEX_PROJECTION = {**{f: 1 for f in FIELD_WEIGHTS}, "status": 1, "updated_at": 1}
+
+
+def _to_millis(value):
+    # MongoDB stores datetimes to the millisecond; compare watermarks at that precision
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
+
+
+class SearchIndex:
+    """In-process inverted index over approved products' title, tags and description.
+
+    Postings hold field-weighted term frequencies and are scored with BM25.
+    Query terms also match vocabulary terms by prefix and within one edit
+    (symmetric-delete lookup), so lookups only touch the postings of matched
+    terms rather than the whole catalog.
+
+    The index is built off the request path (``warm_in_background``); until it
+    is ready, searches fall back to matching titles and tags in MongoDB.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._warming = None
+        self._reset()
+
+    def _reset(self):
+        self._postings = defaultdict(dict)   # term -> {product_id: weighted tf}
+        self._doc_len = {}                   # product_id -> weighted length
+        self._doc_terms = {}                 # product_id -> set of terms
+        self._delete_map = defaultdict(set)  # one-char deletion -> terms
+        self._vocab = None                   # sorted vocabulary, rebuilt lazily
+        self._total_len = 0.0
+        self._loaded = False
+        self._synced_at = 0.0
+        self._watermark = None               # newest updated_at seen, to the millisecond
+        self._watermark_ids = set()          # products already seen at exactly that time
+
+    # ---- maintenance ----
+    def _add_term(self, term):
+        self._vocab = None
+        self._delete_map[term].add(term)
+        for d in _deletes(term):
+            self._delete_map[d].add(term)
+
+    def _drop_term(self, term):
+        self._vocab = None
+        del self._postings[term]
+        for d in _deletes(term) | {term}:
+            bucket = self._delete_map.get(d)
+            if bucket:
+                bucket.discard(term)
+                if not bucket:
+                    del self._delete_map[d]
+
+    def remove(self, product_id):
+        with self._lock:
+            for term in self._doc_terms.pop(product_id, ()):
+                postings = self._postings.get(term)
+                if postings is None:
+                    continue
+                postings.pop(product_id, None)
+                if not postings:
+                    self._drop_term(term)
+            self._total_len -= self._doc_len.pop(product_id, 0.0)
+
+    def index_product(self, product):
+        """Add or replace ``product`` in the index; non-approved products are removed."""
+        product_id = product["_id"]
+        with self._lock:
+            self.remove(product_id)
+            updated = product.get("updated_at")
+            if updated:
+                updated = _to_millis(updated)
+                if self._watermark is None or updated > self._watermark:
+                    self._watermark, self._watermark_ids = updated, {product_id}
+                elif updated == self._watermark:
+                    self._watermark_ids.add(product_id)
+            if product.get("status") != "approved":
+                return
+            tf = defaultdict(float)
+            for field, weight in FIELD_WEIGHTS.items():
+                for term in tokenize(product.get(field)):
+                    tf[term] += weight
+            for term, freq in tf.items():
+                if term not in self._postings:
+                    self._add_term(term)
+                self._postings[term][product_id] = freq
+            length = sum(tf.values())
+            self._doc_terms[product_id] = set(tf)
+            self._doc_len[product_id] = length
+            self._total_len += length
+
+    def rebuild(self):
+        """Load every approved product into a fresh index, then swap it in.
+
+        Searches keep using the current state (or the fallback) during the scan.
+        """
+        fresh = SearchIndex()
+        for product in db.products.find({"status": "approved"}, _INDEX_PROJECTION):
+            fresh.index_product(product)
+        with self._lock:
+            for name, value in vars(fresh).items():
+                if name not in ("_lock", "_warming"):
+                    setattr(self, name, value)
+            self._loaded = True
+            self._synced_at = time.monotonic()
+
+    def warm_in_background(self):
+        """Build the index on a daemon thread unless it is loaded or already building."""
+        with self._lock:
+            if self._loaded or (self._warming and self._warming.is_alive()):
+                return self._warming
+            self._warming = threading.Thread(target=self._warm, name="search-index", daemon=True)
+            self._warming.start()
+            return self._warming
+
+    def _warm(self):
+        try:
+            self.rebuild()
+        except PyMongoError:
+            logger.exception("could not build the search index; searches stay on the fallback")
+
+    def sync(self, force=False):
+        """Load the index if needed, then pick up products changed elsewhere."""
+        if not self._loaded:
+            self.rebuild()
+            return
+        if not force and time.monotonic() - self._synced_at < SYNC_INTERVAL:
+            return
+        with self._lock:
+            # $gte: another worker may have written in the same millisecond as
+            # the newest product we know; skip the ones already indexed.
+            seen_at, seen_ids = self._watermark, set(self._watermark_ids)
+            q = {"updated_at": {"$gte": seen_at}} if seen_at else {}
+            for product in db.products.find(q, _INDEX_PROJECTION):
+                updated = product.get("updated_at")
+                if updated and _to_millis(updated) == seen_at and product["_id"] in seen_ids:
+                    continue
+                self.index_product(product)
+            self._synced_at = time.monotonic()
+
+    def update(self, product):
+        """Index a freshly written product document, if this worker has loaded the index."""
+        if self._loaded:
+            self.index_product(product)
+
+    def refresh(self, product_id):
+        if not self._loaded:
+            return
+        product = db.products.find_one({"_id": product_id}, _INDEX_PROJECTION)
+        if product:
+            self.index_product(product)
+        else:
+            self.remove(product_id)
+
+    # ---- querying ----
+    def _expand(self, token):
+        """Vocabulary terms matching ``token`` with their score multiplier."""
+        matches = {}
+        if token in self._postings:
+            matches[token] = 1.0
+        if self._vocab is None:
+            self._vocab = sorted(self._postings)
+        i = bisect_left(self._vocab, token)
+        expanded = 0
+        while i < len(self._vocab) and expanded < MAX_PREFIX_EXPANSIONS:
+            term = self._vocab[i]
+            if not term.startswith(token):
+                break
+            if term not in matches:
+                matches[term] = PREFIX_BOOST
+                expanded += 1
+            i += 1
+        if len(token) >= MIN_TYPO_LENGTH:
+            candidates = set(self._delete_map.get(token, ()))
+            for d in _deletes(token):
+                candidates |= self._delete_map.get(d, set())
+            for term in candidates:
+                if term not in matches and _within_one_edit(token, term):
+                    matches[term] = TYPO_BOOST
+        return matches
+
+    def _fallback_search(self, tokens, limit):
+        """Approved products whose title or tags contain every token, most downloaded first."""
+        q = {"status": "approved", "$and": [
+            {"$or": [{f: {"$regex": re.escape(t), "$options": "i"}} for f in ("title", "tags")]}
+            for t in tokens
+        ]}
+        cursor = db.products.find(q, {"_id": 1}).sort([("download_count", -1), ("_id", 1)]).limit(limit)
+        return [(product["_id"], 1.0) for product in cursor]
+
+    def search(self, text, limit=MAX_RESULTS):
+        """Return ``[(product_id, score), ...]`` ordered by descending BM25 score."""
+        tokens = tokenize(text)
+        if not self._loaded:
+            self.warm_in_background()
+            return self._fallback_search(tokens, limit) if tokens else []
+        self.sync()
+        if not tokens:
+            return []
+        with self._lock:
+            n_docs = len(self._doc_len)
+            if not n_docs:
+                return []
+            avg_len = self._total_len / n_docs
+            scores = defaultdict(float)
+            for token in dict.fromkeys(tokens):
+                for term, boost in self._expand(token).items():
+                    postings = self._postings[term]
+                    idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for product_id, tf in postings.items():
+                        norm = BM25_K1 * (1 - BM25_B + BM25_B * self._doc_len[product_id] / avg_len)
+                        scores[product_id] += boost * idf * tf * (BM25_K1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+        return ranked[:limit]
+
+
+catalog_index = SearchIndex()
+
+
+def warm_search_index_in_background():
+    """Called when a server process starts, next to the index check."""
+    if not SEARCH_WARM_ON_START:
+        return None
+    return catalog_index.warm_in_background()
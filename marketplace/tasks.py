@@ -0,0 +1,88 @@
+# marketplace/tasks.py
+"""Background job handlers, run by ``manage.py run_jobs`` worker processes."""
+import hashlib
+from datetime import datetime
+
+import gridfs
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from .archives import inspect_archive
+from .db import db, get_db
+from .jobs import JobError, job_handler
+from .renditions import IMAGE_BUCKETS, RenditionError, build_all
+
+SCAN_COLLECTIONS = {"product_files", "licenses"}
+SCAN_READ_SIZE = 1024 * 1024
+SCAN_MAX_ISSUES = 50
+
+# Extra inspections keyed by content type: callable(grid_out) -> (issues, details).
+# They see the stored file after the checksum pass.
+FILE_INSPECTORS = {
+    "application/zip": inspect_archive,
+    "application/java-archive": inspect_archive,
+    "application/vnd.android.package-archive": inspect_archive,
+    # APKs are usually declared as octet-stream; non-ZIPs are skipped
+    "application/octet-stream": inspect_archive,
+}
+
+
+def _open_gridfs(bucket: str, file_id: str):
+    try:
+        return gridfs.GridFS(get_db(), collection=bucket).get(ObjectId(file_id))
+    except (InvalidId, gridfs.errors.NoFile) as exc:
+        raise JobError(f"{bucket}/{file_id}: stored file missing") from exc
+
+
+def _sha256(grid_out):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: grid_out.read(SCAN_READ_SIZE), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+@job_handler("scan_file")
+def scan_file(collection: str, id: str):
+    """Check a stored upload against its recorded checksum and run the inspectors."""
+    if collection not in SCAN_COLLECTIONS:
+        raise JobError(f"cannot scan {collection!r}")
+    doc = db[collection].find_one({"_id": id})
+    if not doc:
+        raise JobError(f"{collection}/{id} no longer exists")
+
+    bucket = doc.get("bucket") or "products"
+    grid_out = _open_gridfs(bucket, doc["path"])
+    content_type = doc.get("content_type") or grid_out.content_type
+    sha256 = _sha256(grid_out)
+    issues = []
+    if doc.get("checksum") and doc["checksum"] != sha256:
+        issues.append("checksum mismatch")
+    results = {"sha256": sha256, "size": grid_out.length, "content_type": content_type}
+
+    inspector = FILE_INSPECTORS.get(content_type)
+    if inspector:
+        grid_out.seek(0)
+        found, details = inspector(grid_out)
+        issues.extend(found)
+        results.update(details)
+    if bucket in IMAGE_BUCKETS and (content_type or "").startswith("image/"):
+        try:
+            results["renditions"] = len(build_all(bucket, doc["path"]))
+        except RenditionError as exc:
+            issues.append(f"unreadable image: {exc}")
+
+    results["issues"] = issues[:SCAN_MAX_ISSUES]
+    results["scanned_at"] = datetime.now()
+    status = "flagged" if issues else "clean"
+    db[collection].update_one({"_id": id}, {"$set": {"scan_status": status, "scan_results": results}})
+    return {"scan_status": status, "issues": results["issues"]}
+
+
+@job_handler("build_renditions")
+def build_renditions(bucket: str, file_id: str):
+    if bucket not in IMAGE_BUCKETS:
+        raise JobError(f"no renditions for bucket {bucket!r}")
+    try:
+        return {"renditions": len(build_all(bucket, file_id))}
+    except RenditionError as exc:
+        raise JobError(str(exc)) from exc
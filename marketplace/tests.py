@@ -1,3 +1,763 @@
-from django.test import TestCase
+import base64
+import hashlib
+import io
+import os
+import stat
+import tempfile
+import time
+import unittest
+import zipfile
+from datetime import datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+import gridfs
+from bson import ObjectId
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase
+from pymongo.errors import PyMongoError
+
+from . import bundles, db as db_module, jobs, media, models, profiling, views
+from .archives import inspect_archive
+from .bundles import _arcname, _compression
+from .cache import DocumentCache, doc_cache
+from .counters import DownloadCounter
+from .importprofile import IMPORT_TIME_BUDGET_MS, profile_imports
+from .media import IMMUTABLE_PUBLIC, RangeNotSatisfiable, parse_range
+from .models import cursor_decode, cursor_encode, page_query
+from .profiling import command_shape
+from .search import SearchIndex, _within_one_edit, tokenize
+from .views import _sniff_content_type
+
+
+class MongoTestCase(SimpleTestCase):
+    """Runs against a scratch database, one per test.
+
+    Uses the server at MONGO_TEST_URI when set, otherwise mongomock if it is
+    installed; without either the tests are skipped. Tests of features mongomock
+    lacks call ``requires_server()``.
+    """
+    mocked = False
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        uri = os.environ.get("MONGO_TEST_URI")
+        if uri:
+            connections = db_module.MongoConnections(uri=uri, db_name="modmarket_test")
+            try:
+                connections.client.admin.command("ping")
+            except PyMongoError as exc:
+                raise unittest.SkipTest(f"MongoDB at MONGO_TEST_URI unavailable: {exc}")
+        else:
+            try:
+                import mongomock
+                import mongomock.gridfs
+            except ImportError:
+                raise unittest.SkipTest("set MONGO_TEST_URI or install mongomock")
+            mongomock.gridfs.enable_gridfs_integration()
+            cls.mocked = True
+            connections = mock.Mock(database=mongomock.MongoClient()["modmarket_test"])
+        cls._connections = mock.patch.object(db_module, "connections", connections)
+        cls._connections.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._connections.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        database = db_module.get_db()
+        for name in database.list_collection_names():
+            database.drop_collection(name)
+        db_module.ensure_indexes()
+        doc_cache.clear()
+
+    def requires_server(self, feature):
+        if self.mocked:
+            self.skipTest(f"mongomock doesn't support {feature}; set MONGO_TEST_URI")
+
+
+class ImportTimeBudgetTests(SimpleTestCase):
+    """Worker boot must not block on MongoDB or heavy optional imports."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.profile = profile_imports()
+        cls.modules = {name for name, *_ in cls.profile["modules"]}
+
+    @unittest.skipUnless(os.environ.get("IMPORT_TIME_TEST"), "set IMPORT_TIME_TEST=1 to check wall-clock import time")
+    def test_project_imports_within_budget(self):
+        # twice the budget: shared CI runners are noisy, regressions are not subtle
+        self.assertLess(self.profile["wall_ms"], 2 * IMPORT_TIME_BUDGET_MS)
+
+    def test_boot_skips_optional_heavy_imports(self):
+        # Pillow is loaded on the first rendition, not at boot.
+        self.assertFalse({name for name in self.modules if name == "PIL" or name.startswith("PIL.")})
+
+    def test_sync_boot_skips_motor(self):
+        if getattr(settings, "ASYNC_VIEWS", False):
+            self.skipTest("async views import Motor")
+        self.assertNotIn("motor", self.modules)
+        self.assertNotIn("marketplace.async_db", self.modules)
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_ranges(self):
+        self.assertEqual(parse_range("bytes=0-99", 1000), (0, 99))
+        self.assertEqual(parse_range("bytes=900-", 1000), (900, 999))
+        self.assertEqual(parse_range("bytes=-100", 1000), (900, 999))
+        self.assertEqual(parse_range("bytes=-5000", 1000), (0, 999))
+        self.assertEqual(parse_range("bytes=990-5000", 1000), (990, 999))
+
+    def test_ignored_headers(self):
+        for header in (None, "", "bytes=-", "items=0-1", "bytes=0-1,5-6", "bytes=a-b"):
+            self.assertIsNone(parse_range(header, 1000), header)
+
+    def test_unsatisfiable(self):
+        for header in ("bytes=1000-", "bytes=5-2", "bytes=-0"):
+            with self.assertRaises(RangeNotSatisfiable, msg=header):
+                parse_range(header, 1000)
+
+
+class CursorTests(SimpleTestCase):
+    def test_round_trip(self):
+        created = datetime(2024, 5, 1, 12, 30)
+        token = cursor_encode({"_id": "abc", "created_at": created}, "created_at")
+        self.assertEqual(cursor_decode(token), (created, "abc"))
+        self.assertEqual(cursor_decode(cursor_encode({"_id": "abc"}, "price")), (None, "abc"))
+
+    def test_malformed_tokens(self):
+        invalid_oid = base64.urlsafe_b64encode(b'[{"$oid": "bad"}, "x"]').decode()
+        for token in ("!!!", "bm90IGpzb24", base64.urlsafe_b64encode(b"[1, 2, 3]").decode(), invalid_oid):
+            self.assertIsNone(cursor_decode(token), token)
+
+    def test_page_query_includes_null_sort_values(self):
+        query, sort, skip, backwards = page_query({}, "price", 1, 40, after=cursor_encode({"_id": "a"}, "price"))
+        self.assertEqual((sort, skip, backwards), ([("price", 1), ("_id", 1)], 0, False))
+        self.assertIn({"price": {"$ne": None}}, query["$and"][1]["$or"])
+        query, *_ = page_query({}, "price", -1, 0, after=cursor_encode({"_id": "a", "price": 3}, "price"))
+        self.assertIn({"price": None}, query["$and"][1]["$or"])
+
+
+class SearchTests(SimpleTestCase):
+    def test_tokenize(self):
+        self.assertEqual(tokenize("The Quick, brown fox!"), ["quick", "brown", "fox"])
+        self.assertEqual(tokenize(["Tag One", "two"]), ["tag", "one", "two"])
+        self.assertEqual(tokenize(None), [])
+
+    def test_within_one_edit(self):
+        for a, b in [("kitten", "kitten"), ("kitten", "sitten"), ("abcd", "abdc"), ("abc", "abcd"), ("abcd", "acd")]:
+            self.assertTrue(_within_one_edit(a, b), (a, b))
+        for a, b in [("abc", "xyz"), ("abc", "a"), ("abcd", "badc"), ("abcd", "dcba")]:
+            self.assertFalse(_within_one_edit(a, b), (a, b))
+
+    def _index(self, *products):
+        index = SearchIndex()
+        for product in products:
+            index.index_product({"status": "approved", **product})
+        index._loaded, index._synced_at = True, time.monotonic()  # no Mongo sync
+        return index
+
+    def test_bm25_ranking(self):
+        index = self._index(
+            {"_id": "title", "title": "Dragon Quest Mod", "description": "adds quests"},
+            {"_id": "body", "title": "Texture pack", "description": "a dragon appears in the sky"},
+            {"_id": "other", "title": "Space Shooter", "description": "lasers"},
+            {"_id": "hidden", "title": "Dragon", "status": "pending"},
+        )
+        self.assertEqual([pid for pid, _ in index.search("dragon")], ["title", "body"])
+        self.assertEqual([pid for pid, _ in index.search("drag")], ["title", "body"])  # prefix
+        self.assertEqual(index.search("dargon")[0][0], "title")  # transposed letters
+        self.assertEqual(index.search("the"), [])
+
+    def test_remove(self):
+        index = self._index({"_id": "a", "title": "Dragon"}, {"_id": "b", "title": "Dragon slayer"})
+        index.remove("a")
+        self.assertEqual([pid for pid, _ in index.search("dragon")], ["b"])
+        index.index_product({"_id": "b", "title": "Dragon slayer", "status": "rejected"})
+        self.assertEqual(index.search("dragon"), [])
+
+
+class SniffContentTypeTests(SimpleTestCase):
+    def test_magic_bytes(self):
+        self.assertEqual(_sniff_content_type(b"\x89PNG\r\n\x1a\n....", "application/octet-stream"), "image/png")
+        self.assertEqual(_sniff_content_type(b"%PDF-1.7", "image/png"), "application/pdf")
+        self.assertEqual(_sniff_content_type(b"PK\x03\x04....", "application/zip"), "application/zip")
+        # APKs are ZIPs but keep their generic declared type
+        self.assertEqual(_sniff_content_type(b"PK\x03\x04....", "application/octet-stream"), "application/octet-stream")
+
+    def test_text(self):
+        self.assertEqual(_sniff_content_type("MIT License é".encode(), "text/plain"), "text/plain")
+        # a multi-byte character cut off at the end of the sniffed block
+        self.assertEqual(_sniff_content_type("abc é".encode()[:-1], "text/plain"), "text/plain")
+        with self.assertRaises(ValueError):
+            _sniff_content_type(b"\x00\xff\xfe\x00binary data here", "text/plain")
+
+    def test_unknown(self):
+        self.assertEqual(_sniff_content_type(b"\x00\x01", "application/octet-stream"), "application/octet-stream")
+        with self.assertRaises(ValueError):
+            _sniff_content_type(b"GIF89a", "image/gif")
+
+
+class InspectArchiveTests(SimpleTestCase):
+    def _zip(self, entries):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as archive:
+            for info, data in entries:
+                archive.writestr(info, data)
+        buf.seek(0)
+        return buf
+
+    def test_clean_archive(self):
+        issues, result = inspect_archive(self._zip([("mod/main.lua", b"print('hi')\n" * 10), ("README", b"read me")]))
+        self.assertEqual(issues, [])
+        self.assertEqual(result["archive"]["entry_count"], 2)
+        self.assertEqual([e["name"] for e in result["archive"]["entries"]], ["mod/main.lua", "README"])
+
+    def test_not_an_archive(self):
+        self.assertEqual(inspect_archive(io.BytesIO(b"plain text")), ([], {}))
+
+    def test_unsafe_paths(self):
+        issues, _ = inspect_archive(self._zip([("../evil.sh", b"x"), ("/etc/passwd", b"x"), ("ok/../../up", b"x")]))
+        self.assertIn("path traversal: ../evil.sh", issues)
+        self.assertIn("absolute path: /etc/passwd", issues)
+        self.assertIn("path traversal: ok/../../up", issues)
+
+    def test_symlink(self):
+        link = zipfile.ZipInfo("link")
+        link.external_attr = (stat.S_IFLNK | 0o777) << 16
+        issues, _ = inspect_archive(self._zip([(link, b"/etc/passwd")]))
+        self.assertIn("symlink: link", issues)
+
+    def test_compression_ratio(self):
+        issues, result = inspect_archive(self._zip([("zeros.bin", b"\0" * (4 * 1024 * 1024))]))
+        self.assertTrue(any(issue.startswith("compression ratio") for issue in issues), issues)
+        self.assertGreater(result["archive"]["ratio"], 100)
+
+    def test_entry_inflating_past_declared_size(self):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("small.txt", os.urandom(64 * 1024))
+            archive.infolist()[0].file_size = 100  # the central directory now lies
+        issues, _ = inspect_archive(buf)
+        self.assertIn("entry inflates past its declared size: small.txt", issues)
+
+    def test_only_suspicious_entries_are_inflated(self):
+        ok = self._zip([("mod/main.lua", b"print('hi')\n" * 10000), ("blob", os.urandom(256 * 1024))])
+        with mock.patch("marketplace.archives._inflated_size") as inflate:
+            self.assertEqual(inspect_archive(ok)[0], [])
+        inflate.assert_not_called()
+
+        with mock.patch("marketplace.archives._inflated_size", return_value=0) as inflate:
+            inspect_archive(self._zip([("zeros.bin", b"\0" * (4 * 1024 * 1024))]))
+        self.assertEqual(inflate.call_count, 1)
+
+
+
+class DiskResponseTests(SimpleTestCase):
+    def setUp(self):
+        handle = tempfile.NamedTemporaryFile(delete=False)
+        handle.write(b"0123456789")
+        handle.close()
+        self.addCleanup(os.unlink, handle.name)
+        self.path = handle.name
+        self.meta = {"file_id": str(ObjectId()), "length": 10, "filename": "f.bin"}
+
+    def _respond(self, request):
+        with mock.patch.object(media.DiskFile, "close", autospec=True, side_effect=media.DiskFile.close) as close:
+            response = media._disk_response(request, self.path, self.meta, False, '"etag"', IMMUTABLE_PUBLIC)
+        return response, close
+
+    def test_bodyless_responses_close_the_file(self):
+        factory = RequestFactory()
+        for request, status in [
+            (factory.head("/"), 200),
+            (factory.get("/", HTTP_RANGE="bytes=0-1", HTTP_IF_NONE_MATCH='"etag"'), 304),
+            (factory.get("/", HTTP_RANGE="bytes=50-60"), 416),
+        ]:
+            response, close = self._respond(request)
+            self.assertEqual(response.status_code, status)
+            close.assert_called_once()
+
+    def test_range_body_closes_after_streaming(self):
+        response, close = self._respond(RequestFactory().get("/", HTTP_RANGE="bytes=2-4"))
+        close.assert_not_called()
+        self.assertEqual(b"".join(response.streaming_content), b"234")
+
+
+class BundleTests(SimpleTestCase):
+    def test_arcname(self):
+        taken = set()
+        self.assertEqual(_arcname("main", "mod.zip", taken), "main/mod.zip")
+        self.assertEqual(_arcname("main", "mod.zip", taken), "main/mod (2).zip")
+        self.assertEqual(_arcname("main", "mod.zip", taken), "main/mod (3).zip")
+        self.assertEqual(_arcname("main", "..\\..\\evil.exe", taken), "main/evil.exe")
+        self.assertEqual(_arcname("docs", "a<b>:c?.txt", taken), "docs/a_b_c_.txt")
+        self.assertEqual(_arcname("docs", "", taken), "docs/file")
+
+    def test_compression(self):
+        self.assertEqual(_compression("mod.APK", None), zipfile.ZIP_STORED)
+        self.assertEqual(_compression("shot", "image/png"), zipfile.ZIP_STORED)
+        self.assertEqual(_compression("README.md", "text/markdown"), zipfile.ZIP_DEFLATED)
+        self.assertEqual(_compression(None, None), zipfile.ZIP_DEFLATED)
+
+    def test_zip_stream_round_trip(self):
+        blobs = {ObjectId(): os.urandom(600 * 1024), ObjectId(): b"hello world\n" * 5000}
+        missing = ObjectId()
+
+        class StubGridOut(io.BytesIO):
+            chunk_size = 255 * 1024
+            upload_date = datetime(2024, 1, 2, 3, 4, 5)
+
+            def __init__(self, data):
+                super().__init__(data)
+                self.length = len(data)
+
+        class StubGridFS:
+            def __init__(self, database, collection):
+                pass
+
+            def get(self, file_id):
+                if file_id not in blobs:
+                    raise gridfs.NoFile(file_id)
+                return StubGridOut(blobs[file_id])
+
+        (bin_id, bin_data), (text_id, text_data) = blobs.items()
+        members = [
+            {"name": "main/mod.bin", "bucket": "products", "file_id": str(bin_id), "compression": zipfile.ZIP_STORED},
+            {"name": "docs/gone.txt", "bucket": "products", "file_id": str(missing), "compression": zipfile.ZIP_DEFLATED},
+            {"name": "license/LICENSE", "bucket": "license", "file_id": str(text_id), "compression": zipfile.ZIP_DEFLATED},
+        ]
+        with mock.patch.object(bundles.gridfs, "GridFS", StubGridFS), mock.patch.object(bundles, "get_db"), \
+                self.assertLogs("marketplace.bundles", "WARNING"):
+            parts = list(bundles._zip_stream(members))
+        self.assertLessEqual(max(len(p) for p in parts), 2 * StubGridOut.chunk_size)
+
+        with zipfile.ZipFile(io.BytesIO(b"".join(parts))) as archive:
+            self.assertEqual(archive.namelist(), ["main/mod.bin", "license/LICENSE"])
+            self.assertEqual(archive.read("main/mod.bin"), bin_data)
+            self.assertEqual(archive.read("license/LICENSE"), text_data)
+            self.assertEqual(archive.getinfo("main/mod.bin").compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(archive.getinfo("license/LICENSE").compress_type, zipfile.ZIP_DEFLATED)
+            self.assertIsNone(archive.testzip())
+
+
+class CommandShapeTests(SimpleTestCase):
+    def test_literals_are_erased(self):
+        a = command_shape("find", {"find": "products", "filter": {"_id": "x", "tags": {"$in": [1, 2, 3]}}})
+        b = command_shape("find", {"find": "products", "filter": {"_id": "y", "tags": {"$in": [4]}}})
+        self.assertEqual(a, b)
+        self.assertEqual(a, '{"_id": "?", "tags": {"$in": ["?"]}}')
+        self.assertNotEqual(a, command_shape("find", {"find": "products", "filter": {"status": "approved"}}))
+
+    def test_commands(self):
+        self.assertEqual(command_shape("count", {"count": "reviews", "query": {"product_id": 1}}), '{"product_id": "?"}')
+        self.assertEqual(
+            command_shape("update", {"update": "products", "updates": [{"q": {"_id": "p"}, "u": {"$inc": {"n": 1}}}]}),
+            '{"_id": "?"}',
+        )
+        self.assertEqual(command_shape("insert", {"insert": "jobs", "documents": [{}]}), "null")
+        self.assertEqual(
+            command_shape("aggregate", {"pipeline": [{"$match": {"status": "approved"}}, {"$limit": 5}]}),
+            '[{"$match": {"status": "?"}}, {"$limit": "?"}]',
+        )
+
+
+class BackoffTests(SimpleTestCase):
+    def test_exponential_and_capped(self):
+        with mock.patch.object(jobs.random, "uniform", side_effect=lambda low, high: high):
+            self.assertEqual(jobs.backoff_delay(0), jobs.JOB_BACKOFF_BASE)
+            self.assertEqual(jobs.backoff_delay(1), jobs.JOB_BACKOFF_BASE)
+            self.assertEqual(jobs.backoff_delay(3), min(jobs.JOB_BACKOFF_MAX, jobs.JOB_BACKOFF_BASE * 4))
+            self.assertEqual(jobs.backoff_delay(200), jobs.JOB_BACKOFF_MAX)
+
+    def test_jitter_within_bounds(self):
+        for attempts in range(1, 12):
+            delay = jobs.backoff_delay(attempts)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(jobs.JOB_BACKOFF_MAX, jobs.JOB_BACKOFF_BASE * 2 ** (attempts - 1)))
+
+
+class MongoFixtureTests(MongoTestCase):
+    def test_scratch_database(self):
+        database = db_module.get_db()
+        self.assertEqual(database.name, "modmarket_test")
+        self.assertEqual(database.products.count_documents({}), 0)
+        self.assertEqual(db_module.applied_index_version(), db_module.INDEX_VERSION)
+
+
+class DocumentCacheTests(SimpleTestCase):
+    def setUp(self):
+        caches["default"].clear()
+
+    def _worker(self):
+        return DocumentCache(ttl=60, backend="default")
+
+    def test_shared_tier(self):
+        self.assertEqual(self._worker().get("product", "p1", lambda: {"v": 1}), {"v": 1})
+        self.assertEqual(self._worker().get("product", "p1", mock.Mock(side_effect=AssertionError)), {"v": 1})
+
+        self._worker().invalidate("product", "p1")
+        self.assertEqual(self._worker().get("product", "p1", lambda: {"v": 2}), {"v": 2})
+
+    def test_clear_reaches_the_shared_tier(self):
+        worker = self._worker()
+        worker.get("product", "p1", lambda: {"v": 1})
+        worker.get("developer", "d1", lambda: {"v": 1})
+
+        worker.clear("product")
+        self.assertEqual(self._worker().get("product", "p1", lambda: {"v": 2}), {"v": 2})
+        self.assertEqual(self._worker().get("developer", "d1", lambda: {"v": 2}), {"v": 1})
+
+        worker.clear()
+        self.assertEqual(self._worker().get("product", "p1", lambda: {"v": 3}), {"v": 3})
+        self.assertEqual(self._worker().get("developer", "d1", lambda: {"v": 3}), {"v": 3})
+
+
+class QueryProfilerMiddlewareTests(SimpleTestCase):
+    def _get_thumbnail(self, **settings_overrides):
+        response = HttpResponse(b"png", content_type="image/png")
+        response["Cache-Control"] = IMMUTABLE_PUBLIC
+        with mock.patch.object(views, "serve_gridfs", return_value=response), \
+                mock.patch.multiple(profiling, **settings_overrides):
+            return self.client.get(f"/thumbnail/{ObjectId()}/")
+
+    def test_anonymous_media_stays_publicly_cacheable(self):
+        response = self._get_thumbnail(MONGO_PROFILE_SERVER_TIMING=False)
+        self.assertEqual(response["Cache-Control"], IMMUTABLE_PUBLIC)
+        self.assertNotIn("Cookie", response.get("Vary", ""))
+        self.assertNotIn("Server-Timing", response)
+
+    def test_server_timing_setting(self):
+        response = self._get_thumbnail(MONGO_PROFILE_SERVER_TIMING=True)
+        self.assertRegex(response["Server-Timing"], r'^mongo;dur=[\d.]+;desc="0 commands", app;dur=[\d.]+$')
+        self.assertNotIn("Cookie", response.get("Vary", ""))
+
+
+class BundleManifestTests(MongoTestCase):
+    def _add_file(self, product_id, data, filename="mod.bin"):
+        file_id = gridfs.GridFS(db_module.get_db(), collection="products").put(data, filename=filename)
+        return models.product_file_add(product_id, "main", str(file_id), filename, len(data))
+
+    def test_manifest_is_cached_until_files_change(self):
+        self._add_file("p1", b"first")
+        signature, members = bundles.bundle_members("p1")
+        self.assertEqual([m["name"] for m in members], ["main/mod.bin"])
+        with mock.patch.object(bundles, "_manifest") as manifest:
+            self.assertEqual(bundles.bundle_members("p1"), (signature, members))
+        manifest.assert_not_called()
+
+        self._add_file("p1", b"second", filename="extra.txt")
+        new_signature, members = bundles.bundle_members("p1")
+        self.assertNotEqual(new_signature, signature)
+        self.assertEqual(len(members), 2)
+
+    def test_same_members_stream_the_same_bytes(self):
+        self._add_file("p1", b"payload" * 1000)
+        _, members = bundles.bundle_members("p1")
+        first = b"".join(bundles.stream_bundle(members))
+        self.assertEqual(b"".join(bundles.stream_bundle(members)), first)
+        with zipfile.ZipFile(io.BytesIO(first)) as archive:
+            self.assertEqual(archive.read("main/mod.bin"), b"payload" * 1000)
+        self.assertNotIn("bundles.files", db_module.get_db().list_collection_names())
+
+
+class DownloadBucketTests(SimpleTestCase):
+    def test_only_product_buckets_are_served(self):
+        with mock.patch.object(views, "serve_gridfs", return_value=HttpResponse(b"data")) as serve:
+            self.assertEqual(self.client.get(f"/file/{ObjectId()}/avatars/download/").status_code, 404)
+            self.assertEqual(self.client.get(f"/file/{ObjectId()}/fs/download/").status_code, 404)
+            serve.assert_not_called()
+            self.assertEqual(self.client.get(f"/file/{ObjectId()}/license/download/").status_code, 200)
+
+
+class RatingAggregateTests(MongoTestCase):
+    def _product(self, **fields):
+        pid = str(ObjectId())
+        db_module.db.products.insert_one({"_id": pid, "title": "Mod", "status": "approved", **fields})
+        return pid
+
+    def test_review_add_updates_running_aggregates(self):
+        self.requires_server("$round in update pipelines")
+        pid = self._product(rating_sum=0, rating_count=0, review_count=0, rating=0.0)
+        models.review_add(1, pid, 5)
+        models.review_add(2, pid, 4)
+        product = db_module.db.products.find_one({"_id": pid})
+        self.assertEqual((product["rating_sum"], product["rating_count"], product["review_count"]), (9, 2, 2))
+        self.assertEqual(product["rating"], 4.5)
+        self.assertEqual(product["rating_histogram"], {"5": 1, "4": 1})
+
+    def test_review_add_seeds_missing_aggregates_from_existing_reviews(self):
+        pid = self._product(rating=5.0)
+        db_module.db.reviews.insert_many([
+            {"user_id": 1, "product_id": ObjectId(pid), "rating": 5},
+            {"user_id": 2, "product_id": ObjectId(pid), "rating": 4},
+        ])
+        models.review_add(3, pid, 1)
+        product = db_module.db.products.find_one({"_id": pid})
+        self.assertEqual((product["rating_sum"], product["rating_count"], product["review_count"]), (10, 3, 3))
+        self.assertEqual(product["rating"], 3.33)
+
+    def test_rebuild_missing_only(self):
+        rated = self._product(rating_sum=3, rating_count=1, review_count=1, rating=3.0)
+        unrated = self._product()
+        for pid in (rated, unrated):
+            db_module.db.reviews.insert_one({"user_id": 1, "product_id": ObjectId(pid), "rating": 4})
+        self.assertEqual(models.ratings_rebuild(missing_only=True), 1)
+        self.assertEqual(db_module.db.products.find_one({"_id": rated})["rating"], 3.0)
+        self.assertEqual(db_module.db.products.find_one({"_id": unrated})["rating"], 4.0)
+        self.assertEqual(models.ratings_rebuild(missing_only=True), 0)
+
+
+class BlobIndexTests(MongoTestCase):
+    def _store(self, bucket, data):
+        file_id = str(gridfs.GridFS(db_module.get_db(), collection=bucket).put(data))
+        return file_id, models.blob_register(bucket, hashlib.sha256(data).hexdigest(), file_id, len(data))
+
+    def _exists(self, bucket, file_id):
+        return gridfs.GridFS(db_module.get_db(), collection=bucket).exists(ObjectId(file_id))
+
+    def test_shared_blob_is_deleted_with_its_last_reference(self):
+        first, canonical = self._store("products", b"same bytes")
+        _, again = self._store("products", b"same bytes")
+        self.assertEqual((canonical, again), (first, first))
+        self.assertEqual(db_module.db.blob_index.find_one({"file_id": first})["refcount"], 2)
+
+        models.blob_release("products", first)
+        self.assertTrue(self._exists("products", first))
+        models.blob_release("products", first)
+        self.assertFalse(self._exists("products", first))
+        self.assertIsNone(db_module.db.blob_index.find_one({"file_id": first}))
+
+    def test_reclaim_skips_a_blob_that_was_referenced_again(self):
+        file_id, _ = self._store("products", b"bytes")
+        key = db_module.db.blob_index.find_one({"file_id": file_id})["_id"]
+        models.blob_reclaim(key, "products", file_id)  # refcount is still 1
+        self.assertTrue(self._exists("products", file_id))
+
+        db_module.db.blob_index.update_one({"_id": key}, {"$set": {"refcount": 0}})
+        models.blob_reclaim(key, "products", file_id)
+        self.assertFalse(self._exists("products", file_id))
+
+    def test_unindexed_blob_is_deleted_on_release(self):
+        file_id = str(gridfs.GridFS(db_module.get_db(), collection="avatars").put(b"old upload"))
+        models.blob_release("avatars", file_id)
+        self.assertFalse(self._exists("avatars", file_id))
+
+    def test_developer_delete_releases_the_avatar(self):
+        file_id, _ = self._store("avatars", b"avatar")
+        db_module.db.developers.insert_one({"_id": "d1", "avatar_path": file_id, "avatar_bucket": "avatars"})
+        models.developer_delete("d1")
+        self.assertIsNone(db_module.db.developers.find_one({"_id": "d1"}))
+        self.assertFalse(self._exists("avatars", file_id))
+
+
+class SearchIndexSyncTests(MongoTestCase):
+    def _product(self, pid, title, updated_at, status="approved", download_count=0):
+        db_module.db.products.insert_one({
+            "_id": pid, "title": title, "status": status, "updated_at": updated_at, "download_count": download_count,
+        })
+
+    def test_searches_fall_back_to_mongo_until_the_index_is_built(self):
+        self._product("a", "Dragon Quest", datetime(2024, 1, 1), download_count=5)
+        self._product("b", "Dragon Rider", datetime(2024, 1, 1), download_count=9)
+        self._product("c", "Dragon Pending", datetime(2024, 1, 1), status="pending")
+        index = SearchIndex()
+        with mock.patch.object(index, "warm_in_background") as warm:
+            self.assertEqual([pid for pid, _ in index.search("dragon")], ["b", "a"])
+        warm.assert_called_once()
+
+        index.warm_in_background().join()
+        self.assertEqual({pid for pid, _ in index.search("dragon")}, {"a", "b"})
+
+    def test_sync_picks_up_writes_in_the_same_millisecond(self):
+        stamp = datetime(2024, 1, 1, 12, 0, 0, 123000)
+        self._product("a", "Alpha", stamp)
+        index = SearchIndex()
+        index.rebuild()
+        # another worker writes in the millisecond the index already saw
+        self._product("b", "Beta", stamp)
+        with mock.patch.object(index, "index_product", wraps=index.index_product) as indexed:
+            index.sync(force=True)
+        self.assertEqual([c.args[0]["_id"] for c in indexed.call_args_list], ["b"])
+        self.assertEqual([pid for pid, _ in index.search("beta")], ["b"])
+
+    def test_local_update_with_microseconds_does_not_hide_other_writes(self):
+        index = SearchIndex()
+        index.rebuild()
+        index.update({"_id": "a", "title": "Alpha", "status": "approved",
+                      "updated_at": datetime(2024, 1, 1, 12, 0, 0, 123456)})
+        self._product("b", "Beta", datetime(2024, 1, 1, 12, 0, 0, 123000))
+        index.sync(force=True)
+        self.assertEqual([pid for pid, _ in index.search("beta")], ["b"])
+
+
+class BatchLoaderTests(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        database = db_module.get_db()
+        database.users.insert_many([{"_id": "u1", "user_id": 1}, {"_id": "u2", "user_id": 2}])
+        database.developers.insert_many([{"_id": "d1", "user_id": 1}, {"_id": "d2", "user_id": 2}])
+        database.categories.insert_many([{"_id": "c1", "category": "Maps"}, {"_id": "c2", "category": "Tools"}])
+        self.products = [
+            {"_id": "p1", "developer_id": "d1", "category": ["Maps"]},
+            {"_id": "p2", "developer_id": "d2", "category": ["Maps", "Tools"]},
+            {"_id": "p3", "developer_id": "d1", "category": ["Gone"]},
+        ]
+
+    def _finds(self):
+        collection_type = type(db_module.get_db().products)
+        return mock.patch.object(collection_type, "find", autospec=True, side_effect=collection_type.find)
+
+    def test_one_query_per_collection(self):
+        loader = models.batch_loader()
+        with self._finds() as find:
+            loader.attach_developers(self.products)
+            loader.attach_categories(self.products)
+        self.assertEqual(sorted(c.args[0].name for c in find.call_args_list), ["categories", "developers", "users"])
+        self.assertEqual([p["developer"]["_id"] for p in self.products], ["d1", "d2", "d1"])
+        self.assertEqual([p["user"]["_id"] for p in self.products], ["u1", "u2", "u1"])
+        self.assertEqual([[c["_id"] for c in p["categories"]] for p in self.products], [["c1"], ["c1", "c2"], []])
+
+        with self._finds() as find:
+            loader.attach_developers(self.products)
+            loader.attach_categories(self.products)
+        find.assert_not_called()  # misses ("Gone") are remembered too
+
+
+class DownloadCounterFlushTests(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        db_module.db.products.insert_many([{"_id": "p1", "download_count": 0}, {"_id": "p2", "download_count": 0}])
+        self.counter = DownloadCounter(interval=3600, max_pending=10_000)
+
+    def _counts(self):
+        return {p["_id"]: p["download_count"] for p in db_module.db.products.find()}
+
+    def test_flush_counts_first_downloads_only(self):
+        db_module.db.downloads.insert_one({"_id": "old", "user_id": 3, "product_id": "p1"})
+        for user_id, product_id in [(1, "p1"), (1, "p1"), (2, "p1"), (1, "p2"), (3, "p1")]:
+            self.counter.record(product_id, user_id)
+        self.assertEqual(self.counter.flush(), 3)
+        self.assertEqual(self._counts(), {"p1": 2, "p2": 1})
+        self.assertEqual(db_module.db.downloads.count_documents({}), 4)
+
+        self.counter.record("p1", 1)  # already counted in an earlier flush
+        self.assertEqual(self.counter.flush(), 0)
+        self.assertEqual(self._counts(), {"p1": 2, "p2": 1})
+
+    def test_failed_flush_is_retried(self):
+        self.counter.record("p1", 1)
+        with mock.patch.object(type(db_module.get_db().products), "bulk_write", side_effect=PyMongoError("down")):
+            with self.assertRaises(PyMongoError):
+                self.counter.flush()
+        self.assertEqual(self.counter.pending(), 1)
+        self.assertEqual(self.counter.flush(), 1)
+        self.assertEqual(self._counts(), {"p1": 1, "p2": 0})
+
+
+class CategoryStatsTests(MongoTestCase):
+    def _counts(self):
+        return {c["category"]: c["count"] for c in models.category_facets()}
+
+    def test_counts_follow_status_and_category_changes(self):
+        pid = models.product_create({"title": "Mod", "category": ["Maps", "Tools"]})
+        self.assertEqual(self._counts(), {})
+
+        models.product_update(pid, {"status": "approved"})
+        self.assertEqual(self._counts(), {"Maps": 1, "Tools": 1})
+
+        models.product_update(pid, {"category": ["Tools", "Art"]})
+        self.assertEqual(self._counts(), {"Art": 1, "Tools": 1})
+
+        models.product_update(pid, {"status": "rejected", "category": ["Maps"]})
+        self.assertEqual(self._counts(), {})
+
+        models.product_update(pid, {"status": "approved"})
+        models.product_create({"title": "Other", "category": ["Maps"], "status": "approved"})
+        self.assertEqual(self._counts(), {"Maps": 2})
+
+        models.product_delete(pid)
+        self.assertEqual(self._counts(), {"Maps": 1})
+
+
+class JobQueueTests(MongoTestCase):
+    def _expire(self, job_id, field):
+        db_module.db.jobs.update_one({"_id": job_id}, {"$set": {field: datetime.now() - timedelta(seconds=1)}})
+
+    def test_claim_takes_each_due_job_once_in_order(self):
+        later = jobs.enqueue("scan_file", {"n": 2}, run_at=datetime.now() - timedelta(seconds=5))
+        first = jobs.enqueue("scan_file", {"n": 1}, run_at=datetime.now() - timedelta(seconds=10))
+        jobs.enqueue("scan_file", {"n": 3}, run_at=datetime.now() + timedelta(hours=1))
+        claimed = [jobs.claim("w1"), jobs.claim("w2"), jobs.claim("w3")]
+        self.assertEqual([job and job["_id"] for job in claimed], [first, later, None])
+        self.assertEqual((claimed[0]["status"], claimed[0]["attempts"], claimed[0]["locked_by"]), ("running", 1, "w1"))
+        self.assertIsNone(jobs.claim("w1", kinds=["build_renditions"]))
+
+    def test_expired_lock_is_claimed_by_another_worker(self):
+        job_id = jobs.enqueue("scan_file")
+        jobs.claim("w1")
+        self.assertIsNone(jobs.claim("w2"))
+        self._expire(job_id, "locked_until")
+        job = jobs.claim("w2")
+        self.assertEqual((job["_id"], job["attempts"], job["locked_by"]), (job_id, 2, "w2"))
+        jobs.complete(job, "w1")  # the old owner can no longer finish it
+        self.assertEqual(db_module.db.jobs.find_one({"_id": job_id})["status"], "running")
+
+    def test_retry_then_fail(self):
+        job_id = jobs.enqueue("scan_file", max_attempts=2)
+        with mock.patch.object(jobs, "backoff_delay", return_value=60):
+            self.assertTrue(jobs.fail(jobs.claim("w1"), "w1", ValueError("boom")))
+            retried = db_module.db.jobs.find_one({"_id": job_id})
+            self.assertEqual((retried["status"], retried["last_error"]), ("queued", "ValueError: boom"))
+            self.assertIsNone(jobs.claim("w1"))  # backing off
+
+            self._expire(job_id, "run_at")
+            self.assertFalse(jobs.fail(jobs.claim("w1"), "w1", "boom again"))
+        self.assertEqual(db_module.db.jobs.find_one({"_id": job_id})["status"], "failed")
+        self.assertIsNone(jobs.claim("w1"))
+        self.assertEqual(jobs.stats()["failed"], 1)
+
+
+class KeysetPaginationTests(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        prices = {"a": 5.0, "b": None, "c": 1.0, "d": 5.0, "e": None, "f": 0.0, "g": 5.0}
+        db_module.db.products.insert_many([
+            {"_id": pid, "title": pid, "status": "approved", **({} if pid == "e" else {"price": price})}
+            for pid, price in prices.items()
+        ])
+        # nulls and missing values sort first, ties break on _id
+        self.ascending = ["b", "e", "f", "c", "a", "d", "g"]
+
+    def _page(self, sort_dir, after=None, before=None):
+        query, sort, skip, backwards = models.page_query({"status": "approved"}, "price", sort_dir, after=after, before=before)
+        docs = list(db_module.db.products.find(query, {"price": 1}).sort(sort).skip(skip).limit(3))
+        return models.page_result(docs, 2, backwards)
+
+    def _walk(self, sort_dir):
+        ids, cursor = [], None
+        while True:
+            docs, has_more = self._page(sort_dir, after=cursor)
+            ids += [d["_id"] for d in docs]
+            if not has_more:
+                return ids, docs[-1]
+            cursor = models.cursor_encode(docs[-1], "price")
+
+    def _walk_back(self, sort_dir, last):
+        ids, cursor = [], models.cursor_encode(last, "price")
+        while True:
+            docs, has_more = self._page(sort_dir, before=cursor)
+            ids = [d["_id"] for d in docs] + ids
+            if not has_more:
+                return ids
+            cursor = models.cursor_encode(docs[0], "price")
+
+    def test_walks_cover_every_product_once(self):
+        for sort_dir, expected in [(1, self.ascending), (-1, self.ascending[::-1])]:
+            ids, last = self._walk(sort_dir)
+            self.assertEqual(ids, expected)
+            self.assertEqual(self._walk_back(sort_dir, last), expected[:-1])
@@ -1,20 +1,29 @@
+from django.conf import settings
 from django.urls import path
 from django.contrib.auth import views as auth_views
 from . import views
 from .forms import StyledAuthenticationForm
 from .forms import StyledPasswordResetForm,StyledSetPasswordForm
 
+# File serving and catalog reads have async twins for ASGI deployments.
+if settings.ASYNC_VIEWS:
+    from . import async_views as read_views
+else:
+    read_views = views
+
 urlpatterns = [
     # Public pages
     path('', views.home, name='home'),
-    path('products/', views.product_list, name='product_list'),
-    path('products/<str:pk>/', views.product_detail, name='product_detail'),
-    path('products/<str:pk>/download/', views.download_product, name='download_product'),
+    path('products/', read_views.product_list, name='product_list'),
+    path('products/<str:pk>/', read_views.product_detail, name='product_detail'),
+    path('products/<str:pk>/download/', read_views.download_product, name='download_product'),
+    path('products/<str:pk>/bundle/', views.download_bundle, name='download_bundle'),
     path('products/<str:pk>/review/', views.add_review, name='add_review'),
-    path("thumbnail/<str:file_id>/", views.serve_thumbnail, name="serve_thumbnail"),
-    path("avatar/<str:file_id>/", views.serve_avatar, name="serve_avatar"),
-    path('serve_file/<str:file_id>/', views.serve_file, name='serve_file'),
-    path('file/<str:file_id>/<str:bucket>/download/', views.download_product_file, name='download_file'),
+    path("thumbnail/<str:file_id>/", read_views.serve_thumbnail, name="serve_thumbnail"),
+    path("avatar/<str:file_id>/", read_views.serve_avatar, name="serve_avatar"),
+    path("image/<str:bucket>/<str:file_id>/<str:size>/", views.serve_image, name="serve_image"),
+    path('serve_file/<str:file_id>/', read_views.serve_file, name='serve_file'),
+    path('file/<str:file_id>/<str:bucket>/download/', read_views.download_product_file, name='download_file'),
     path('developer/<str:pk>/',views.developer_profile,name="developer_profile"),
     
     # Authentication
@@ -55,4 +64,7 @@ urlpatterns = [
     path('manage/developers/', views.admin_developer_list, name='admin_developer_list'),
     path('manage/developers/<str:pk>/delete/', views.admin_developer_delete, name='admin_developer_delete'),
     path('manage/deveopers/<str:pk>/view/',views.admin_developer_view,name="admin_developer_view"),
+    path('manage/cache-stats/', views.admin_cache_stats, name='admin_cache_stats'),
+    path('manage/pool-stats/', views.admin_pool_stats, name='admin_pool_stats'),
+    path('manage/job-stats/', views.admin_job_stats, name='admin_job_stats'),
 ]
@@ -2,35 +2,59 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth import login
-from django.contrib.auth.forms import UserCreationForm
 from django.contrib import messages
 from django.core.paginator import Paginator
-from django.http import HttpResponse, Http404
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_POST
 from django.conf import settings
-from django.utils.encoding import smart_str
 from django.utils.timezone import now
+from django.utils.cache import patch_vary_headers
+from django.utils.text import slugify
 import gridfs
 from bson import ObjectId
-import re
+from bson.errors import InvalidId
+import hashlib
+import itertools
+import logging
+from collections import Counter
 from urllib.parse import quote
 from django.contrib.admin.views.decorators import staff_member_required
-import io , zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pymongo.errors import PyMongoError
 from .forms import (
     ProductForm, DeveloperProfileForm, ReviewForm,
     ProductFileFormSet, ModerationForm,StyledUserCreationForm
 )
 from .models import (
-    categories_all, category_get,
+    category_get,
     developer_get_or_create, developer_update,
-    product_create, product_get, products_find, products_count,
-    product_inc_download, product_update, products_related,
-    product_file_add, product_file_first, product_files_for,
+    product_create, product_get, products_count,
+    products_count_cached, products_find_page, products_search_page, cursor_encode,
+    product_update, products_related,
+    product_files_for, product_file_payload, product_files_add_many,
     review_add, review_get_by_user, reviews_for_product,
-    download_get_or_create, moderation_log_add,
-    user_get,user_create,license_create,product_inc_review,refresh_product_rating,category_create
+    moderation_log_add,
+    user_get,user_create,license_create,rating_breakdown,category_create,
+    batch_loader, category_facets, category_stats_rename, product_delete,
+    product_doc, developer_get, developer_delete, user_get_by_pk,
+    blob_register, blob_release, moderation_queue_page,
+    developer_products_by_status, PRODUCT_STATUSES, product_cards
 )
-from .db import db
+from .db import db, get_db, connections
+from .jobs import enqueue_many, stats as job_stats
+from .profiling import query_budget
+from .search import catalog_index
+from .counters import download_counter
+from .cache import doc_cache
+from .blobcache import blob_cache
+from .media import (
+    gridfs_response, serve_gridfs, immutable_etag, immutable_not_modified, is_conditional, stored_last_modified,
+    not_modified_response, DOWNLOAD_BUCKETS, IMMUTABLE_PUBLIC, IMMUTABLE_PRIVATE, REVALIDATE_PRIVATE
+)
+from . import renditions
+from .bundles import bundle_etag, bundle_members, stream_bundle
+
+logger = logging.getLogger(__name__)
 
 # ------------------------
 # Constants
@@ -63,102 +87,190 @@ ALLOWED_CONTENT_TYPES = [
 # ------------------------
 # Helper Functions
 # ------------------------
-def _regex_contains(value):
-    return {"$regex": re.escape(value), "$options": "i"}
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB reads from Django's upload handler
+# Concurrent GridFS writes per upload request
+UPLOAD_WRITE_WORKERS = getattr(settings, "UPLOAD_WRITE_WORKERS", 4)
+
+# Leading bytes of the binary types we accept; the declared type is not trusted
+MAGIC_BYTES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"%PDF-", "application/pdf"),
+    (b"PK\x03\x04", "application/zip"),
+    (b"PK\x05\x06", "application/zip"),  # empty archive
+]
 
 
 def _validate_file(file):
     if file.size > MAX_UPLOAD_SIZE:
         raise ValueError("File too large.")
-    if getattr(file, "content_type", None) not in ALLOWED_CONTENT_TYPES:
-        raise ValueError(f"Unsupported file type: {getattr(file, 'content_type', 'unknown')}")
+
+
+def _sniff_content_type(head, declared):
+    for magic, content_type in MAGIC_BYTES:
+        if head.startswith(magic):
+            # APKs and other zip containers keep a more specific declared type
+            if content_type == "application/zip" and declared == "application/octet-stream":
+                return declared
+            return content_type
+    if declared == "text/plain":
+        try:
+            head.decode("utf-8")
+        except UnicodeDecodeError as exc:
+            # a multi-byte character may be cut at the end of the sniffed block
+            if exc.start < len(head) - 3:
+                raise ValueError("Unsupported file type: text/plain with binary content")
+        return declared
+    if declared == "application/octet-stream":
+        return declared
+    raise ValueError(f"Unsupported file type: {declared or 'unknown'}")
 
 
 def _save_file_to_gridfs(uploaded_file, bucket_name="products"):
-    """Save a file to MongoDB GridFS and return metadata"""
+    """Stream an upload into GridFS and return metadata.
+
+    The file is read in UPLOAD_CHUNK_SIZE pieces, so memory use is constant;
+    size limits, the SHA-256 checksum and content-type sniffing all happen in
+    that single pass. A file rejected part-way is removed from GridFS. With
+    DEDUPE_UPLOADS, content already stored in the bucket is referenced instead.
+    """
     _validate_file(uploaded_file)
-    fs = gridfs.GridFS(db, collection=bucket_name)
-    file_id = fs.put(
-        uploaded_file.read(),
-        filename=uploaded_file.name,
-        content_type=getattr(uploaded_file, "content_type", "application/octet-stream"),
-        length=getattr(uploaded_file, "size", None)
-    )
+    declared = getattr(uploaded_file, "content_type", None) or "application/octet-stream"
+    chunks = uploaded_file.chunks(UPLOAD_CHUNK_SIZE)
+    head = next(chunks, b"")
+    content_type = _sniff_content_type(head[:512], declared)
+    if content_type not in ALLOWED_CONTENT_TYPES:
+        raise ValueError(f"Unsupported file type: {content_type}")
+
+    fs = gridfs.GridFS(get_db(), collection=bucket_name)
+    grid_in = fs.new_file(filename=uploaded_file.name, content_type=content_type)
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        for chunk in itertools.chain([head], chunks):
+            size += len(chunk)
+            if size > MAX_UPLOAD_SIZE:
+                raise ValueError("File too large.")
+            sha256.update(chunk)
+            grid_in.write(chunk)
+        grid_in.sha256 = sha256.hexdigest()
+        grid_in.close()
+    except Exception:
+        grid_in.abort()
+        raise
+    file_id = str(grid_in._id)
+    if getattr(settings, "DEDUPE_UPLOADS", True):
+        canonical_id = blob_register(bucket_name, sha256.hexdigest(), file_id, size)
+        if canonical_id != file_id:
+            # identical content already stored: reference it and drop this copy
+            fs.delete(grid_in._id)
+            file_id = canonical_id
     return {
-        "file_id": str(file_id),
+        "file_id": file_id,
         "filename": uploaded_file.name,
-        "content_type": getattr(uploaded_file, "content_type", "application/octet-stream"),
-        "size": getattr(uploaded_file, "size", 0),
+        "content_type": content_type,
+        "size": size,
+        "checksum": sha256.hexdigest(),
         "bucket": bucket_name
     }
 
 
-def serve_file(file_id, bucket_name="products", inline=False):
-    """Serve a GridFS file via Django response"""
-    fs = gridfs.GridFS(db, collection=bucket_name)
+def _save_files_to_gridfs(jobs):
+    """Write ``[(uploaded_file, bucket_name), ...]`` to GridFS concurrently.
+
+    At most UPLOAD_WRITE_WORKERS files are written at once. Returns the
+    _save_file_to_gridfs metadata in ``jobs`` order; if any file fails, the ones
+    already stored are released and the first error is raised.
+    """
+    if not jobs:
+        return []
+    workers = min(UPLOAD_WRITE_WORKERS, len(jobs))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload") as pool:
+        futures = [pool.submit(_save_file_to_gridfs, f, bucket) for f, bucket in jobs]
+    saved, error = [], None
+    for future in futures:
+        try:
+            saved.append(future.result())
+        except Exception as exc:
+            error = error or exc
+    if error:
+        for entry in saved:
+            blob_release(entry["bucket"], entry["file_id"])
+        raise error
+    return saved
+
+
+def _discard_upload(product_id, saved):
+    """Undo a half-stored upload: its documents and every blob it wrote."""
+    unowned = Counter((entry["bucket"], entry["file_id"]) for entry in saved)
     try:
-        grid_out = fs.get(ObjectId(file_id))
-    except gridfs.NoFile:
-        raise Http404("File not found.")
-    response = HttpResponse(grid_out.read(), content_type=grid_out.content_type or "application/octet-stream")
-    dispo_type = "inline" if inline else "attachment"
-    response["Content-Disposition"] = f'{dispo_type}; filename="{quote(grid_out.filename)}"'
-    return response
+        if product_id:
+            owned = Counter()
+            product = db.products.find_one({"_id": product_id}, {"thumbnail_path": 1, "thumbnail_bucket": 1})
+            if product and product.get("thumbnail_path"):
+                owned[(product.get("thumbnail_bucket") or "thumbnails", product["thumbnail_path"])] += 1
+            for coll in (db.product_files, db.licenses):
+                for f in coll.find({"product_id": product_id}, {"path": 1, "bucket": 1}):
+                    owned[(f.get("bucket"), f["path"])] += 1
+            # product_delete releases what the product's documents reference
+            product_delete(product_id)
+            unowned -= owned
+        for (bucket, file_id), count in unowned.items():
+            for _ in range(count):
+                blob_release(bucket, file_id)
+    except PyMongoError:
+        logger.exception("could not clean up failed upload %s", product_id)
+
+
+def serve_file(request, file_id, bucket_name="products", inline=False, cache_control=IMMUTABLE_PRIVATE):
+    """Stream a GridFS file chunk by chunk (Range/ETag/Last-Modified aware)"""
+    return serve_gridfs(request, bucket_name, file_id, inline=inline, cache_control=cache_control)
 
 
 def serve_thumbnail(request, file_id):
-    return serve_file(file_id, bucket_name="thumbnails", inline=True)
+    return serve_file(request, file_id, bucket_name="thumbnails", inline=True, cache_control=IMMUTABLE_PUBLIC)
 def serve_avatar(request, file_id):
-    return serve_file(file_id, bucket_name="avatars", inline=True)
+    return serve_file(request, file_id, bucket_name="avatars", inline=True, cache_control=IMMUTABLE_PUBLIC)
+
+def serve_image(request, bucket, file_id, size):
+    """Serve a resized WebP/JPEG rendition of an image, building it on first use"""
+    fmt = renditions.preferred_format(request.META.get("HTTP_ACCEPT"))
+    etag = immutable_etag(bucket, file_id, size, fmt)
+    exists, last_modified = stored_last_modified(bucket, file_id) if is_conditional(request) else (False, None)
+    if exists and immutable_not_modified(request, etag, last_modified):
+        response = not_modified_response(etag, IMMUTABLE_PUBLIC)
+    else:
+        try:
+            grid_out = renditions.get_or_build(bucket, file_id, size, fmt)
+        except (gridfs.NoFile, InvalidId, renditions.RenditionError):
+            raise Http404("Image not found.")
+        response = gridfs_response(request, grid_out, inline=True, etag=etag, cache_control=IMMUTABLE_PUBLIC)
+    # the representation depends on Accept (WebP vs JPEG)
+    patch_vary_headers(response, ["Accept"])
+    return response
 
 def download_product_file(request,file_id,bucket):
-    return serve_file(file_id,bucket_name=bucket,inline=True)
+    if bucket not in DOWNLOAD_BUCKETS:
+        raise Http404("File not found.")
+    return serve_file(request, file_id,bucket_name=bucket,inline=True)
 
 
 # ------------------------
 # Public Pages
 # ------------------------
+# Query budgets are the command counts with a cold document cache; the
+# profiler middleware warns when a view goes over.
+@query_budget(6)
 def home(request):
-    featured = list(
-        db.products.find({"status": "approved"})
-        .sort("download_count", -1)
-        .limit(8)
-    )
-    recent = list(
-        db.products.find({"status": "approved"})
-        .sort("created_at", -1)
-        .limit(6)
-    )
-    categories_cursor = db.products.aggregate([
-        {"$match": {"status": "approved"}},
-        {"$unwind": "$category"},
-        {"$group": {"_id": "$category"}},
-        {"$limit": 6}
-    ])
-
-    categories = []
-    for c in categories_cursor:
-        val = c["_id"]
-        if isinstance(val, dict) and "name" in val:
-            categories.append({"category": val["name"]})
-        elif isinstance(val, str):
-            categories.append({"category": val})
+    featured = product_cards({"status": "approved"}, [("download_count", -1)], limit=8)
+    recent = product_cards({"status": "approved"}, [("created_at", -1)], limit=6)
+    categories = category_facets(limit=6, by_count=True)
     all_products = featured + recent
     for p in all_products:
         p_id = p.get("_id")
         if p_id:
             p["id"] = str(p_id)
-
-        dev_id = p.get("developer_id")
-        dev = db.developers.find_one({"_id": dev_id}) if dev_id else None
-        if dev:
-            dev["_id"] = str(dev["_id"])
-            p["developer"] = dev
-            user_id = dev.get("user_id")
-            usr = db.users.find_one({"user_id": user_id}) if user_id else None
-            if usr:
-                usr["_id"] = str(usr["_id"])
-                p["user"] = usr
+    batch_loader(request).attach_developers(all_products)
 
     return render(request, "marketplace/home.html", {
         "featured_products": featured,
@@ -167,23 +279,25 @@ def home(request):
     })
 
 
+LISTING_SORTS = {
+    "-created_at": ("created_at", -1),
+    "-download_count": ("download_count", -1),
+    "-rating": ("rating", -1),
+    "price": ("price", 1),
+    "-price": ("price", -1)
+}
+LISTING_PAGE_SIZE = 12
+MODERATION_PAGE_SIZE = 20
+DEVELOPER_PAGE_SIZE = 20
 
-from bson import ObjectId
-
-def product_list(request):
+def _listing_params(request):
+    """Filters, sort and page position for product_list (shared with the async view)"""
     q = {"status": "approved"}
     query = request.GET.get("q")
-    if query:
-        q["$or"] = [
-            {"title": _regex_contains(query)},
-            {"description": _regex_contains(query)},
-            {"tags": _regex_contains(query)}
-        ]
 
     category_filter = request.GET.get("category")
     if category_filter:
         q["category"] = category_filter
-    
 
     product_type = request.GET.get("type")
     if product_type:
@@ -195,68 +309,95 @@ def product_list(request):
     elif price_filter == "paid":
         q["is_free"] = False
 
-    sort_by = request.GET.get("sort", "-created_at")
-    sort_map = {
-        "-created_at": ("created_at", -1),
-        "-download_count": ("download_count", -1),
-        "-rating": ("rating", -1),
-        "price": ("price", 1),
-        "-price": ("price", -1)
+    sort_by = request.GET.get("sort", "relevance" if query else "-created_at")
+    sort_field, sort_dir = LISTING_SORTS.get(sort_by, ("created_at", -1))
+
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+    except ValueError:
+        page = 1
+    return {
+        "q": q,
+        "query": query,
+        "category": category_filter,
+        "type": product_type,
+        "price": price_filter,
+        "sort_by": sort_by,
+        "sort_field": sort_field,
+        "sort_dir": sort_dir,
+        "page": page,
+        "skip": (page - 1) * LISTING_PAGE_SIZE,
+        "after": request.GET.get("after"),
+        "before": request.GET.get("before"),
     }
-    sort_field, sort_dir = sort_map.get(sort_by, ("created_at", -1))
 
-    page = int(request.GET.get("page", 1))
-    per_page = 12
-    total = products_count(q)
-    skip = (page - 1) * per_page
-    items = products_find(q, [(sort_field, sort_dir)], skip, per_page)
-    for p in items:
-        p["id"] = str(p["_id"])
-        dev = db.developers.find_one({"_id": p.get("developer_id")})
-        if dev:
-            dev["id"] = str(dev["_id"])
-            usr = db.users.find_one({"user_id": dev.get("user_id")})
-            if usr:
-                usr["id"] = str(usr["_id"])
-                dev["user"] = usr
-            p["developer"] = dev
-        if p.get("category"):
-            cat_objs = list(db.categories.find({"category": {"$in": p["category"]}}))
-            categories_list = []
-            for c in cat_objs:
-                c["id"] = str(c["_id"])
-                categories_list.append(c)
-            p["categories"] = categories_list
-        else:
-            p["categories"] = []
+def _listing_context(request, params, items, has_more, total, categories):
+    after, before, sort_by, page = params["after"], params["before"], params["sort_by"], params["page"]
+    if before and not after:
+        has_previous, has_next = has_more, True
+    else:
+        has_previous, has_next = page > 1 or bool(after), has_more
+    cursors = items and sort_by != "relevance"
+    next_cursor = cursor_encode(items[-1], params["sort_field"]) if cursors and has_next else None
+    prev_cursor = cursor_encode(items[0], params["sort_field"]) if cursors and has_previous else None
 
-    paginator = Paginator(range(total), per_page)
+    paginator = Paginator(range(total), LISTING_PAGE_SIZE)
     page_obj = paginator.get_page(page)
-    categories_cursor = db.products.aggregate([
-        {"$match": {"status": "approved"}},
-        {"$unwind": "$category"},
-        {"$group": {"_id": "$category", "count": {"$sum": 1}}},
-        {"$match": {"count": {"$gt": 0}}},
-        {"$sort":{"_id":1}},
-    ])
-    categories = [{"category": c["_id"]} for c in categories_cursor]
     get_params = request.GET.copy()
-    if "sort" in get_params:
-        del get_params["sort"]
+    for key in ("page", "after", "before"):
+        get_params.pop(key, None)
+    page_querystring = get_params.urlencode()
+    get_params.pop("sort", None)
     querystring = get_params.urlencode()
 
-    return render(request, "marketplace/product_list.html", {
+    return {
         "items": items,
         "categories": categories,
-        "current_category": category_filter,
-        "current_type": product_type,
-        "current_price": price_filter,
+        "current_category": params["category"],
+        "current_type": params["type"],
+        "current_price": params["price"],
         "current_sort": sort_by,
-        "query": query,
+        "query": params["query"],
         "page_obj": page_obj,
-        "querystring": querystring
-    })
+        "querystring": querystring,
+        "page_querystring": page_querystring,
+        "has_next": has_next,
+        "has_previous": has_previous,
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor,
+    }
 
+@query_budget(10)
+def product_list(request):
+    params = _listing_params(request)
+    q, query = params["q"], params["query"]
+    ranked = catalog_index.search(query) if query else None
+
+    per_page = LISTING_PAGE_SIZE
+    if ranked is not None and params["sort_by"] == "relevance":
+        # Relevance order comes from the search index, so page by offset.
+        items, has_more, total = products_search_page(q, ranked, per_page, skip=params["skip"])
+        params["after"] = params["before"] = None
+    else:
+        if ranked is not None:
+            q["_id"] = {"$in": [pid for pid, _ in ranked]}
+            total = products_count(q)
+        else:
+            total = products_count_cached(q)
+        items, has_more = products_find_page(
+            q, params["sort_field"], params["sort_dir"], per_page,
+            skip=params["skip"], after=params["after"], before=params["before"]
+        )
+    for p in items:
+        p["id"] = str(p["_id"])
+    loader = batch_loader(request)
+    loader.attach_developers(items)
+    loader.attach_categories(items)
+
+    context = _listing_context(request, params, items, has_more, total, category_facets())
+    return render(request, "marketplace/product_list.html", context)
+
+@query_budget(13)
 def product_detail(request, pk):
     product = None
     profile, is_admin = None, False
@@ -265,19 +406,37 @@ def product_detail(request, pk):
         profile, _ = developer_get_or_create(request.user.id)
         is_admin = request.user.is_staff
     if is_admin:
-        product = db.products.find_one({"_id": pk})
+        product = product_doc(pk)
     else:
         product = product_get(pk, status="approved")
         if not product and profile:
-            product = db.products.find_one({"_id": pk, "developer_id": profile["_id"]})
+            product = product_doc(pk)
+            if product and product.get("developer_id") != profile["_id"]:
+                product = None
 
     if not product:
         messages.error(request, "Product not found.")
         return redirect("home")
 
-    product['id'] = product['_id']
     license = db.licenses.find_one({'product_id': product['_id']})
     files = list(db.product_files.find({"product_id": product["_id"]}))
+    _decorate_product(product, license, files, user_get_by_pk(product["user_id"]), developer_get(product["developer_id"]))
+    reviews=[]
+    user_review=[]
+    if product.get("status") == "approved":
+        reviews = reviews_for_product(pk)
+        if request.user.is_authenticated:
+            user_review = review_get_by_user(request.user.id, pk)
+    related = products_related(product.get("category"), pk, limit=4)
+
+    return render(request, "marketplace/product_detail.html", _detail_context(
+        request, product, reviews, user_review, related,
+        product_files_for(pk), category_get(product.get("category_id"))
+    ))
+
+def _decorate_product(product, license, files, user_details, dev):
+    """Attach files, screenshots, license and owner details for product_detail"""
+    product['id'] = product['_id']
     product["files"] = []
     product["screenshots"] = []
 
@@ -296,28 +455,39 @@ def product_detail(request, pk):
             })
 
     product["license_file"] = license
-    product["user_details"] = db.users.find_one({"_id": product["user_id"]})
+    product["user_details"] = user_details
     product["product_type_label"] = TYPE_LABELS.get(product.get("product_type"), product.get("product_type"))
-    dev = db.developers.find_one({"_id": product["developer_id"]})
     product['developer_doc'] = dev
-    reviews=[]
-    user_review=[]
-    if product.get("status") == "approved":
-        reviews = reviews_for_product(pk)
-        if request.user.is_authenticated:
-            user_review = review_get_by_user(request.user.id, pk)
-    related = products_related(product.get("category"), pk, limit=4)
-    refresh_product_rating(product['id'])
+    product["rating_breakdown"] = rating_breakdown(product)
+    return product
 
-    return render(request, "marketplace/product_detail.html", {
+def _detail_context(request, product, reviews, user_review, related, files, category):
+    return {
         "product": product,
         "reviews": reviews,
         "user_review": user_review,
         "can_review": request.user.is_authenticated and not user_review and product.get('status')=='approved',
         "related_products": related,
-        "files": product_files_for(pk),
-        "category": category_get(product.get("category_id"))
-    })
+        "files": files,
+        "category": category
+    }
+
+def _downloadable_product(request, pk):
+    """The product if this user may download it, else None (with a message)."""
+    profile, _ = developer_get_or_create(request.user.id)
+    product = product_doc(pk)
+    if product and product.get("status") != "approved" and product.get("developer_id") != profile["_id"]:
+        product = None
+    if not product:
+        messages.error(request, "Product not available for download.")
+    return product
+
+def _record_download(request, pk):
+    download_counter.record(
+        pk, request.user.id,
+        ip=request.META.get("REMOTE_ADDR", ""),
+        ua=request.META.get("HTTP_USER_AGENT", "")[:256],
+    )
 
 @login_required
 def download_product(request, pk):
@@ -325,22 +495,43 @@ def download_product(request, pk):
         messages.error(request, "Login required to download this product.")
         return redirect("login")
 
-    profile, _ = developer_get_or_create(request.user.id)
-    product = db.products.find_one({
-        "$or": [
-            {"_id": pk, "status": "approved"},
-            {"_id": pk, "developer_id": profile["_id"]}
-        ]
-    })
-
+    product = _downloadable_product(request, pk)
     if not product:
-        messages.error(request, "Product not available for download.")
         return redirect("home")
     main_file = db.product_files.find_one({"product_id": pk, "file_type": "main"})
     if not main_file:
         messages.error(request, "Main product file not found.")
         return redirect("product_detail", pk=pk)
-    return serve_file(file_id=main_file["path"], bucket_name="products", inline=False)
+    _record_download(request, pk)
+    # the URL names the product, not the file, so clients revalidate each time
+    return serve_file(request, file_id=main_file["path"], bucket_name="products", inline=False,
+                      cache_control=REVALIDATE_PRIVATE)
+
+@login_required
+def download_bundle(request, pk):
+    """Every file of a product (and its license) as one ZIP, streamed from GridFS"""
+    if not request.user.is_authenticated:
+        messages.error(request, "Login required to download this product.")
+        return redirect("login")
+
+    product = _downloadable_product(request, pk)
+    if not product:
+        return redirect("home")
+    signature, members = bundle_members(pk)
+    if not members:
+        messages.error(request, "This product has no files.")
+        return redirect("product_detail", pk=pk)
+    # the URL names the product, so clients revalidate against the member signature
+    etag = bundle_etag(signature)
+    if immutable_not_modified(request, etag):
+        return not_modified_response(etag, REVALIDATE_PRIVATE)
+    _record_download(request, pk)
+    filename = "-".join(filter(None, [slugify(product.get("title", "")) or pk, slugify(product.get("version") or "")])) + ".zip"
+    response = StreamingHttpResponse(stream_bundle(members), content_type="application/zip")
+    response["Content-Disposition"] = f'attachment; filename="{quote(filename)}"'
+    response["ETag"] = etag
+    response["Cache-Control"] = REVALIDATE_PRIVATE
+    return response
 
 # ------------------------
 # Authentication
@@ -367,7 +558,7 @@ def register(request):
 def developer_dashboard(request):
     profile, _ = developer_get_or_create(request.user.id)
     total_products_count = db.products.count_documents({"developer_id": profile["_id"]})
-    my_products = list(db.products.find({"developer_id": profile["_id"]}).sort("created_at", -1))
+    my_products = product_cards({"developer_id": profile["_id"]}, [("created_at", -1)])
     for p in my_products:
         p['id'] = p['_id']
     total_downloads = sum(p.get("download_count", 0) for p in my_products)
@@ -401,6 +592,8 @@ def edit_profile(request):
                 saved = _save_file_to_gridfs(form.cleaned_data["avatar"], "avatars")
                 updates["avatar_path"] = saved["file_id"]
                 updates["avatar_bucket"] = saved["bucket"]
+                if profile.get("avatar_path") and profile["avatar_path"] != saved["file_id"]:
+                    blob_release(profile.get("avatar_bucket") or "avatars", profile["avatar_path"])
             developer_update(request.user.id, updates)
             messages.success(request, "Profile updated successfully!")
             return redirect("developer_dashboard")
@@ -447,40 +640,73 @@ def upload_product(request):
                 "user_id": user["_id"],
                 "tags": [t.strip() for t in data.get("tags", "").split(",") if t.strip()]
             }
+            # Every GridFS write goes out at once; metadata follows in bulk.
+            uploads = []
             if data.get("thumbnail"):
-                saved = _save_file_to_gridfs(data["thumbnail"], "thumbnails")
-                product_payload["thumbnail_path"] = saved["file_id"]
-                product_payload["thumbnail_bucket"] = saved["bucket"]
-            product_id = product_create(product_payload)
-            if categories:
-                category_create(product_id, categories)
+                uploads.append(("thumbnail", data["thumbnail"], "thumbnails"))
             if data.get("license_file"):
-                saved_license = _save_file_to_gridfs(data["license_file"], "license")
-                license_create(
-                    product_id=product_id,
-                    path=saved_license["file_id"],
-                    filename=saved_license["filename"],
-                    size=saved_license["size"],
-                    bucket=saved_license["bucket"]
-                )
+                uploads.append(("license", data["license_file"], "license"))
             for fform in file_formset:
                 if fform.cleaned_data and not fform.cleaned_data.get("DELETE"):
                     uploaded_file = fform.cleaned_data.get("file")
-                    file_type = fform.cleaned_data.get("file_type")
                     if uploaded_file:
-                        saved_file = _save_file_to_gridfs(uploaded_file, "products")
-                        product_file_add(
-                            product_id=product_id,
-                            file_type=file_type,
-                            path=saved_file["file_id"],
-                            filename=saved_file["filename"],
-                            size=saved_file["size"],
-                            bucket=saved_file["bucket"],
-                            content_type=uploaded_file.content_type
-                        )
-
-            messages.success(request, "Product uploaded! Awaiting review.")
-            return redirect("developer_dashboard")
+                        uploads.append((fform.cleaned_data.get("file_type"), uploaded_file, "products"))
+            saved_all, product_id = [], None
+            try:
+                saved_all = _save_files_to_gridfs([(f, bucket) for _, f, bucket in uploads])
+                file_entries = []
+                saved_license = None
+                for (role, _, _), saved in zip(uploads, saved_all):
+                    if role == "thumbnail":
+                        product_payload["thumbnail_path"] = saved["file_id"]
+                        product_payload["thumbnail_bucket"] = saved["bucket"]
+                    elif role == "license":
+                        saved_license = saved
+                    else:
+                        file_entries.append((role, saved))
+                product_id = product_create(product_payload)
+                if categories:
+                    category_create(product_id, categories)
+                if saved_license:
+                    license_id = license_create(
+                        product_id=product_id,
+                        path=saved_license["file_id"],
+                        filename=saved_license["filename"],
+                        size=saved_license["size"],
+                        checksum=saved_license["checksum"],
+                        bucket=saved_license["bucket"]
+                    )
+                file_ids = product_files_add_many([
+                    product_file_payload(
+                        product_id=product_id,
+                        file_type=file_type,
+                        path=saved_file["file_id"],
+                        filename=saved_file["filename"],
+                        size=saved_file["size"],
+                        checksum=saved_file["checksum"],
+                        bucket=saved_file["bucket"],
+                        content_type=saved_file["content_type"]
+                    )
+                    for file_type, saved_file in file_entries
+                ])
+                # Scans and renditions run in `manage.py run_jobs`, not in this request.
+                enqueue_many(
+                    [("scan_file", {"collection": "product_files", "id": file_id}) for file_id in file_ids]
+                    + ([("scan_file", {"collection": "licenses", "id": license_id})] if saved_license else [])
+                    + ([("build_renditions", {"bucket": product_payload["thumbnail_bucket"],
+                                              "file_id": product_payload["thumbnail_path"]})]
+                       if product_payload.get("thumbnail_path") else [])
+                )
+            except ValueError as exc:
+                _discard_upload(product_id, saved_all)
+                messages.error(request, str(exc))
+            except PyMongoError:
+                logger.exception("upload by user %s failed", request.user.id)
+                _discard_upload(product_id, saved_all)
+                messages.error(request, "Your upload could not be stored. Please try again.")
+            else:
+                messages.success(request, "Product uploaded! Awaiting review.")
+                return redirect("developer_dashboard")
 
     else:
         form = ProductForm()
@@ -512,23 +738,6 @@ def add_review(request, pk):
             int(form.cleaned_data["rating"]),
             form.cleaned_data.get("comment", "")
         )
-        reviews = list(db.reviews.find({"product_id": ObjectId(pk)}))
-        if reviews:
-            total = sum(r["rating"] for r in reviews)
-            count = len(reviews)
-            avg = round(total / count, 1)
-        else:
-            avg = 0
-            count = 0
-        db.products.update_one(
-            {"_id": pk},
-            {"$set": {
-                "rating": avg,
-                "review_count": count,
-                "updated_at": now()
-            }}
-        )
-
         messages.success(request, "Review added successfully!")
 
     return redirect("product_detail", pk=pk)
@@ -541,17 +750,26 @@ def add_review(request, pk):
 # ------------------------
 @user_passes_test(lambda u: u.is_staff)
 def moderation_queue(request):
-    pending_products = list(db.products.find({"status": "pending"}).sort("created_at", -1))
+    after = request.GET.get("after")
+    before = request.GET.get("before")
+    pending_products, has_more = moderation_queue_page(MODERATION_PAGE_SIZE, after=after, before=before)
     for p in pending_products:
         p["id"] = str(p["_id"])
         p["product_type_label"] = TYPE_LABELS.get(p.get("product_type"), p.get("product_type"))
-        files = list(db.product_files.find({"product_id": p["_id"]}))
-        for f in files:
+        for f in p["files"]:
             f["id"] = str(f["_id"])
             f["file_type_label"] = FILE_TYPE_LABELS.get(f.get("file_type"), f.get("file_type"))
-        p["files"] = files
-        p["developer"] = db.developers.find_one({"_id": p["developer_id"]})
-    return render(request, "marketplace/moderation_queue.html", {"pending_products": pending_products})
+    if before and not after:
+        has_previous, has_next = has_more, True
+    else:
+        has_previous, has_next = bool(after), has_more
+    return render(request, "marketplace/moderation_queue.html", {
+        "pending_products": pending_products,
+        "has_next": has_next,
+        "has_previous": has_previous,
+        "next_cursor": cursor_encode(pending_products[-1], "created_at") if has_next and pending_products else None,
+        "prev_cursor": cursor_encode(pending_products[0], "created_at") if has_previous and pending_products else None,
+    })
 
 
 @user_passes_test(lambda u: u.is_staff)
@@ -562,7 +780,7 @@ def moderate_product(request, pk):
         return redirect("moderation_queue")
 
     developer_id = product["developer_id"]
-    product["developer"] = db.developers.find_one({"_id": developer_id})
+    product["developer"] = developer_get(developer_id)
     license = db.licenses.find_one({'product_id': product['_id']})
     files = list(db.product_files.find({"product_id": product["_id"]}))
     for f in files:
@@ -665,6 +883,8 @@ def admin_category_edit(request, pk):
                     "$set": {"category.$": new_name}
                 }
             )
+            category_stats_rename(old_name, new_name)
+            doc_cache.clear("product")
             messages.success(request, "Category updated and applied to products.")
             return redirect("admin_category_list")
         messages.error(request, "Name is required.")
@@ -684,7 +904,7 @@ def admin_category_delete(request, pk):
 # ------------------------
 @staff_member_required
 def admin_product_list(request):
-    products = list(db.products.find().sort("created_at", -1))
+    products = product_cards({}, [("created_at", -1)])
     for p in products:
         p["id"] = str(p["_id"])
     return render(request, "admin/products_list.html", {"products": products})
@@ -692,7 +912,7 @@ def admin_product_list(request):
 
 @staff_member_required
 def admin_product_delete(request, pk):
-    db.products.delete_one({"_id":pk})
+    product_delete(pk)
     messages.success(request, "Product deleted.")
     return redirect("admin_product_list")
 
@@ -705,69 +925,71 @@ def admin_developer_list(request):
     devs = list(db.developers.find().sort("created_at", -1))
     for d in devs:
         d["id"] = str(d["_id"])
-        d['user']=db.users.find_one({'user_id':d['user_id']})
+    batch_loader(request).attach_users(devs)
     return render(request, "admin/developers_list.html", {"developers": devs})
 
 
+@staff_member_required
+def admin_cache_stats(request):
+    return JsonResponse({"documents": doc_cache.stats(), "blobs": blob_cache.stats()})
+
+@staff_member_required
+def admin_pool_stats(request):
+    """Mongo pool usage for the worker that served this request"""
+    return JsonResponse(connections.stats())
+
+@staff_member_required
+def admin_job_stats(request):
+    """Background job queue depth by status"""
+    return JsonResponse(job_stats())
+
+
 @staff_member_required
 def admin_developer_delete(request, pk):
-    db.developers.delete_one({"_id": pk})
+    developer_delete(pk)
     messages.success(request, "Developer deleted.")
     return redirect("admin_developer_list")
 
+def _developer_profile_context(request, pk):
+    devs = developer_get(pk)
+    if not devs:
+        return None
+    devs["id"] = devs["_id"]
+    devs['user'] = user_get(devs['user_id'])
+    pages = {}
+    for status in PRODUCT_STATUSES:
+        try:
+            pages[status] = int(request.GET.get(f"{status}_page", 1))
+        except ValueError:
+            pages[status] = 1
+    by_status = developer_products_by_status(devs["id"], DEVELOPER_PAGE_SIZE, pages)
+    for group in by_status.values():
+        for p in group["items"]:
+            p['id'] = p['_id']
+    get_params = request.GET.copy()
+    for status in PRODUCT_STATUSES:
+        get_params.pop(f"{status}_page", None)
+    return {
+        "developers": devs,
+        "products": [p for group in by_status.values() for p in group["items"]],
+        "approved_products": by_status["approved"]["items"],
+        "pending_products": by_status["pending"]["items"],
+        "rejected_products": by_status["rejected"]["items"],
+        "by_status": by_status,
+        "querystring": get_params.urlencode(),
+    }
+
 @staff_member_required
 def admin_developer_view(request,pk):
-    devs = db.developers.find_one({'_id':pk})
-    if not devs:
+    context = _developer_profile_context(request, pk)
+    if not context:
         messages.error(request, "Developer not found.")
         return redirect("admin_developer_list")
-    devs["id"] = devs["_id"]
-    devs['user']=db.users.find_one({'user_id':devs['user_id']})
-    products=list(db.products.find({'developer_id':devs["id"]}))
-    for p in products:
-        p['id']=p['_id']
-    approved_products = list(db.products.find({'developer_id':devs["id"],'status':"approved"}))
-    for a in approved_products:
-        a['id']=a['_id']
-    pending_products = list(db.products.find({'developer_id':devs["id"],'status':"pending"}))
-    for p in pending_products:
-        p['id']=p['_id']
-    rejected_products = list(db.products.find({'developer_id':devs["id"],'status':"rejected"}))
-    for r in rejected_products:
-        r['id']=r['_id']
-    context = {
-    "developers": devs,
-    "products": products,
-    "approved_products": approved_products,
-    "pending_products": pending_products,
-    "rejected_products": rejected_products,
-    }
     return render(request, 'marketplace/developer_profile.html', context)
 
 def developer_profile(request,pk):
-    devs = db.developers.find_one({'_id':pk})
-    if not devs:
+    context = _developer_profile_context(request, pk)
+    if not context:
         messages.error(request, "Developer not found.")
         return redirect("admin_developer_list")
-    devs["id"] = devs["_id"]
-    devs['user']=db.users.find_one({'user_id':devs['user_id']})
-    products=list(db.products.find({'developer_id':devs["id"]}))
-    for p in products:
-        p['id']=p['_id']
-    approved_products = list(db.products.find({'developer_id':devs["id"],'status':"approved"}))
-    for a in approved_products:
-        a['id']=a['_id']
-    pending_products = list(db.products.find({'developer_id':devs["id"],'status':"pending"}))
-    for p in pending_products:
-        p['id']=p['_id']
-    rejected_products = list(db.products.find({'developer_id':devs["id"],'status':"rejected"}))
-    for r in rejected_products:
-        r['id']=r['_id']
-    context = {
-    "developers": devs,
-    "products": products,
-    "approved_products": approved_products,
-    "pending_products": pending_products,
-    "rejected_products": rejected_products,
-    }
     return render(request, 'marketplace/developer_profile.html', context)
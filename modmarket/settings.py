@@ -7,7 +7,6 @@ from pathlib import Path
 import os
 import environ
 import dj_database_url
-from pymongo import MongoClient
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -50,6 +49,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "marketplace.profiling.QueryProfilerMiddleware",
 ]
 
 ROOT_URLCONF = "modmarket.urls"
@@ -87,10 +87,40 @@ if not DEBUG:
 MONGO_URI = env("MONGO_URI", default="mongodb://localhost:27017")
 MONGO_DB_NAME = env("MONGO_DB_NAME", default="modmarket")
 
-# Lazy getter avoids blocking at import time
+# Connection pool, per worker process (see marketplace/db.py). Workers x
+# MONGO_MAX_POOL_SIZE should stay below the server's connection limit.
+MONGO_MAX_POOL_SIZE = env.int("MONGO_MAX_POOL_SIZE", default=50)
+MONGO_MIN_POOL_SIZE = env.int("MONGO_MIN_POOL_SIZE", default=0)
+MONGO_MAX_IDLE_TIME_MS = env.int("MONGO_MAX_IDLE_TIME_MS", default=60000)
+MONGO_MAX_CONNECTING = env.int("MONGO_MAX_CONNECTING", default=2)
+MONGO_WAIT_QUEUE_TIMEOUT_MS = env.int("MONGO_WAIT_QUEUE_TIMEOUT_MS", default=None)
+MONGO_CONNECT_TIMEOUT_MS = env.int("MONGO_CONNECT_TIMEOUT_MS", default=5000)
+MONGO_SOCKET_TIMEOUT_MS = env.int("MONGO_SOCKET_TIMEOUT_MS", default=None)
+MONGO_SERVER_SELECTION_TIMEOUT_MS = env.int("MONGO_SERVER_SELECTION_TIMEOUT_MS", default=8000)
+
+# Check (never build) indexes in the background when a server process starts
+MONGO_VERIFY_INDEXES = env.bool("MONGO_VERIFY_INDEXES", default=True)
+# Build the in-process search index when a server process starts
+SEARCH_WARM_ON_START = env.bool("SEARCH_WARM_ON_START", default=True)
+
+# Per-request Mongo profiling (see marketplace/profiling.py). Staff always get a
+# Server-Timing header; MONGO_PROFILE_SERVER_TIMING sends it to everyone.
+MONGO_PROFILE_SERVER_TIMING = env.bool("MONGO_PROFILE_SERVER_TIMING", default=DEBUG)
+# Warn when one query shape repeats this often in a request (likely N+1)
+MONGO_PROFILE_REPEAT_WARN = env.int("MONGO_PROFILE_REPEAT_WARN", default=5)
+# Log this fraction of requests slower than MONGO_PROFILE_SLOW_MS to marketplace.slow_requests
+MONGO_PROFILE_SLOW_MS = env.int("MONGO_PROFILE_SLOW_MS", default=500)
+MONGO_PROFILE_SAMPLE_RATE = env.float("MONGO_PROFILE_SAMPLE_RATE", default=0.0)
+# Raise instead of warning when a view goes over its @query_budget
+MONGO_QUERY_BUDGET_STRICT = env.bool("MONGO_QUERY_BUDGET_STRICT", default=False)
+
+# Budget for `manage.py profile_imports --budget-ms` and the import-time test
+IMPORT_TIME_BUDGET_MS = env.int("IMPORT_TIME_BUDGET_MS", default=1500)
+
+# Lazy getter avoids blocking at import time; shares the per-process client
 def get_mongo_db():
-    client = MongoClient(MONGO_URI)
-    return client[MONGO_DB_NAME]
+    from marketplace.db import get_db
+    return get_db()
 
 AUTH_PASSWORD_VALIDATORS = [
     {"NAME": "django.contrib.auth.password_validation.UserAttributeSimilarityValidator"},
@@ -117,9 +147,53 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap4"
 CRISPY_TEMPLATE_PACK = "bootstrap4"
 
-FILE_UPLOAD_MAX_MEMORY_SIZE = 100 * 1024 * 1024
+# Uploads above this size are spooled to a temporary file and streamed into
+# GridFS in chunks, so a large mod is never held in worker memory.
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440  # 2.5MB (Django default)
 DATA_UPLOAD_MAX_MEMORY_SIZE = 100 * 1024 * 1024
 
+# Files in one upload are written to GridFS this many at a time
+UPLOAD_WRITE_WORKERS = env.int("UPLOAD_WRITE_WORKERS", default=4)
+
+# Background job queue (see marketplace/jobs.py, `manage.py run_jobs`).
+# A claimed job is retried once its lock lapses for JOB_VISIBILITY_TIMEOUT seconds;
+# failures back off exponentially from JOB_BACKOFF_BASE up to JOB_BACKOFF_MAX seconds.
+JOB_VISIBILITY_TIMEOUT = env.int("JOB_VISIBILITY_TIMEOUT", default=300)
+JOB_MAX_ATTEMPTS = env.int("JOB_MAX_ATTEMPTS", default=5)
+JOB_BACKOFF_BASE = env.int("JOB_BACKOFF_BASE", default=10)
+JOB_BACKOFF_MAX = env.int("JOB_BACKOFF_MAX", default=3600)
+# 0 means one worker process per CPU
+JOB_WORKER_PROCESSES = env.int("JOB_WORKER_PROCESSES", default=0)
+
+# Uploaded ZIP/APK archives are flagged past these limits (see marketplace/archives.py)
+ARCHIVE_MAX_ENTRIES = env.int("ARCHIVE_MAX_ENTRIES", default=20000)
+ARCHIVE_MAX_UNCOMPRESSED = env.int("ARCHIVE_MAX_UNCOMPRESSED", default=4 * 1024 ** 3)
+ARCHIVE_MAX_RATIO = env.int("ARCHIVE_MAX_RATIO", default=100)
+# Entries kept in the manifest shown to moderators
+ARCHIVE_MANIFEST_ENTRIES = env.int("ARCHIVE_MANIFEST_ENTRIES", default=200)
+
+# Download counts are buffered per worker and flushed in bulk (see marketplace/counters.py)
+DOWNLOAD_COUNTER_FLUSH_INTERVAL = env.int("DOWNLOAD_COUNTER_FLUSH_INTERVAL", default=5)
+DOWNLOAD_COUNTER_MAX_PENDING = env.int("DOWNLOAD_COUNTER_MAX_PENDING", default=500)
+
+# Read-through cache for product/developer/user documents (see marketplace/cache.py).
+# Set DOC_CACHE_BACKEND to a CACHES alias to share entries across workers.
+DOC_CACHE_TTL = env.int("DOC_CACHE_TTL", default=60)
+DOC_CACHE_MAX_ENTRIES = env.int("DOC_CACHE_MAX_ENTRIES", default=2000)
+DOC_CACHE_BACKEND = env("DOC_CACHE_BACKEND", default=None)
+
+# Store identical uploads once per GridFS bucket (see blob_index / dedupe_blobs)
+DEDUPE_UPLOADS = env.bool("DEDUPE_UPLOADS", default=True)
+
+# Optional local-disk cache of hot GridFS files (see marketplace/blobcache.py); unset disables it
+BLOB_CACHE_DIR = env("BLOB_CACHE_DIR", default=None)
+BLOB_CACHE_MAX_BYTES = env.int("BLOB_CACHE_MAX_BYTES", default=2 * 1024 ** 3)
+BLOB_CACHE_MAX_FILE_BYTES = env.int("BLOB_CACHE_MAX_FILE_BYTES", default=200 * 1024 ** 2)
+
+# Route file serving and catalog pages to marketplace/async_views.py (Motor).
+# Only worth enabling when served by an ASGI server, see modmarket/asgi.py.
+ASYNC_VIEWS = env.bool("ASYNC_VIEWS", default=False)
+
 LOGIN_URL = "login"
 LOGIN_REDIRECT_URL = "home"
 LOGOUT_REDIRECT_URL = "home"
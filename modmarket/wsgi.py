@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "modmarket.settings")
 
 application = get_wsgi_application()
+
+# Indexes are built by `manage.py ensure_indexes`; here we only check them, off the boot path.
+from marketplace.db import verify_indexes_in_background  # noqa: E402
+from marketplace.search import warm_search_index_in_background  # noqa: E402
+
+verify_indexes_in_background()
+warm_search_index_in_background()